@@ -0,0 +1,149 @@
+#-------------------------------------------------------------------------------
+# pss: archives.py
+#
+# Listing and reading the members of zip and tar archives, which are searched
+# as files with virtual paths like app.jar!/com/x/Y.java
+#
+# Eli Bendersky (eliben@gmail.com)
+# This code is in the public domain
+#-------------------------------------------------------------------------------
+import lzma
+import os
+import tarfile
+import zipfile
+import zlib
+
+
+# Separates the path of an archive from the name of a member in the virtual
+# path of the member.
+MEMBER_SEPARATOR = '!/'
+
+_ZIP_EXTENSIONS = ('.zip', '.jar', '.war', '.ear', '.whl', '.egg', '.apk')
+_TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tbz',
+                   '.tar.xz', '.txz')
+
+# Errors raised for corrupt or truncated archives, besides OSError
+ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error,
+                  lzma.LZMAError)
+
+
+def archive_format(filename):
+    """ The format of the archive with the given file name, judging by its
+        extension: 'zip', 'tar' or None if it's not an archive.
+    """
+    name = filename.lower()
+    if name.endswith(_ZIP_EXTENSIONS):
+        return 'zip'
+    if name.endswith(_TAR_EXTENSIONS):
+        return 'tar'
+    return None
+
+
+def member_path(archive, name):
+    """ The virtual path of the member with the given name in archive.
+    """
+    return archive + MEMBER_SEPARATOR + name.replace('/', os.sep)
+
+
+def split_member_path(path):
+    """ Split the virtual path of an archive member into a pair (archive,
+        name). Return None if path is not the path of a member.
+    """
+    separator = MEMBER_SEPARATOR.replace('/', os.sep)
+    i = path.find(separator)
+    while i >= 0:
+        if archive_format(path[:i]) is not None:
+            name = path[i + len(separator):].replace(os.sep, '/')
+            return path[:i], name
+        i = path.find(separator, i + 1)
+    return None
+
+
+def archive_members(archive):
+    """ Generate the names of the regular files in the archive at the given
+        path, in the order they're stored. Archives that can't be read
+        have no members; a corrupt archive has the members that precede
+        the corruption.
+
+        An archive can hold several entries with the same name (tar
+        archives appended to, in particular). The last one replaces the
+        others, like when the archive is extracted, so each name is
+        generated once, in the place of its last entry.
+    """
+    # Maps the names of the entries to whether the last entry with the name
+    # is a regular file, in the order of the last entries.
+    entries = {}
+    try:
+        if archive_format(archive) == 'zip':
+            with zipfile.ZipFile(archive) as zf:
+                for info in zf.infolist():
+                    entries.pop(info.filename, None)
+                    entries[info.filename] = not info.is_dir()
+        else:
+            # Only the headers are read: the data of members is skipped by
+            # seeking (which still decompresses it in compressed archives).
+            with tarfile.open(archive, 'r:*') as tf:
+                for info in tf:
+                    entries.pop(info.name, None)
+                    entries[info.name] = info.isfile()
+    except (OSError,) + ARCHIVE_ERRORS:
+        pass
+    for name, is_file in entries.items():
+        if is_file:
+            yield name
+
+
+class MemberReader(object):
+    """ Opens archive members for reading their contents, without
+        extracting them to disk.
+
+        The archive of the last member opened is kept open, as members are
+        usually read one after another. Tar archives have no index to jump
+        to a member, so all the headers of a tar archive are read when
+        it's opened, to find the last entry of each member (see
+        archive_members). Members are then read by seeking, which goes
+        forward through a compressed archive when they're read in order.
+    """
+    def __init__(self):
+        self._archive = None
+        self._zipfile = None
+        self._tarfile = None
+
+    def open(self, archive, name):
+        """ Open the member with the given name in archive, returning a
+            buffered binary file object. Raise OSError if it can't be
+            opened. Reading the member can also raise ARCHIVE_ERRORS.
+        """
+        try:
+            if archive_format(archive) == 'zip':
+                return self._open_zip(archive).open(name)
+            return self._open_tar_member(archive, name)
+        except (KeyError,) + ARCHIVE_ERRORS as e:
+            self.close()
+            raise OSError('cannot read %s in %s: %s' % (name, archive, e))
+
+    def close(self):
+        if self._zipfile is not None:
+            self._zipfile.close()
+        if self._tarfile is not None:
+            self._tarfile.close()
+        self._archive = self._zipfile = self._tarfile = None
+
+    def _open_zip(self, archive):
+        if self._archive != archive or self._zipfile is None:
+            self.close()
+            self._zipfile = zipfile.ZipFile(archive)
+            self._archive = archive
+        return self._zipfile
+
+    def _open_tar_member(self, archive, name):
+        if self._archive != archive or self._tarfile is None:
+            self.close()
+            self._tarfile = tarfile.open(archive, 'r:*')
+            self._archive = archive
+            self._tarfile.getmembers()
+        # getmember finds the last entry with the name
+        info = self._tarfile.getmember(name)
+        if not info.isfile():
+            raise KeyError(name)
+        return self._tarfile.extractfile(info)
@@ -0,0 +1,232 @@
+#-------------------------------------------------------------------------------
+# pss: compressed.py
+#
+# Transparent decompression of gzip, bzip2 and xz compressed files, for
+# searching their contents.
+#
+# Eli Bendersky (eliben@gmail.com)
+# This code is in the public domain
+#-------------------------------------------------------------------------------
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import threading
+import zlib
+
+
+# The modules that decompress each format, by the magic bytes that compressed
+# files start with.
+_MAGIC_FORMATS = [
+    (b'\x1f\x8b', gzip),
+    (b'BZh', bz2),
+    (b'\xfd7zXZ\x00', lzma),
+]
+
+# The modules that decompress files by their extensions. Files in the legacy
+# .lzma format have no magic bytes, so they're only recognized by extension.
+_EXTENSION_FORMATS = {
+    '.gz': gzip,
+    '.bz2': bz2,
+    '.xz': lzma,
+    '.lzma': lzma,
+}
+
+# Extensions of compressed files. foo.c.gz is found like foo.c when
+# compressed files are searched (see FileFinder).
+COMPRESSED_EXTENSIONS = frozenset(_EXTENSION_FORMATS)
+
+# Errors raised by the decompressors on corrupt or truncated data. gzip's
+# BadGzipFile and bz2's errors are OSErrors already.
+_DECOMPRESSION_ERRORS = (EOFError, zlib.error, lzma.LZMAError)
+
+
+def open_decompressed(fileobj, filename, block, prefetch=False):
+    """ If the binary file fileobj (named filename) is compressed, return a
+        buffered binary stream of its decompressed contents. Otherwise
+        return None. block is the first block of the file, for recognizing
+        the compression format by its magic bytes; the file position
+        should be at its start.
+
+        Only files with the extension of a compressed file are compressed:
+        a text file that happens to start with magic bytes (like "BZh") is
+        searched as it is. So are files with such an extension that turn
+        out not to be compressed.
+
+        The stream is decompressed in chunks as it's read. With prefetch,
+        a thread decompresses ahead of the reader (see DecompressedReader).
+        The stream has to be closed, but closing it doesn't close fileobj.
+    """
+    ext = os.path.splitext(filename)[1]
+    if ext not in COMPRESSED_EXTENSIONS:
+        return None
+    module = None
+    has_magic = False
+    for magic, magic_module in _MAGIC_FORMATS:
+        if block.startswith(magic):
+            module = magic_module
+            has_magic = True
+            break
+    else:
+        if ext == '.lzma':
+            module = _EXTENSION_FORMATS[ext]
+    if module is None:
+        return None
+    reader = DecompressedReader(fileobj, module, prefetch=prefetch)
+    stream = io.BufferedReader(reader,
+                               buffer_size=DecompressedReader.CHUNK_SIZE)
+    if not has_magic:
+        # Without magic bytes, only decompressing tells whether the file
+        # is compressed at all.
+        try:
+            stream.peek(1)
+        except OSError:
+            stream.close()
+            fileobj.seek(0)
+            return None
+    return stream
+
+
+class DecompressedReader(io.RawIOBase):
+    """ A raw stream of the decompressed contents of a compressed file.
+
+        fileobj:
+            The compressed file, at its start. It's not closed by close().
+
+        module:
+            The module whose open() function decompresses the file (gzip,
+            bz2 or lzma).
+
+        prefetch:
+            Decompress in a separate thread, ahead of the reader. The
+            decompressors release the GIL, so this overlaps decompression
+            with searching the contents decompressed so far. At most
+            PREFETCH_CHUNKS chunks are decompressed ahead, so the memory
+            used stays bounded.
+
+        Reading from the stream can raise OSError for corrupt files. The
+        only seek supported is back to the start, which starts over.
+    """
+    CHUNK_SIZE = 256 * 1024
+    PREFETCH_CHUNKS = 4
+
+    def __init__(self, fileobj, module, prefetch=False):
+        self._fileobj = fileobj
+        self._module = module
+        self._prefetch = prefetch
+        self._thread = None
+        self._start()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        if self._pos == len(self._chunk):
+            if self._eof:
+                return 0
+            self._chunk = self._next_chunk()
+            self._pos = 0
+            if not self._chunk:
+                self._eof = True
+                return 0
+        n = min(len(b), len(self._chunk) - self._pos)
+        b[:n] = self._chunk[self._pos:self._pos + n]
+        self._pos += n
+        self._offset += n
+        return n
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR and offset == 0:
+            return self._offset
+        if whence != io.SEEK_SET or offset != 0:
+            raise io.UnsupportedOperation(
+                'decompressed streams can only be rewound')
+        self._stop()
+        self._start()
+        return 0
+
+    def close(self):
+        if not self.closed:
+            self._stop()
+        super(DecompressedReader, self).close()
+
+    def _start(self):
+        """ Start decompressing from the start of the file.
+        """
+        self._fileobj.seek(0)
+        self._stream = self._module.open(self._fileobj, 'rb')
+        self._chunk = b''
+        self._pos = 0
+        self._offset = 0
+        self._eof = False
+        if self._prefetch:
+            self._chunks = queue.Queue(maxsize=self.PREFETCH_CHUNKS)
+            self._stopping = threading.Event()
+            self._thread = threading.Thread(target=self._decompress,
+                                            daemon=True)
+            self._thread.start()
+
+    def _stop(self):
+        """ Stop decompressing, and release the decompressor.
+        """
+        if self._thread is not None:
+            # The thread may be waiting for room in the queue: make room,
+            # so that it notices the event right away.
+            self._stopping.set()
+            try:
+                while True:
+                    self._chunks.get_nowait()
+            except queue.Empty:
+                pass
+            self._thread.join()
+            self._thread = None
+        self._stream.close()
+
+    def _next_chunk(self):
+        """ The next chunk of decompressed data, empty at the end.
+        """
+        if self._thread is None:
+            return self._read_chunk()
+        chunk = self._chunks.get()
+        if isinstance(chunk, _DecompressionError):
+            raise chunk.exc
+        return chunk
+
+    def _read_chunk(self):
+        try:
+            return self._stream.read(self.CHUNK_SIZE)
+        except _DECOMPRESSION_ERRORS as e:
+            raise OSError('cannot decompress: %s' % e)
+
+    def _decompress(self):
+        """ The prefetching thread: decompress chunks into the queue until
+            the end of the file, an error, or _stop.
+        """
+        while not self._stopping.is_set():
+            try:
+                chunk = self._read_chunk()
+            except BaseException as e:
+                chunk = _DecompressionError(e)
+            while not self._stopping.is_set():
+                try:
+                    self._chunks.put(chunk, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if not chunk or isinstance(chunk, _DecompressionError):
+                return
+
+
+class _DecompressionError(object):
+    """ Carries an exception raised in a prefetching thread to the reader.
+    """
+    def __init__(self, exc):
+        self.exc = exc
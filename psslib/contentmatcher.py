@@ -7,21 +7,45 @@
 # Eli Bendersky (eliben@gmail.com)
 # This code is in the public domain
 #-------------------------------------------------------------------------------
+import io
+import itertools
+import mmap
+import os
 import re
 import sys
+import time
 
-from .utils import tostring
 from .matchresult import MatchResult
+from . import regexinfo
 
 
 class ContentMatcher(object):
+    # Size of the chunks read by the buffer engine (see buffer_matcher)
+    BUFFER_CHUNK_SIZE = 1024 * 1024
+
+    # Files at least this big that are read as bytes (not as text, like with
+    # pss -U) are searched by the buffer and multiline engines through
+    # memory mappings instead of being read (see _mappable_size). The file
+    # is mapped in windows of MMAP_WINDOW_SIZE bytes, so that the pages of a
+    # huge file don't all stay mapped (and resident) until its search is
+    # done.
+    MMAP_THRESHOLD = 16 * 1024 * 1024
+    MMAP_WINDOW_SIZE = 64 * 1024 * 1024
+
+    # Reading a page of a mapping past the end of a file that was truncated
+    # after it was mapped kills the process with SIGBUS. Files modified less
+    # than MMAP_STABLE_SECONDS ago (logs being written, for example) are
+    # read instead of mapped.
+    MMAP_STABLE_SECONDS = 5
+
     def __init__(self,
                  pattern,
                  ignore_case=False,
                  invert_match=False,
                  whole_words=False,
                  literal_pattern=False,
-                 max_match_count=sys.maxsize):
+                 max_match_count=sys.maxsize,
+                 multiline=False):
         """ Create a new ContentMatcher for matching the pattern in files.
             The parameters are the "matching rules".
 
@@ -31,6 +55,9 @@ class ContentMatcher(object):
             pattern:
                 The pattern (regular expression) to match, as a string or bytes
                 object (should match the stream passed to the match method).
+                Can also be a list of patterns, to match lines that match any
+                of them. The matches are then tagged with the pattern that
+                fired (see MatchResult.matching_patterns).
 
             ignore_case:
                 If True, the pattern will ignore case when matching
@@ -49,29 +76,268 @@ class ContentMatcher(object):
 
             max_match_count:
                 Maximal amount of matches to report for a search
+
+            multiline:
+                Match the pattern against the whole contents of files, with
+                re.MULTILINE and re.DOTALL, so that matches can span several
+                lines (see multiline_matcher)
         """
-        self.regex = self._create_regex(pattern,
-                            ignore_case=ignore_case,
-                            whole_words=whole_words,
-                            literal_pattern=literal_pattern)
-        if invert_match:
-            self.match_file = self.inverted_matcher
+        if isinstance(pattern, (list, tuple)) and len(pattern) == 1:
+            pattern = pattern[0]
+        # When matching several patterns, what tells which of them a match
+        # is for: a map of the text of literal matches to their patterns, or
+        # the tag regex - the alternation of the patterns, each in a group
+        # named after its index - and the regexes of the patterns searched
+        # for apart from it (see _pattern_of_match).
+        self._pattern_of_text = None
+        self._tag_regex = None
+        self._tag_patterns = None
+        self._separate_regexes = []
+        # Number of the patterns searched for apart from the alternation of
+        # the others (see _create_multi_regex)
+        self._separate_patterns = 0
+        if isinstance(pattern, (list, tuple)):
+            self.regex = self._create_multi_regex(pattern,
+                                ignore_case=ignore_case,
+                                whole_words=whole_words,
+                                literal_pattern=literal_pattern,
+                                multiline=multiline)
         else:
-            self.match_file = self.matcher
+            self.regex = self._create_regex(pattern,
+                                ignore_case=ignore_case,
+                                whole_words=whole_words,
+                                literal_pattern=literal_pattern,
+                                multiline=multiline)
+        self._ignore_case = ignore_case
+        self._multiline = multiline
+        # When matches can't extend beyond a line, the pattern is run over
+        # big buffers of lines instead of line by line (see buffer_matcher).
+        # The buffer regex needs re.MULTILINE for ^ and $ to match at the
+        # edges of each line.
+        # A _RegexSet is analyzed regex by regex.
+        regexes = (self.regex.regexes if isinstance(self.regex, _RegexSet)
+                   else [self.regex])
+        parsed = [regexinfo.parse(regex.pattern, regex.flags)
+                  for regex in regexes]
+        analyzed = all(p is not None for p in parsed)
+        self._buffer_regex = None
+        if (    not multiline and analyzed and
+                all(regexinfo.is_line_local(p) for p in parsed)):
+            buffer_regexes = [re.compile(regex.pattern, regex.flags | re.M)
+                              for regex in regexes]
+            self._buffer_regex = (
+                _RegexSet(buffer_regexes) if len(buffer_regexes) > 1
+                else buffer_regexes[0])
+        self._invert_match = invert_match
         self.max_match_count = max_match_count
 
+        # Files in UTF-16 and UTF-32 are decoded, and the pattern is matched
+        # in their text by a str twin of this matcher (see
+        # match_encoded_file).
+        self._pattern = pattern
+        self._options = dict(ignore_case=ignore_case,
+                             invert_match=invert_match,
+                             whole_words=whole_words,
+                             literal_pattern=literal_pattern,
+                             max_match_count=max_match_count,
+                             multiline=multiline)
+        self._text_matcher = None
+
         # Cache frequently used attributes for faster access
         self._finditer = self.regex.finditer
         self._search = self.regex.search
 
-        # Optimize a common case: searching for a simple non-regex string.
-        # In this case, we don't need regex matching - using str.find is
-        # faster.
+        # Optimize a common case: searching for a literal string (a plain
+        # pattern, or any -Q pattern). In this case, we don't need regex
+        # matching - using str.find is faster. With ignore_case, the
+        # lowercased literal is found in lowercased text, and with
+        # whole_words the characters around each occurrence are checked
+        # like \b would.
         self._findstr = None
-        if (    not ignore_case and not whole_words and
-                self._pattern_is_simple(pattern)):
-            self._findstr = pattern
-            self._findstrlen = len(self._findstr)
+        if not multiline and not isinstance(pattern, (list, tuple)):
+            literal = self._literal_of_pattern(pattern, literal_pattern)
+            # Unicode case folding can't be emulated with lower(), so for
+            # str only ASCII literals are found case insensitively.
+            if literal and (not ignore_case or isinstance(literal, bytes) or
+                            literal.isascii()):
+                self._findstr = literal.lower() if ignore_case else literal
+                self._findstrlen = len(self._findstr)
+                self._fold_case = ignore_case
+                self._whole_words = whole_words
+                isword = (_is_word_str if isinstance(literal, str)
+                          else _is_word_byte)
+                self._starts_with_word = isword(self._findstr[0])
+                self._ends_with_word = isword(self._findstr[-1])
+
+        # For other patterns, look for literals that every match contains.
+        # Searching for them is much faster than running the regex, and
+        # lines (or whole buffers) that have none of them can't match.
+        # For case sensitive whole words, the buffer engine uses these
+        # literals as well: they lead it to the same lines as the literal
+        # engine, where re checks word boundaries faster than Python can.
+        # Every match of a _RegexSet contains one of the literals of some
+        # regex in it, when they all have literals.
+        self._required = None
+        if (    analyzed and
+                (not self._findstr or (whole_words and not ignore_case))):
+            literals = set()
+            for p in parsed:
+                regex_literals = regexinfo.required_literals(p)
+                if not regex_literals:
+                    literals = None
+                    break
+                literals.update(regex_literals)
+            # Single characters are too common to be worth screening for
+            if literals and min(map(len, literals)) >= 2:
+                if isinstance(regexes[0].pattern, bytes):
+                    literals = [lit.encode('latin-1') for lit in literals]
+                self._required = tuple(sorted(literals))
+
+        self._select_engine(analyzed, pattern)
+
+    def _select_engine(self, analyzed, pattern):
+        """ Choose the engine that searches files for the pattern, weighing
+            what is known about the pattern, and set match_file to it. The
+            name of the engine and the reasons for choosing it are kept in
+            engine and engine_reasons (see explain).
+
+            Line engines go over files line by line. Buffer engines search
+            big buffers of lines at once (big binary files through memory
+            mappings), which is only possible when matches don't extend
+            beyond a line. Matches are found with str.find for literal
+            patterns, with the regex only on the lines that contain a
+            literal the pattern requires, or with the regex everywhere.
+        """
+        reasons = []
+        if isinstance(pattern, (list, tuple)):
+            if self._pattern_of_text is not None:
+                reasons.append('the %d patterns are literal strings, matched '
+                               'by a single trie-shaped regex' % len(pattern))
+            elif self._separate_patterns == len(pattern):
+                reasons.append('the %d patterns set flags inline or have '
+                               'groups, so they are searched for separately'
+                               % len(pattern))
+            elif self._separate_patterns:
+                reasons.append('%d of the %d patterns set flags inline or '
+                               'have groups, so they are searched for '
+                               'apart from the alternation of the others' %
+                               (self._separate_patterns, len(pattern)))
+            else:
+                reasons.append('the %d patterns are matched by an '
+                               'alternation of them' % len(pattern))
+        if not analyzed:
+            reasons.append("the regex can't be analyzed, so it's run as is")
+
+        # Files are only mapped into memory when they're read as bytes, and
+        # only plain files can be (see _mappable_size).
+        mappable = isinstance(
+            pattern[0] if isinstance(pattern, (list, tuple)) else pattern,
+            bytes)
+        unmappable = (' (not compressed files, archive members, or files '
+                      'in UTF-16 or UTF-32)')
+        unstable = ('files modified in the last %d seconds are read '
+                    'instead, since a mapped file that is truncated while '
+                    "it's searched makes pss crash with SIGBUS" %
+                    self.MMAP_STABLE_SECONDS)
+
+        if self._multiline:
+            layout = 'file'
+            reasons.append('matches may span lines, so the regex runs over '
+                           'the whole contents of each file, with '
+                           're.MULTILINE and re.DOTALL')
+            if mappable:
+                reasons.append('files of %d MB or more are mapped into '
+                               'memory instead of being read%s' %
+                               (self.MMAP_THRESHOLD // (1024 * 1024),
+                                unmappable))
+                reasons.append(unstable)
+        elif self._buffer_regex is not None:
+            layout = 'buffer'
+            reasons.append("matches can't extend beyond a line, so buffers "
+                           "of %d MB of lines are searched at once" %
+                           (self.BUFFER_CHUNK_SIZE // (1024 * 1024)))
+            if mappable:
+                reasons.append('files of %d MB or more are searched through '
+                               'memory mappings, %d MB at a time%s' %
+                               (self.MMAP_THRESHOLD // (1024 * 1024),
+                                self.MMAP_WINDOW_SIZE // (1024 * 1024),
+                                unmappable))
+                reasons.append(unstable)
+        else:
+            layout = 'line'
+            if analyzed:
+                reasons.append('matches may extend beyond a line, so files '
+                               'are searched line by line')
+
+        self._find_spans = None
+        if self._multiline:
+            strategy = ('multiline-inverted' if self._invert_match
+                        else 'multiline')
+            self.match_file = self.multiline_matcher
+            if self._required:
+                reasons.append('files that contain none of the literals the '
+                               'regex requires are not searched: %s' %
+                               _literals_text(self._required))
+        elif self._invert_match:
+            strategy = 'inverted'
+            if layout == 'buffer':
+                self.match_file = self.buffer_matcher
+                reasons.append('lines are only searched one by one in the '
+                               'blocks of lines that have matches')
+            else:
+                self.match_file = self.inverted_matcher
+                if self._required:
+                    reasons.append('lines that contain none of the literals '
+                                   'the regex requires are not searched: %s'
+                                   % _literals_text(self._required))
+        elif self._findstr and (layout == 'line' or not self._required):
+            strategy = 'literal'
+            self.match_file = (self.buffer_matcher if layout == 'buffer'
+                               else self.matcher)
+            self._find_spans = self._literal_spans
+            how = 'the pattern is a literal string, found with str.find'
+            if self._fold_case:
+                how += (' in lowercased text (where it has non-ASCII '
+                        'characters, and in memory mappings, the regex '
+                        'is run instead)')
+            if self._whole_words:
+                how += ', checking the characters around it for word edges'
+            reasons.append(how)
+        elif self._required:
+            strategy = 'screened-regex'
+            self.match_file = (self.buffer_matcher if layout == 'buffer'
+                               else self.matcher)
+            self._find_spans = self._screened_spans
+            if self._findstr:
+                reasons.append('the pattern is a literal string, but re '
+                               'checks the edges of whole words faster')
+            reasons.append('the regex only runs on lines that contain one '
+                           'of the literals it requires: %s' %
+                           _literals_text(self._required))
+        else:
+            strategy = 'regex'
+            self.match_file = (self.buffer_matcher if layout == 'buffer'
+                               else self.matcher)
+            self._find_spans = self._regex_spans
+            if analyzed:
+                reasons.append('the pattern requires no literal long enough '
+                               'to screen lines with, so the regex is run '
+                               'everywhere')
+
+        if not self._invert_match and isinstance(pattern, (list, tuple)):
+            self._untagged_match_file = self.match_file
+            self.match_file = self.tagged_matcher
+            reasons.append('each match is tagged with the pattern that '
+                           'fired')
+        self.engine = '%s-%s' % (layout, strategy)
+        self.engine_reasons = reasons
+
+    def explain(self):
+        """ Describe the engine chosen for the search, and why, as a list of
+            lines of text.
+        """
+        return (['engine: %s' % self.engine] +
+                ['  - %s' % reason for reason in self.engine_reasons])
 
     def matcher(self, fileobj, max_match_count=sys.maxsize):
         """ Perform matching in the file according to the matching rules. Yield
@@ -85,18 +351,28 @@ class ContentMatcher(object):
         for lineno, line in enumerate(fileobj, 1):
             # Iterate over all matches of the pattern in the line,
             # noting each matching column range.
+            hay = None
             if self._findstr:
+                hay = (self._literal_haystack(line) if self._fold_case
+                       else line)
+            if hay is not None:
                 # Make the common case faster: there's no match in this line, so
                 # bail out ASAP.
-                i = line.find(self._findstr, 0)
+                i = hay.find(self._findstr, 0)
                 if i == -1:
                     continue
-                col_ranges = []
-                while i >= 0:
-                    startnext = i + self._findstrlen
-                    col_ranges.append((i, startnext))
-                    i = line.find(self._findstr, startnext)
+                if self._fold_case or self._whole_words:
+                    col_ranges = list(
+                        self._find_literal(line, hay, 0, len(line)))
+                else:
+                    col_ranges = []
+                    while i >= 0:
+                        startnext = i + self._findstrlen
+                        col_ranges.append((i, startnext))
+                        i = line.find(self._findstr, startnext)
             else:
+                if self._required and not self._has_required(line):
+                    continue
                 col_ranges = [mo.span() for mo in self._finditer(line) if mo]
             if col_ranges:
                 yield MatchResult(line, lineno, col_ranges)
@@ -104,6 +380,313 @@ class ContentMatcher(object):
                 if nmatch >= max_match_count:
                     break
 
+    def buffer_matcher(self, fileobj, max_match_count=sys.maxsize):
+        """ Same as matcher, but instead of going over the file line by
+            line, the pattern is searched in chunks of whole lines. Line
+            boundaries and numbers are only computed for the lines that
+            have matches. Only usable for patterns whose matches don't
+            extend beyond a line.
+
+            With invert_match, the lines without matches are generated
+            instead (like inverted_matcher). The buffers are split into
+            lines all at once, and lines are only searched one by one in
+            the parts of the buffers that have matches.
+
+            Big files read as bytes are mapped into memory and searched in
+            place: only the matching lines are copied out of the mappings.
+        """
+        max_match_count = min(max_match_count, self.max_match_count)
+        nmatch = 0
+
+        size = self._mappable_size(fileobj)
+        if size is not None:
+            for result in self._match_mapped(fileobj.fileno(), size):
+                yield result
+                nmatch += 1
+                if nmatch >= max_match_count:
+                    return
+            return
+
+        lineno = 1
+        pending = None
+        while True:
+            chunk = fileobj.read(self.BUFFER_CHUNK_SIZE)
+            if chunk:
+                if pending:
+                    chunk = pending + chunk
+                newline = '\n' if isinstance(chunk, str) else b'\n'
+                # Only whole lines are searched; a partial last line waits
+                # for the next chunk.
+                end = chunk.rfind(newline) + 1
+                if end == 0:
+                    pending = chunk
+                    continue
+                buf, pending = chunk[:end], chunk[end:]
+            elif pending:
+                # The last line of the file, with no newline at its end
+                buf, pending = pending, None
+            else:
+                break
+
+            for result in self._match_buffer(buf, lineno, newline):
+                yield result
+                nmatch += 1
+                if nmatch >= max_match_count:
+                    return
+            lineno += buf.count(newline)
+
+    def _match_buffer(self, buf, first_lineno, newline, start=0, end=None):
+        """ Return an iterator of the MatchResults for the lines in
+            buf[start:end] (which starts at line number first_lineno, and
+            holds whole lines). With invert_match, these are the lines
+            without matches.
+        """
+        if end is None:
+            end = len(buf)
+        if self._invert_match:
+            return self._unmatched_lines(buf, first_lineno, newline,
+                                         start, end)
+        spans = self._find_spans(buf, newline, start, end)
+        return self._matched_lines(buf, spans, first_lineno, newline,
+                                   start, end)
+
+    def _literal_spans(self, buf, newline, start, end):
+        """ Return an iterator of the spans of the occurrences of the literal
+            pattern in buf[start:end]. Where the literal can't be found
+            like the regex would match it, the regex is run.
+        """
+        hay = self._literal_haystack(buf)
+        if hay is None:
+            return self._regex_spans(buf, newline, start, end)
+        return self._find_literal(buf, hay, start, end)
+
+    def _regex_spans(self, buf, newline, start, end):
+        """ Return an iterator of the spans of the matches of the buffer
+            regex in buf[start:end].
+        """
+        return (mo.span()
+                for mo in self._buffer_regex.finditer(buf, start, end))
+
+    def _matched_lines(self, buf, spans, first_lineno, newline, start, end):
+        """ Generate the MatchResults for the lines of buf[start:end] that
+            have the matches with the given spans.
+        """
+        lineno = first_lineno
+        # Position up to which newlines were counted into lineno
+        counted = start
+        line_start = line_end = start
+        col_ranges = None
+        for match_start, match_end in spans:
+            if match_start >= line_end:
+                # The first match in a new line
+                if col_ranges:
+                    yield MatchResult(buf[line_start:line_end], lineno,
+                                      col_ranges)
+                lineno += _count(buf, newline, counted, match_start)
+                counted = match_start
+                line_start = buf.rfind(newline, 0, match_start) + 1
+                line_end = buf.find(newline, match_start, end) + 1 or end
+                col_ranges = []
+            col_ranges.append((match_start - line_start,
+                               match_end - line_start))
+        if col_ranges:
+            yield MatchResult(buf[line_start:line_end], lineno, col_ranges)
+
+    def _unmatched_lines(self, buf, first_lineno, newline, start, end):
+        """ Generate the MatchResults for the lines of buf[start:end] that
+            have no matches. The lines are split off in big blocks, and only
+            the lines of blocks that have matches are searched one by one.
+        """
+        block_search = self._buffer_regex.search
+        search = self._search
+        lineno = first_lineno
+        for block in _line_blocks(buf, start, end, newline):
+            lines = _split_lines(block, newline)
+            if not block_search(block):
+                for line in lines:
+                    yield MatchResult(line, lineno, [])
+                    lineno += 1
+                continue
+            for line in lines:
+                if not search(line):
+                    yield MatchResult(line, lineno, [])
+                lineno += 1
+
+    def _match_mapped(self, fd, size):
+        """ Generate the MatchResults for the file with descriptor fd and the
+            given size, mapping it into memory one window at a time. Each
+            window is searched up to its last whole line; the next window
+            starts at the line following it.
+        """
+        granularity = mmap.ALLOCATIONGRANULARITY
+        lineno = 1
+        # Offset in the file of the first line not searched yet
+        offset = 0
+        window_size = self.MMAP_WINDOW_SIZE
+        while offset < size:
+            # The file may have shrunk since it was opened: don't map pages
+            # that are gone.
+            try:
+                size = min(size, os.fstat(fd).st_size)
+            except OSError:
+                return
+            if offset >= size:
+                return
+            # Mappings have to start at a multiple of the granularity
+            map_offset = offset - offset % granularity
+            length = min(window_size, size - map_offset)
+            with mmap.mmap(fd, length, offset=map_offset,
+                           access=mmap.ACCESS_READ) as window:
+                start = offset - map_offset
+                if map_offset + length == size:
+                    end = length
+                else:
+                    end = window.rfind(b'\n', start) + 1
+                    if end == 0:
+                        # A line longer than the window: retry with a
+                        # window big enough to hold it.
+                        window_size *= 2
+                        continue
+                if hasattr(window, 'madvise'):
+                    window.madvise(mmap.MADV_SEQUENTIAL)
+                for result in self._match_buffer(window, lineno, b'\n',
+                                                 start, end):
+                    yield result
+                lineno += _count(window, b'\n', start, end)
+            offset = map_offset + end
+            window_size = self.MMAP_WINDOW_SIZE
+
+    def _mappable_size(self, fileobj):
+        """ If fileobj is a big enough plain file read as bytes, at its
+            start, that can be searched through memory mappings, return its
+            size. Otherwise return None. Files modified recently aren't
+            mapped (see MMAP_STABLE_SECONDS).
+        """
+        if isinstance(fileobj, io.TextIOBase):
+            return None
+        # Only plain files can be mapped: the file descriptor of a stream
+        # that decompresses a file is that of the compressed file.
+        if not isinstance(getattr(fileobj, 'raw', fileobj), io.FileIO):
+            return None
+        try:
+            st = os.fstat(fileobj.fileno())
+            size = st.st_size
+            if size < self.MMAP_THRESHOLD or fileobj.tell() != 0:
+                return None
+            if time.time() - st.st_mtime < self.MMAP_STABLE_SECONDS:
+                return None
+            # Make sure the file can be mapped at all (it can't be, for
+            # example, if it's a pipe or a device)
+            mmap.mmap(fileobj.fileno(), 1, access=mmap.ACCESS_READ).close()
+        except (AttributeError, OSError, ValueError):
+            return None
+        return size
+
+    def _literal_haystack(self, buf):
+        """ The text in which to find the literal pattern of buf: buf itself,
+            or a lowercased copy of it for case insensitive searches. None
+            when the literal can't be found like the regex would: str text
+            with non-ASCII characters can have case folds that lower()
+            doesn't reproduce, and lowering a memory mapping would copy it.
+        """
+        if not self._fold_case:
+            return buf
+        if isinstance(buf, str):
+            return buf.lower() if buf.isascii() else None
+        if isinstance(buf, mmap.mmap):
+            return None
+        return buf.lower()
+
+    def _find_literal(self, buf, hay, start, end):
+        """ Generate the spans of the non-overlapping occurrences of the
+            literal pattern in buf[start:end] that the regex would match.
+            They are found in hay (see _literal_haystack).
+        """
+        find = hay.find
+        findstr = self._findstr
+        findstrlen = self._findstrlen
+        if self._whole_words:
+            # Like \b, check that the characters on both sides of an
+            # occurrence differ from its edges in being word characters.
+            isword = _is_word_str if isinstance(buf, str) else _is_word_byte
+            starts_with_word = self._starts_with_word
+            ends_with_word = self._ends_with_word
+        i = find(findstr, start, end)
+        while i >= 0:
+            j = i + findstrlen
+            if self._whole_words and (
+                    (i > 0 and isword(buf[i - 1])) == starts_with_word or
+                    (j < end and isword(buf[j])) == ends_with_word):
+                i = find(findstr, i + 1, end)
+                continue
+            yield i, j
+            i = find(findstr, j, end)
+
+    def tagged_matcher(self, fileobj, max_match_count=sys.maxsize):
+        """ Perform matching with several patterns, tagging each match with
+            the pattern that fired. Yield MatchResult objects.
+        """
+        for result in self._untagged_match_file(fileobj, max_match_count):
+            line = result.matching_line
+            yield result._replace(matching_patterns=[
+                self._pattern_of_match(line, start, end)
+                for start, end in result.matching_column_ranges])
+
+    def _pattern_of_match(self, line, start, end):
+        """ The pattern that matched line[start:end], when matching several
+            patterns.
+        """
+        if self._pattern_of_text is not None:
+            text = line[start:end]
+            if self._ignore_case:
+                text = text.lower()
+            return self._pattern_of_text.get(text)
+        # The group of the alternative that the alternation picked at start
+        # names the pattern.
+        if self._tag_regex is not None:
+            m = self._tag_regex.match(line, start)
+            if m is not None:
+                return self._tag_patterns[m.lastgroup]
+        # A _RegexSet only takes a match of the other regexes when the
+        # alternation (its first regex) has none at the same position, and
+        # then the match of the first of them.
+        for pattern, regex in self._separate_regexes:
+            if regex.match(line, start):
+                return pattern
+        return None
+
+    def _has_required(self, line):
+        """ Does the line contain any of the required literals?
+        """
+        for literal in self._required:
+            if literal in line:
+                return True
+        return False
+
+    def _screened_spans(self, buf, newline, start, end):
+        """ Generate the spans of the matches of the buffer regex in
+            buf[start:end], running it only on the lines that contain a
+            required literal.
+        """
+        finditer = self._buffer_regex.finditer
+        literals = self._required
+        # The next position of each literal; -1 when it's not found anymore
+        found = [buf.find(literal, start, end) for literal in literals]
+        pos = start
+        while True:
+            for k, i in enumerate(found):
+                if 0 <= i < pos:
+                    found[k] = buf.find(literals[k], pos, end)
+            i = min((i for i in found if i >= 0), default=-1)
+            if i < 0:
+                return
+            # pos is always at the start of a line
+            line_start = buf.rfind(newline, pos, i) + 1 or pos
+            line_end = buf.find(newline, i, end) + 1 or end
+            for mo in finditer(buf, line_start, line_end):
+                yield mo.span()
+            pos = line_end
+
     def inverted_matcher(self, fileobj, max_match_count=sys.maxsize):
         """ Perform inverted matching in the file according to the matching
             rules. Yield MatchResult objects.
@@ -116,23 +699,168 @@ class ContentMatcher(object):
         for lineno, line in enumerate(fileobj, 1):
             # Invert match: only return lines that don't match the
             # pattern anywhere
-            if not self._search(line):
+            if ((   self._required and not self._has_required(line)) or
+                    not self._search(line)):
                 yield MatchResult(line, lineno, [])
                 nmatch += 1
                 if nmatch >= max_match_count:
                     break
 
-    def _pattern_is_simple(self, pattern):
-        """ A "simple" pattern that can be matched with str.find and doesn't
-            require a regex engine.
+    def multiline_matcher(self, fileobj, max_match_count=sys.maxsize):
+        """ Perform matching over the whole contents of the file, so that
+            matches can span several lines. Yield MatchResult objects: the
+            lines that a match spans are reported in a single result (see
+            MatchResult), together with the other matches that share any
+            of these lines.
+
+            With invert_match, the lines that no match touches are
+            generated instead, one by one.
+
+            fileobj is a file-like object, being read from the beginning.
+            max_match_count: can be set for each file individually.
         """
-        return bool(re.match(r'[\w_]+$', tostring(pattern)))
+        max_match_count = min(max_match_count, self.max_match_count)
+        size = self._mappable_size(fileobj)
+        if size is not None:
+            with mmap.mmap(fileobj.fileno(), size,
+                           access=mmap.ACCESS_READ) as buf:
+                for result in self._match_whole(buf, max_match_count):
+                    yield result
+        else:
+            for result in self._match_whole(fileobj.read(), max_match_count):
+                yield result
+
+    def _match_whole(self, buf, max_match_count):
+        """ Generate the MatchResults of multiline_matcher for buf, the
+            whole contents of a file.
+        """
+        newline = '\n' if isinstance(buf, str) else b'\n'
+        if self._required and not any(buf.find(literal) >= 0
+                                       for literal in self._required):
+            if not self._invert_match:
+                return
+            blocks = []
+        else:
+            blocks = self._matched_blocks(buf, newline)
+        nmatch = 0
+        if not self._invert_match:
+            for block_start, block_end, lineno, col_ranges in blocks:
+                yield MatchResult(buf[block_start:block_end], lineno,
+                                  col_ranges)
+                nmatch += 1
+                if nmatch >= max_match_count:
+                    return
+            return
+
+        # The lines between the blocks of matched lines
+        lineno = 1
+        pos = 0
+        for block_start, block_end, block_lineno, _ in itertools.chain(
+                blocks, [(len(buf), len(buf), None, None)]):
+            for block in _line_blocks(buf, pos, block_start, newline):
+                for line in _split_lines(block, newline):
+                    yield MatchResult(line, lineno, [])
+                    lineno += 1
+                    nmatch += 1
+                    if nmatch >= max_match_count:
+                        return
+            if block_lineno is not None:
+                lineno = block_lineno + _count(buf, newline, block_start,
+                                               block_end)
+            pos = block_end
+
+    def _matched_blocks(self, buf, newline):
+        """ Generate the blocks of whole lines of buf that matches span, as
+            tuples (block_start, block_end, lineno, col_ranges): the
+            positions of the block in buf, the number of its first line,
+            and the column ranges of its matches, counted from block_start.
+            Matches that share lines are in the same block.
+        """
+        size = len(buf)
+        lineno = 1
+        # Position up to which newlines were counted into lineno
+        counted = 0
+        block_start = block_end = block_lineno = 0
+        col_ranges = None
+        for mo in self._finditer(buf):
+            match_start, match_end = mo.span()
+            if match_start == size and (
+                    size == 0 or buf[size - 1:size] == newline):
+                # An empty match past the last line
+                break
+            if col_ranges is None or match_start >= block_end:
+                if col_ranges is not None:
+                    yield block_start, block_end, block_lineno, col_ranges
+                lineno += _count(buf, newline, counted, match_start)
+                counted = match_start
+                block_start = buf.rfind(newline, 0, match_start) + 1
+                block_lineno = lineno
+                col_ranges = []
+            # The newline that ends a match belongs to its last line
+            last = match_end - 1 if match_end > match_start else match_start
+            block_end = max(block_end, buf.find(newline, last) + 1 or size)
+            col_ranges.append((match_start - block_start,
+                               match_end - block_start))
+        if col_ranges is not None:
+            yield block_start, block_end, block_lineno, col_ranges
+
+    def match_encoded_file(self, fileobj, encoding,
+                           max_match_count=sys.maxsize):
+        """ Same as match_file, for a binary file of text in UTF-16 or
+            UTF-32, starting with a byte order mark (encoding is the
+            encoding of the text after it, see utils.bom_encoding). The
+            results are those of the text in UTF-8: the lines are UTF-8
+            (without the mark), and column ranges count UTF-8 bytes.
+
+            The file is decoded as it's read, and the text is matched by a
+            str twin of this matcher - so \\w, \\b and ignore_case follow
+            Unicode in it. The engines read text in chunks like bytes, so
+            files aren't decoded as a whole (except in multiline matching,
+            which reads whole files anyway).
+        """
+        fileobj.read(len('\ufeff'.encode(encoding)))
+        textobj = io.TextIOWrapper(fileobj, encoding=encoding,
+                                   errors='replace', newline='\n')
+        try:
+            for result in self._get_text_matcher().match_file(
+                    textobj, min(max_match_count, self.max_match_count)):
+                yield _utf8_result(result)
+        finally:
+            # Leave fileobj open for the caller
+            textobj.detach()
+
+    def _get_text_matcher(self):
+        """ The matcher of the pattern in decoded text: a str twin of this
+            one, created when it's first needed.
+        """
+        if self._text_matcher is None:
+            if isinstance(self._pattern, (list, tuple)):
+                pattern = [_text_of_pattern(p) for p in self._pattern]
+            else:
+                pattern = _text_of_pattern(self._pattern)
+            if pattern == self._pattern:
+                self._text_matcher = self
+            else:
+                self._text_matcher = ContentMatcher(pattern, **self._options)
+        return self._text_matcher
+
+    def _literal_of_pattern(self, pattern, literal_pattern):
+        """ The string that pattern matches literally, or None if it's a
+            real regex.
+        """
+        if literal_pattern:
+            return pattern
+        literal = regexinfo.literal_text(regexinfo.parse(pattern))
+        if literal is not None and isinstance(pattern, bytes):
+            literal = literal.encode('latin-1')
+        return literal
 
     def _create_regex(self,
             pattern,
             ignore_case=False,
             whole_words=False,
-            literal_pattern=False):
+            literal_pattern=False,
+            multiline=False):
         """ Utility for creating the compiled regex from pattern and options.
         """
         if literal_pattern:
@@ -140,9 +868,265 @@ class ContentMatcher(object):
         if whole_words:
             b = r'\b' if isinstance(pattern, str) else br'\b'
             pattern = b + pattern + b
-        regex = re.compile(pattern, re.I if ignore_case else 0)
+        regex = re.compile(pattern, _regex_flags(ignore_case, multiline))
         return regex
 
+    def _create_multi_regex(self,
+            patterns,
+            ignore_case=False,
+            whole_words=False,
+            literal_pattern=False,
+            multiline=False):
+        """ Create a compiled regex matching any of the patterns.
+
+            When all the patterns are literal strings, the regex is shaped as
+            a trie (see _literal_trie), which re runs much faster than an
+            alternation of thousands of strings. Otherwise it's an
+            alternation of the patterns - except for patterns that change
+            their meaning in an alternation (see
+            regexinfo.is_self_contained). These are compiled on their own,
+            and searched for together with the alternation in a _RegexSet.
+        """
+        empty = patterns[0][:0]
+        flags = _regex_flags(ignore_case, multiline)
+        literals = []
+        for pattern in patterns:
+            literal = self._literal_of_pattern(pattern, literal_pattern)
+            if literal is None:
+                break
+            literals.append(literal)
+        else:
+            self._pattern_of_text = {}
+            for literal, pattern in zip(literals, patterns):
+                key = literal.lower() if ignore_case else literal
+                self._pattern_of_text.setdefault(key, pattern)
+            # re.I makes the case of the literals irrelevant; lowercasing
+            # them lets the trie share prefixes that differ only in case.
+            alternation = _literal_trie(
+                [literal.lower() for literal in literals] if ignore_case
+                else literals)
+            if whole_words:
+                alternation = _bytes_like(empty, r'\b(?:%s)\b') % alternation
+            return re.compile(alternation, flags)
+
+        joined = []
+        self._tag_patterns = {}
+        for i, pattern in enumerate(patterns):
+            regex = self._create_regex(pattern, ignore_case=ignore_case,
+                                       whole_words=whole_words,
+                                       multiline=multiline)
+            if regexinfo.is_self_contained(regex.pattern, flags):
+                joined.append((i, regex))
+                self._tag_patterns['p%d' % i] = pattern
+            else:
+                self._separate_regexes.append((pattern, regex))
+        self._separate_patterns = len(self._separate_regexes)
+        separate = [regex for _, regex in self._separate_regexes]
+        if joined:
+            alternation = _bytes_like(empty, '|').join(
+                _bytes_like(empty, '(?:%s)') % regex.pattern
+                for _, regex in joined)
+            # Self-contained patterns have no groups of their own, so the
+            # named groups are the only ones.
+            self._tag_regex = re.compile(_bytes_like(empty, '|').join(
+                _bytes_like(empty, '(?P<p%d>%s)') % (i, regex.pattern)
+                for i, regex in joined), flags)
+            regex = re.compile(alternation, flags)
+            if not separate:
+                return regex
+            separate.insert(0, regex)
+        return _RegexSet(separate)
+
+
+class _RegexSet(object):
+    """ Compiled regexes searched for together, as if they were the
+        alternatives of a single regex: a search finds the leftmost match
+        of any of them, and of those starting at the same position the
+        match of the first regex. Supports the search and finditer methods
+        of compiled regexes.
+    """
+    def __init__(self, regexes):
+        self.regexes = regexes
+
+    def search(self, string, pos=0, endpos=sys.maxsize):
+        return next(self.finditer(string, pos, endpos), None)
+
+    def finditer(self, string, pos=0, endpos=sys.maxsize):
+        endpos = min(endpos, len(string))
+        # The next match of each regex, or False when it has no more matches.
+        # A match that starts before pos is stale and searched for again.
+        found = [None] * len(self.regexes)
+        while pos <= endpos:
+            best = None
+            for k, regex in enumerate(self.regexes):
+                mo = found[k]
+                if mo is None or (mo is not False and mo.start() < pos):
+                    mo = found[k] = regex.search(string, pos, endpos) or False
+                if mo is not False and (best is None or
+                                        mo.start() < best.start()):
+                    best = mo
+            if best is None:
+                return
+            yield best
+            # Go on past an empty match, so it isn't found again
+            pos = best.end() + (best.end() == best.start())
+
+
+def _regex_flags(ignore_case, multiline):
+    """ The re flags for compiling patterns with the given options.
+    """
+    flags = re.I if ignore_case else 0
+    if multiline:
+        flags |= re.M | re.S
+    return flags
+
+
+# Number of characters of a buffer split into lines at a time, for inverted
+# matching
+_SPLIT_BLOCK_SIZE = 1024 * 1024
+
+
+def _line_blocks(buf, start, end, newline):
+    """ Generate the text of buf[start:end] in blocks of whole lines (only
+        the last line may have no newline).
+    """
+    while start < end:
+        block_end = start + _SPLIT_BLOCK_SIZE
+        if block_end < end:
+            block_end = (buf.rfind(newline, start, block_end) + 1 or
+                         buf.find(newline, block_end, end) + 1 or end)
+        else:
+            block_end = end
+        yield buf[start:block_end]
+        start = block_end
+
+
+def _split_lines(text, newline):
+    """ The lines of text, with their newlines. The last line may have no
+        newline.
+    """
+    if isinstance(text, bytes) and b'\r' not in text:
+        # The same as splitting at newlines when there are no other line
+        # breaks, and faster.
+        return text.splitlines(True)
+    lines = text.split(newline)
+    last = lines.pop()
+    lines = [line + newline for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def _text_of_pattern(pattern):
+    """ The pattern as str; bytes patterns are UTF-8.
+    """
+    if isinstance(pattern, bytes):
+        return pattern.decode('utf-8', 'surrogateescape')
+    return pattern
+
+
+def _utf8_result(result):
+    """ The MatchResult for text (see ContentMatcher.match_encoded_file) as
+        a result for bytes: its line in UTF-8, with the column ranges moved
+        to the UTF-8 bytes, and its patterns as UTF-8 bytes.
+    """
+    line = result.matching_line
+    col_ranges = result.matching_column_ranges
+    if not line.isascii():
+        def offset(i):
+            return len(line[:i].encode('utf-8'))
+        col_ranges = [(offset(start), offset(end))
+                      for start, end in col_ranges]
+    patterns = result.matching_patterns
+    if patterns is not None:
+        patterns = [None if p is None
+                    else p.encode('utf-8', 'surrogateescape')
+                    for p in patterns]
+    return MatchResult(line.encode('utf-8'), result.matching_lineno,
+                       col_ranges, patterns)
+
+
+def _literals_text(literals):
+    """ The literals (str or bytes) as text, for explaining the engines.
+    """
+    return ', '.join(repr(literal) if isinstance(literal, str)
+                     else repr(literal.decode('latin-1'))
+                     for literal in literals)
+
+
+def _is_word_str(c):
+    """ Does \\w match the character c?
+    """
+    return c.isalnum() or c == '_'
+
+
+# Does \w match the byte (an int)?
+_is_word_byte = frozenset(
+    b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_'
+    ).__contains__
+
+
+def _literal_trie(literals):
+    """ Create the source of a regex matching any of the literals (all str or
+        all bytes), shaped as a trie: literals with a common prefix share it,
+        so re checks each prefix once instead of trying every literal at
+        every position. Where a literal is a prefix of another, the longer
+        one is preferred.
+    """
+    empty = literals[0][:0]
+    # Each trie node maps the next characters to child nodes; the None key
+    # marks the end of a literal.
+    trie = {}
+    for literal in literals:
+        node = trie
+        for i in range(len(literal)):
+            node = node.setdefault(literal[i:i + 1], {})
+        node[None] = None
+
+    def build(node):
+        alternatives = []
+        for key in sorted(k for k in node if k is not None):
+            prefix = key
+            child = node[key]
+            # Chains of nodes without alternatives become plain strings
+            while len(child) == 1 and None not in child:
+                (key, child), = child.items()
+                prefix += key
+            alternatives.append(re.escape(prefix) + build(child))
+        if not alternatives:
+            return empty
+        source = _bytes_like(empty, '|').join(alternatives)
+        if None in node:
+            return _bytes_like(empty, '(?:%s)?') % source
+        elif len(alternatives) > 1:
+            return _bytes_like(empty, '(?:%s)') % source
+        return source
+
+    return build(trie)
+
+
+def _bytes_like(obj, s):
+    """ The str s, as bytes if obj is bytes.
+    """
+    return s.encode('ascii') if isinstance(obj, bytes) else s
+
+
+# Number of bytes of a memory mapping that are copied at a time for counting
+# newlines in it (mmap objects have no count method).
+_COUNT_BLOCK_SIZE = 1024 * 1024
+
+
+def _count(buf, sub, start, end):
+    """ buf.count(sub, start, end), also for mmap objects.
+    """
+    if not isinstance(buf, mmap.mmap):
+        return buf.count(sub, start, end)
+    n = 0
+    for block_start in range(start, end, _COUNT_BLOCK_SIZE):
+        block_end = min(block_start + _COUNT_BLOCK_SIZE, end)
+        n += buf[block_start:block_end].count(sub)
+    return n
+
 
 if __name__ == '__main__':
     pass
@@ -9,6 +9,7 @@
 import os
 import sys
 
+from .merge import file_record
 from .outputformatter import OutputFormatter
 from .utils import decode_colorama_color, tostring
 from . import colorama
@@ -47,6 +48,8 @@ class DefaultPssOutputFormatter(OutputFormatter):
                                colorama.Fore.MAGENTA + colorama.Style.BRIGHT)
         self.style_lineno = (decode_colorama_color(lineno_color_str) or
                              colorama.Fore.WHITE)
+        self.style_added = colorama.Fore.GREEN + colorama.Style.BRIGHT
+        self.style_removed = colorama.Fore.RED + colorama.Style.BRIGHT
 
         # colorama.init is doing something strange on Linux, by emitting a color
         # reset sequence when it shouldn't. This causes strange errors when
@@ -73,31 +76,61 @@ class DefaultPssOutputFormatter(OutputFormatter):
         self._emitline()
 
     def matching_line(self, matchresult, filename):
+        text = matchresult.matching_line
+        col_ranges = matchresult.matching_column_ranges
+        newline = b'\n' if isinstance(text, bytes) else '\n'
+        lineno = matchresult.matching_lineno
+        # In multiline searches, a match can span several lines. Each of
+        # them is emitted on its own, with the parts of the column ranges
+        # that fall into it.
+        line_start = 0
+        while True:
+            line_end = text.find(newline, line_start, len(text) - 1) + 1
+            if line_end == 0:
+                break
+            self._emit_matching_line(
+                text[line_start:line_end], lineno,
+                _ranges_in_line(col_ranges, line_start, line_end), filename)
+            line_start = line_end
+            lineno += 1
+        if line_start:
+            col_ranges = _ranges_in_line(col_ranges, line_start, len(text))
+        self._emit_matching_line(text[line_start:], lineno, col_ranges,
+                                 filename)
+
+    def _emit_matching_line(self, line, lineno, col_ranges, filename):
         if self.inline_filename:
             self._emit_colored('%s' % filename, self.style_filename)
             self._emit(':')
         if self.show_line_of_match:
-            self._emit_colored('%s' % matchresult.matching_lineno, self.style_lineno)
+            self._emit_colored('%s' % lineno, self.style_lineno)
             self._emit(':')
-        first_match_range = matchresult.matching_column_ranges[0]
+        # Lines of inverted matches have no column ranges
+        first_match_range = col_ranges[0] if col_ranges else (0, 0)
         if self.show_column_of_first_match:
             self._emit('%s:' % first_match_range[0])
+        if not col_ranges:
+            self._emit(line)
+            return
 
         # Emit the chunk before the first matching chunk
-        line = matchresult.matching_line
         self._emit(line[:first_match_range[0]])
         # Now emit the matching chunks (colored), along with the non-matching
         # chunks that come after them
-        for i, (match_start, match_end) in enumerate(
-                matchresult.matching_column_ranges):
+        for i, (match_start, match_end) in enumerate(col_ranges):
             self._emit_colored(line[match_start:match_end], self.style_match)
-            if i == len(matchresult.matching_column_ranges) - 1:
+            if i == len(col_ranges) - 1:
                 chunk = line[match_end:]
             else:
-                next_start = matchresult.matching_column_ranges[i + 1][0]
+                next_start = col_ranges[i + 1][0]
                 chunk = line[match_end:next_start]
             self._emit(chunk)
 
+    def changed_matching_line(self, matchresult, filename, change):
+        style = (self.style_added if change == '+' else self.style_removed)
+        self._emit_colored(change, style)
+        self.matching_line(matchresult, filename)
+
     def context_line(self, line, lineno, filename):
         if self.inline_filename:
             self._emit_colored('%s' % filename, self.style_filename)
@@ -112,12 +145,19 @@ class DefaultPssOutputFormatter(OutputFormatter):
     def context_separator(self):
         self._emitline('--')
 
+    def file_record(self, source, filename):
+        self._emit(file_record(source, filename))
+
     def found_filename(self, filename):
         self._emitline(filename)
 
     def binary_file_matches(self, msg):
         self._emitline(msg)
 
+    def explanation(self, lines):
+        for line in lines:
+            self._emitline(line)
+
     def _emit(self, str):
         """ Write the string to the stream.
         """
@@ -134,3 +174,16 @@ class DefaultPssOutputFormatter(OutputFormatter):
 
     def _emitline(self, line=''):
         self._emit(line + '\n')
+
+
+def _ranges_in_line(col_ranges, line_start, line_end):
+    """ The parts of the column ranges (of a match spanning several lines)
+        that fall into the line at text[line_start:line_end], counted from
+        the start of the line.
+    """
+    ranges = []
+    for start, end in col_ranges:
+        if start < line_end and (end > line_start or start >= line_start):
+            ranges.append((max(start, line_start) - line_start,
+                           min(end, line_end) - line_start))
+    return ranges
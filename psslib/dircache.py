@@ -0,0 +1,184 @@
+#-------------------------------------------------------------------------------
+# pss: dircache.py
+#
+# DirCache class - a persistent on-disk cache of directory listings, used by
+# FileFinder to avoid re-listing directories that didn't change between runs.
+#
+# Eli Bendersky (eliben@gmail.com)
+# This code is in the public domain
+#-------------------------------------------------------------------------------
+import hashlib
+import marshal
+import os
+import sys
+import time
+
+
+# Bump when the format of the stored data changes
+_CACHE_FORMAT_VERSION = 1
+
+# Flags stored for each cached entry
+_ENTRY_IS_DIR = 1
+_ENTRY_IS_SYMLINK = 2
+
+# A directory modified less than this many seconds before it was listed may
+# be modified again within the same mtime tick without the mtime changing, so
+# its listing is not cached (this is the same "racy" problem git has with its
+# index).
+_RACY_SECONDS = 2
+
+
+def default_cache_dir():
+    """ The default directory for pss's caches: $XDG_CACHE_HOME/pss, or the
+        platform's equivalent.
+    """
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = (os.environ.get('XDG_CACHE_HOME') or
+                os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'pss')
+
+
+class DirCache(object):
+    """ Cache of directory listings for a single search root, persisted in a
+        file under cache_dir.
+
+        Each directory's listing is stored together with the directory's
+        mtime, inode and device. As long as those are unchanged the directory
+        contains the same names, so the stored listing is used instead of
+        calling os.scandir.
+
+        Entries of directories that are gone are dropped as the walk finds
+        out about them: when they can't be listed, or when their parent is
+        listed again without them. The directories the walk doesn't reach
+        aren't checked, so a run costs no more stats than the walk needs.
+    """
+    def __init__(self, cache_dir, root):
+        self.cache_dir = cache_dir
+        root_key = os.path.abspath(root).encode('utf-8', 'surrogateescape')
+        self.cache_path = os.path.join(
+            cache_dir, 'dirs-%s' % hashlib.sha1(root_key).hexdigest())
+        self.dirs = self._load()
+        self.modified = False
+        # Number of listings served from the cache
+        self.hits = 0
+
+    def scandir(self, dirpath):
+        """ Return an iterable of os.DirEntry-like objects for dirpath,
+            from the cache if the directory didn't change. Raise OSError if
+            the directory can't be listed.
+        """
+        key = os.path.abspath(dirpath)
+        try:
+            st = os.stat(dirpath)
+        except OSError:
+            self._drop(key)
+            raise
+        stamp = (st.st_mtime_ns, st.st_ino, st.st_dev)
+
+        cached = self.dirs.get(key)
+        if cached is not None and cached[0] == stamp:
+            self.hits += 1
+            return [_CachedEntry(dirpath, name, flags, ino)
+                    for name, flags, ino in cached[1]]
+        return self._scan_and_store(dirpath, key, stamp)
+
+    def save(self):
+        """ Write the cache back to disk, if it was modified.
+        """
+        if not self.modified:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                marshal.dump((_CACHE_FORMAT_VERSION, self.dirs), f)
+            os.replace(tmp_path, self.cache_path)
+            self.modified = False
+        except OSError:
+            # The cache is only an optimization; failing to write it is not
+            # an error.
+            pass
+
+    def _scan_and_store(self, dirpath, key, stamp):
+        entries = []
+        stored = []
+        with os.scandir(dirpath) as scandir_it:
+            for entry in scandir_it:
+                flags = 0
+                try:
+                    if entry.is_dir():
+                        flags |= _ENTRY_IS_DIR
+                except OSError:
+                    pass
+                if entry.is_symlink():
+                    flags |= _ENTRY_IS_SYMLINK
+                try:
+                    ino = entry.inode()
+                except OSError:
+                    ino = 0
+                entries.append(entry)
+                stored.append((entry.name, flags, ino))
+
+        # The subdirectories in the stored listing that aren't in the new
+        # one are gone (or moved), and so are their entries.
+        cached = self.dirs.get(key)
+        if cached is not None:
+            names = set(name for name, _, _ in stored)
+            for name, flags, _ in cached[1]:
+                if flags & _ENTRY_IS_DIR and name not in names:
+                    self._drop(os.path.join(key, name))
+
+        if time.time() - stamp[0] / 1e9 > _RACY_SECONDS:
+            self.dirs[key] = (stamp, stored)
+            self.modified = True
+        return entries
+
+    def _drop(self, key):
+        """ Drop the entry of the directory with the given key, and those of
+            the subdirectories in its stored listing.
+        """
+        cached = self.dirs.pop(key, None)
+        if cached is None:
+            return
+        self.modified = True
+        for name, flags, _ in cached[1]:
+            if flags & _ENTRY_IS_DIR:
+                self._drop(os.path.join(key, name))
+
+    def _load(self):
+        try:
+            with open(self.cache_path, 'rb') as f:
+                version, dirs = marshal.load(f)
+            if version == _CACHE_FORMAT_VERSION and isinstance(dirs, dict):
+                return dirs
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        return {}
+
+
+class _CachedEntry(object):
+    """ Stands in for os.DirEntry for entries coming from the cache.
+    """
+    __slots__ = ('name', 'path', '_flags', '_ino')
+
+    def __init__(self, dirpath, name, flags, ino):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._flags = flags
+        self._ino = ino
+
+    def is_dir(self, follow_symlinks=True):
+        if not follow_symlinks and self._flags & _ENTRY_IS_SYMLINK:
+            return False
+        return bool(self._flags & _ENTRY_IS_DIR)
+
+    def is_symlink(self):
+        return bool(self._flags & _ENTRY_IS_SYMLINK)
+
+    def inode(self):
+        return self._ino
+
+    def stat(self, follow_symlinks=True):
+        return os.stat(self.path, follow_symlinks=follow_symlinks)
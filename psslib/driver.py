@@ -7,12 +7,20 @@
 # This code is in the public domain
 #-------------------------------------------------------------------------------
 import collections
+import contextlib
+import functools
+import io
+import os
 import sys
 
+from .archives import ARCHIVE_ERRORS, MemberReader, split_member_path
+from .compressed import open_decompressed
 from .filefinder import FileFinder
 from .contentmatcher import ContentMatcher
 from .defaultpssoutputformatter import DefaultPssOutputFormatter
-from .utils import istextfile
+from .dircache import default_cache_dir
+from .utils import bom_encoding, istextblock
+from .watcher import WatchEvent, create_watcher, diff_matches
 
 TypeSpec = collections.namedtuple('TypeSpec', ['extensions', 'patterns'])
 
@@ -202,6 +210,11 @@ IGNORED_FILE_PATTERNS = frozenset(
     [r'~$', r'#.+#$', r'[._].*\.swp$', r'core\.\d+$'])
 
 
+# Size of the block at the start of a file that's used to decide whether
+# it's a text file or a binary file (see utils.istextblock)
+TEXT_DETECTION_BLOCK_SIZE = 512
+
+
 class PssOnlyFindFilesOption:
     """ Option to specify how to "only find files"
     """
@@ -241,6 +254,25 @@ def pss_run(roots,
         universal_newlines=False,
         ncontext_before=0,
         ncontext_after=0,
+        walk_threads=1,
+        use_dir_cache=False,
+        use_ignore_files=False,
+        use_git_index=False,
+        files_from=None,
+        min_filesize=None,
+        max_filesize=None,
+        newer_than=None,
+        older_than=None,
+        follow_symlinks=False,
+        walk_order='depth',
+        max_depth=None,
+        watch=False,
+        shard=None,
+        shard_subtrees=False,
+        explain=False,
+        multiline=False,
+        search_zip=False,
+        search_archives=False,
         ):
     """ The main pss invocation function - handles all PSS logic.
 
@@ -293,34 +325,65 @@ def pss_run(roots,
             ignore_extensions.update(TYPE_MAP[typ].extensions)
             ignore_patterns.update(TYPE_MAP[typ].patterns)
 
-    filefinder = FileFinder(
-            roots=roots,
+    # When the files are going to be searched, the text/binary check is done
+    # here on the block that the search reads first anyway, instead of in
+    # FileFinder, which would have to open and read every file separately.
+    only_list_files = (
+        only_find_files and
+        only_find_files_option == PssOnlyFindFilesOption.ALL_FILES)
+
+    # With watch, the directories are watched as they are walked, and the
+    # matches found in each file are kept, to be compared with the matches
+    # after the file changes.
+    watcher = None
+    file_matches = {}
+    if watch:
+        watcher = create_watcher()
+
+    finder_args = dict(
             recurse=recurse,
-            find_only_text_files=textonly,
+            find_only_text_files=textonly and only_list_files,
             ignore_dirs=ignore_dirs,
             search_extensions=search_extensions,
             ignore_extensions=ignore_extensions,
             search_patterns=search_patterns,
             ignore_patterns=ignore_patterns,
             filter_include_patterns=filter_include_patterns,
-            filter_exclude_patterns=filter_exclude_patterns)
+            filter_exclude_patterns=filter_exclude_patterns,
+            walk_threads=walk_threads,
+            cache_dir=default_cache_dir() if use_dir_cache else None,
+            use_ignore_files=use_ignore_files and not search_all_files_and_dirs,
+            use_git_index=use_git_index,
+            min_filesize=min_filesize,
+            max_filesize=max_filesize,
+            newer_than=newer_than,
+            older_than=older_than,
+            follow_symlinks=follow_symlinks,
+            walk_order=walk_order,
+            max_depth=max_depth,
+            dir_callback=watcher.add_dir if watcher is not None else None,
+            shard=shard,
+            shard_subtrees=shard_subtrees,
+            search_compressed=search_zip,
+            search_archives=search_archives)
+    filefinder = FileFinder(roots=roots, files_from=files_from, **finder_args)
 
     # Set up the content matcher
     #
 
+    # pattern may also be a list of patterns (from -e and --patterns-file)
+    patterns = pattern if isinstance(pattern, list) else [pattern]
     if universal_newlines:
-        if pattern is None:
-            pattern = ''
+        patterns = ['' if p is None else p for p in patterns]
         openmode = 'r'
     else:
-        if pattern is None:
-            pattern = b''
-        else:
-            pattern = pattern.encode('utf-8')
+        patterns = [b'' if p is None else p.encode('utf-8') for p in patterns]
         openmode = 'rb'
+    pattern = patterns if isinstance(pattern, list) else patterns[0]
 
     if (    not ignore_case and
-            (smart_case and not _pattern_has_uppercase(pattern))):
+            (smart_case and
+             not any(_pattern_has_uppercase(p) for p in patterns))):
         ignore_case = True
 
     matcher = ContentMatcher(
@@ -329,17 +392,30 @@ def pss_run(roots,
             invert_match=invert_match,
             whole_words=whole_words,
             literal_pattern=literal_pattern,
-            max_match_count=max_match_count)
+            max_match_count=max_match_count,
+            multiline=multiline)
+    if explain and not only_list_files:
+        output_formatter.explanation(matcher.explain())
+
+    # Archive members are opened through a reader that keeps the archive of
+    # the last member open.
+    member_reader = MemberReader() if search_archives else None
 
     match_found = False
 
+    def start_file_output(filepath):
+        # Sharded outputs mark the output of each file, to be merged in the
+        # order of a single search
+        if shard is not None:
+            output_formatter.file_record(filefinder.source_index, filepath)
+
     # All systems go...
     #
     for filepath in filefinder.files():
         # If only_find_files is requested and no special option provided,
         # this is kind of 'find -name'
-        if (    only_find_files and
-                only_find_files_option == PssOnlyFindFilesOption.ALL_FILES):
+        if only_list_files:
+            start_file_output(filepath)
             output_formatter.found_filename(filepath)
             match_found = True
             continue
@@ -351,22 +427,30 @@ def pss_run(roots,
         # full work.
         #
         try:
-            with open(filepath, openmode) as fileobj:
-                if not istextfile(fileobj):
-                    # istextfile does some reading on fileobj, so rewind it
-                    fileobj.seek(0)
-                    matches = list(matcher.match_file(fileobj, max_match_count=1))
+            with _open_for_search(filepath, search_zip,
+                                  member_reader) as (binfileobj, block):
+                is_text = istextblock(block[:TEXT_DETECTION_BLOCK_SIZE])
+                if not is_text and textonly:
+                    continue
+                encoding = bom_encoding(block) if is_text else None
+                fileobj, match_file = _prepare_search(binfileobj, encoding,
+                                                      matcher, openmode)
+
+                if not is_text:
+                    matches = list(match_file(fileobj, max_match_count=1))
+                    if watcher is not None:
+                        file_matches[filepath] = matches
+                        watcher.add_file(filepath)
                     if matches:
+                        start_file_output(filepath)
                         output_formatter.binary_file_matches(
                                 'Binary file %s matches\n' % filepath)
                         match_found = True
                     continue
-                # istextfile does some reading on fileobj, so rewind it
-                fileobj.seek(0)
 
                 # If only files are to be found either with or without matches...
                 if only_find_files:
-                    matches = list(matcher.match_file(fileobj, max_match_count=1))
+                    matches = list(match_file(fileobj, max_match_count=1))
                     found = (
                         (   matches and
                             only_find_files_option == PssOnlyFindFilesOption.FILES_WITH_MATCHES)
@@ -374,17 +458,22 @@ def pss_run(roots,
                         (   not matches and
                             only_find_files_option == PssOnlyFindFilesOption.FILES_WITHOUT_MATCHES))
                     if found:
+                        start_file_output(filepath)
                         output_formatter.found_filename(filepath)
                         match_found = True
                     continue
 
                 # This is the "normal path" when we examine and display the
                 # matches inside the file.
-                matches = list(matcher.match_file(fileobj))
+                matches = list(match_file(fileobj))
+                if watcher is not None:
+                    file_matches[filepath] = matches
+                    watcher.add_file(filepath)
                 if not matches:
                     # Nothing to see here... move along
                     continue
                 match_found =True
+                start_file_output(filepath)
                 output_formatter.start_matches_in_file(filepath)
                 if ncontext_before > 0 or ncontext_after > 0:
                     # If context lines should be printed, we have to read in the
@@ -403,7 +492,11 @@ def pss_run(roots,
                     #
                     prev_was_blank = False
                     had_context = False
-                    for n, line in enumerate(fileobj, 1):
+                    lines = fileobj
+                    if encoding is not None and openmode == 'rb':
+                        # Like the matching lines, in UTF-8
+                        lines = _utf8_lines(fileobj, encoding)
+                    for n, line in enumerate(lines, 1):
                         # Find out whether this line is a match, context or
                         # neither, and act accordingly
                         result, match = match_context_dict.get(n, (None, None))
@@ -412,6 +505,9 @@ def pss_run(roots,
                             continue
                         elif result == LINE_MATCH:
                             output_formatter.matching_line(match, filepath)
+                        elif result == LINE_MATCH_REST:
+                            # Emitted with the first line of its match
+                            pass
                         elif result == LINE_CONTEXT:
                             if prev_was_blank and had_context:
                                 output_formatter.context_separator()
@@ -425,13 +521,206 @@ def pss_run(roots,
 
                 if do_break:
                     output_formatter.end_matches_in_file(filepath)
-        except (OSError, IOError):
+        except _READ_ERRORS:
             # There was a problem opening or reading the file, so ignore it.
             pass
+    if member_reader is not None:
+        member_reader.close()
+
+    if watcher is not None:
+        def search_file(filepath):
+            return _search_file(filepath, matcher, openmode, textonly,
+                                search_zip)
+        if _watch_for_changes(watcher, file_matches, roots, finder_args,
+                              filefinder, search_file, output_formatter,
+                              do_break):
+            match_found = True
 
     return match_found
 
 
+@contextlib.contextmanager
+def _open_for_search(filepath, search_zip, member_reader=None):
+    """ Open the file for searching, as a context manager giving a pair
+        (binfileobj, block): a buffered binary file object at the start of
+        the contents, and the first block of the contents (for telling
+        text and binary files apart). With search_zip, the contents of
+        compressed files are decompressed as they're read. With a
+        member_reader (see archives.MemberReader), filepath can also be
+        the virtual path of an archive member.
+    """
+    member = None
+    if member_reader is not None:
+        member = split_member_path(filepath)
+    if member is not None:
+        binfileobj = member_reader.open(*member)
+    else:
+        binfileobj = open(filepath, 'rb')
+    with binfileobj:
+        # peek doesn't move the file position, so the block stays in the
+        # buffer for the matcher to read - the file is opened and its first
+        # block is read only once.
+        block = binfileobj.peek(TEXT_DETECTION_BLOCK_SIZE)
+        decompressed = None
+        if search_zip:
+            decompressed = open_decompressed(binfileobj, filepath, block,
+                                             prefetch=_CAN_PREFETCH)
+        if decompressed is None:
+            yield binfileobj, block
+            return
+        with decompressed:
+            yield decompressed, decompressed.peek(TEXT_DETECTION_BLOCK_SIZE)
+
+
+def _prepare_search(binfileobj, encoding, matcher, openmode):
+    """ Return a pair (fileobj, match_file): the file object to search, read
+        from binfileobj, and the function matching it (see
+        ContentMatcher.match_file). encoding is that of text with a byte
+        order mark (see utils.bom_encoding), or None.
+    """
+    if openmode == 'r':
+        if encoding is None:
+            return io.TextIOWrapper(binfileobj), matcher.match_file
+        # The utf-16 and utf-32 codecs (the encoding without its byte order)
+        # take the byte order from the mark and skip it, also when the file
+        # is read again from the start.
+        fileobj = io.TextIOWrapper(binfileobj, encoding=encoding[:-3],
+                                   errors='replace')
+        return fileobj, matcher.match_file
+    if encoding is None:
+        return binfileobj, matcher.match_file
+    return binfileobj, functools.partial(matcher.match_encoded_file,
+                                         encoding=encoding)
+
+
+def _utf8_lines(binfileobj, encoding):
+    """ Generate the lines of binfileobj, text in encoding after a byte order
+        mark, in UTF-8 - as ContentMatcher.match_encoded_file reports them.
+    """
+    binfileobj.read(len('\ufeff'.encode(encoding)))
+    textobj = io.TextIOWrapper(binfileobj, encoding=encoding,
+                               errors='replace', newline='\n')
+    try:
+        for line in textobj:
+            yield line.encode('utf-8')
+    finally:
+        # Leave binfileobj open for the caller
+        textobj.detach()
+
+
+# Errors of reading files (and archive members) that make pss_run skip them
+_READ_ERRORS = (OSError, IOError) + ARCHIVE_ERRORS
+
+
+# Compressed files are decompressed ahead of the search in another thread
+# when there's more than one CPU for it to run on.
+_CAN_PREFETCH = (os.cpu_count() or 1) > 1
+
+
+def _search_file(filepath, matcher, openmode, textonly, search_zip=False):
+    """ Search a single file like pss_run does. Return a pair (is_text,
+        matches), or None if the file is skipped or can't be read.
+    """
+    try:
+        with _open_for_search(filepath, search_zip) as (binfileobj, block):
+            is_text = istextblock(block[:TEXT_DETECTION_BLOCK_SIZE])
+            if not is_text and textonly:
+                return None
+            encoding = bom_encoding(block) if is_text else None
+            fileobj, match_file = _prepare_search(binfileobj, encoding,
+                                                  matcher, openmode)
+            if is_text:
+                return True, list(match_file(fileobj))
+            else:
+                return False, list(match_file(fileobj, max_match_count=1))
+    except (OSError, IOError):
+        return None
+
+
+def _watch_for_changes(watcher, file_matches, roots, finder_args, filefinder,
+                       search_file, output_formatter, do_break):
+    """ The --watch loop, run after the initial search: wait for files to
+        change and search the changed files again, reporting how their
+        matches changed. file_matches maps each searched file to its list of
+        matches. Runs until interrupted. Return True if new matches were
+        found.
+    """
+    new_matches_found = [False]
+
+    def update(filepath, result):
+        old = file_matches.pop(filepath, [])
+        if result is None:
+            is_text, new = True, []
+        else:
+            is_text, new = result
+            file_matches[filepath] = new
+            watcher.add_file(filepath)
+        if _report_match_changes(filepath, is_text, old, new,
+                                 output_formatter, do_break):
+            new_matches_found[0] = True
+
+    def rescan(filepaths, all_known):
+        found = set()
+        for filepath in filepaths:
+            found.add(filepath)
+            update(filepath, search_file(filepath))
+        if all_known:
+            for filepath in list(file_matches):
+                if filepath not in found:
+                    update(filepath, search_file(filepath))
+
+    try:
+        while True:
+            for kind, path in watcher.wait():
+                if kind == WatchEvent.FILE_CHANGED:
+                    if path in file_matches or filefinder.is_found(path):
+                        update(path, search_file(path))
+                elif kind == WatchEvent.FILE_DELETED:
+                    if path in file_matches:
+                        update(path, None)
+                elif kind == WatchEvent.DIR_CREATED:
+                    # Checked against the rules for its place under its
+                    # root, not walked as a root of its own
+                    rescan(filefinder.files_in_dir(path), False)
+                elif kind == WatchEvent.DIR_DELETED:
+                    prefix = os.path.join(path, '')
+                    for filepath in list(file_matches):
+                        if filepath.startswith(prefix):
+                            update(filepath, None)
+                elif kind == WatchEvent.RESCAN:
+                    rescan(FileFinder(roots=roots, **finder_args).files(),
+                           True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return new_matches_found[0]
+
+
+def _report_match_changes(filepath, is_text, old_matches, new_matches,
+                          output_formatter, do_break):
+    """ Report the difference between the old and new matches of a file
+        that changed. Return True if there are new matches.
+    """
+    if not is_text:
+        if new_matches and not old_matches:
+            output_formatter.binary_file_matches(
+                    'Binary file %s matches\n' % filepath)
+        return bool(new_matches)
+
+    removed, added = diff_matches(old_matches, new_matches)
+    if not removed and not added:
+        return False
+    output_formatter.start_matches_in_file(filepath)
+    for match in removed:
+        output_formatter.changed_matching_line(match, filepath, '-')
+    for match in added:
+        output_formatter.changed_matching_line(match, filepath, '+')
+    if do_break:
+        output_formatter.end_matches_in_file(filepath)
+    return bool(added)
+
+
 def _pattern_has_uppercase(pattern):
     """ Check whether the given regex pattern has uppercase letters to match
     """
@@ -450,23 +739,30 @@ def _pattern_has_uppercase(pattern):
     return False
 
 
-LINE_MATCH, LINE_CONTEXT = range(2)
+LINE_MATCH, LINE_MATCH_REST, LINE_CONTEXT = range(3)
 
 
 def _build_match_context_dict(matches, ncontext_before, ncontext_after):
     """ Given a list of MatchResult objects and number of context lines before
         and after a match, build a dictionary that maps line numbers to
         (line_kind, data) pairs. line_kind is either LINE_MATCH or LINE_CONTEXT
-        and data holds the match object for LINE_MATCH.
+        and data holds the match object for LINE_MATCH. The lines after the
+        first of a match that spans several lines (see multiline) are
+        LINE_MATCH_REST.
     """
     d = {}
     for match in matches:
         # Take care to give LINE_MATCH entries priority over LINE_CONTEXT
         lineno = match.matching_lineno
         d[lineno] = LINE_MATCH, match
+        line = match.matching_line
+        newline = b'\n' if isinstance(line, bytes) else '\n'
+        last_lineno = lineno + line.count(newline, 0, len(line) - 1)
+        for nrest in range(lineno + 1, last_lineno + 1):
+            d[nrest] = LINE_MATCH_REST, None
 
         context_start = lineno - ncontext_before
-        context_end = lineno + ncontext_after
+        context_end = last_lineno + ncontext_after
         for ncontext in range(context_start, context_end + 1):
             if ncontext not in d:
                 d[ncontext] = LINE_CONTEXT, None
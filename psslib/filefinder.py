@@ -6,13 +6,35 @@
 # Eli Bendersky (eliben@gmail.com)
 # This code is in the public domain
 #-------------------------------------------------------------------------------
+import collections
+import heapq
+import itertools
 import os
+import queue
 import re
+import threading
+import zlib
 
+from .archives import (ARCHIVE_ERRORS, MemberReader, archive_format,
+                       archive_members, member_path, split_member_path)
+from .compressed import COMPRESSED_EXTENSIONS
+from .dircache import DirCache
+from .gitindex import find_git_worktree, read_index_paths, GitIndexError
+from .ignorefiles import (IGNORE_FILE_NAMES, CACHEDIR_TAG_NAME,
+        ancestor_ignore_context, descend_ignore_context, is_cachedir,
+        is_ignored, load_ignore_rules)
 from .utils import istextfile
+from . import regexinfo
 
 
 class FileFinder(object):
+    # Maximal number of found files waiting to be consumed when the walk runs
+    # in several threads.
+    WALK_QUEUE_SIZE = 1024
+
+    # Accepted values of walk_order
+    WALK_ORDERS = ('depth', 'sorted', 'breadth', 'shallow', 'mtime')
+
     def __init__(self,
             roots,
             recurse=True,
@@ -23,7 +45,24 @@ class FileFinder(object):
             search_patterns=[],
             ignore_patterns=[],
             filter_include_patterns=[],
-            filter_exclude_patterns=[]):
+            filter_exclude_patterns=[],
+            walk_threads=1,
+            cache_dir=None,
+            use_ignore_files=False,
+            use_git_index=False,
+            files_from=None,
+            min_filesize=None,
+            max_filesize=None,
+            newer_than=None,
+            older_than=None,
+            follow_symlinks=False,
+            walk_order='depth',
+            max_depth=None,
+            dir_callback=None,
+            shard=None,
+            shard_subtrees=False,
+            search_compressed=False,
+            search_archives=False):
         """ Create a new FileFinder. The parameters are the "search rules"
             that dictate which files are found.
 
@@ -65,10 +104,113 @@ class FileFinder(object):
             filter_exclude_patterns:
                 Files with names matching these patterns will never be found.
                 Overrides all include rules.
+
+            walk_threads:
+                Number of threads listing directories concurrently. With more
+                than one thread the files are found in no particular order.
+
+            cache_dir:
+                If not None, directory listings are cached persistently in
+                this directory, and directories that didn't change since the
+                last search (by their mtime and inode) aren't listed again.
+
+            use_ignore_files:
+                If True, files and directories excluded by .gitignore and
+                .ignore files (including those in parent directories up to the
+                top of the git work tree) are not found, and directories
+                tagged with a CACHEDIR.TAG file are skipped. Ignored
+                directories are pruned without being listed.
+
+            use_git_index:
+                If True, root directories inside a git work tree aren't
+                walked. Instead, the files tracked in the git index are
+                searched (still subject to all the other search rules).
+
+            files_from:
+                An iterable of file paths to find in addition to the roots,
+                consumed lazily. Like files given as roots, these are only
+                checked against the file name rules.
+
+            min_filesize:
+            max_filesize:
+                If not None, only files with at least / at most this many
+                bytes are found.
+
+            newer_than:
+            older_than:
+                If not None, only files modified after / before this time (in
+                seconds since the epoch) are found.
+
+            The size and time bounds use the stat information of directory
+            entries, so files outside them are rejected without being opened.
+
+            follow_symlinks:
+                If True, symbolic links to directories are walked into.
+                Directories and files are identified by their device and
+                inode, so cycles of links are broken and a file reached
+                through several links (or hard links) is found once. The same
+                identification removes duplicates when several roots
+                overlap, even without follow_symlinks.
+
+            walk_order:
+                The order in which directories are walked:
+                'depth' - depth-first, in the same order as os.walk
+                'sorted' - depth-first, with the entries of each directory
+                    sorted by name (see merge.py)
+                'breadth' (or 'shallow') - breadth-first: the files of each
+                    level of the tree are found before those of the next
+                'mtime' - recently modified directories first; in addition,
+                    found files are passed through a window of
+                    WALK_ORDER_WINDOW files, from which the most recently
+                    modified one is found first
+                With walk_threads > 1 directories are walked in no particular
+                order, but the 'mtime' window still applies.
+
+            max_depth:
+                If not None, files more than max_depth directories below a
+                root aren't found (files directly in the root are at depth 1).
+                recurse=False is the same as max_depth=1.
+
+            dir_callback:
+                If not None, called with the path of each directory the walk
+                lists, just before listing it (from the walking threads, with
+                walk_threads > 1).
+
+            shard:
+                If not None, a pair (index, count) with 1 <= index <= count:
+                the files are split into count shards by a stable hash of
+                their paths relative to the root, and only the files of shard
+                number index are found. Searches with the same roots and
+                rules, run with each of the shards, together find every file
+                exactly once.
+
+            shard_subtrees:
+                If True, the shards are made of whole top-level entries of
+                the roots rather than of single files, so each search only
+                walks its own subtrees (the shards are less balanced).
+
+            search_compressed:
+                If True, the file type rules (the search and ignore
+                extensions and patterns) see compressed files by their name
+                without the compression extension: foo.c.gz is found like
+                foo.c (see compressed.COMPRESSED_EXTENSIONS).
+
+            search_archives:
+                If True, zip and tar archives (see archives.archive_format)
+                aren't found themselves. Instead, their members are found
+                by virtual paths like app.jar!/com/x/Y.java, when they pass
+                the file name rules. The other rules only apply to the
+                archives.
         """
         # Prepare internal data structures from the parameters
         self.roots = roots
         self.recurse = recurse
+        if walk_order not in self.WALK_ORDERS:
+            raise ValueError('unknown walk order %r' % (walk_order,))
+        self.walk_order = 'breadth' if walk_order == 'shallow' else walk_order
+        self.max_depth = max_depth
+        if not recurse:
+            self.max_depth = 1 if max_depth is None else min(max_depth, 1)
         self.search_extensions = set(search_extensions)
         self.ignore_extensions = set(ignore_extensions)
         self.search_pattern = self._merge_regex_patterns(search_patterns)
@@ -78,40 +220,795 @@ class FileFinder(object):
         self.filter_exclude_pattern = self._merge_regex_patterns(
                                                 filter_exclude_patterns)
 
+        # The same patterns, split according to the part of the path they
+        # need to see, for _file_is_found.
+        self._search_patterns = _PathPatterns(search_patterns)
+        self._ignore_patterns = _PathPatterns(ignore_patterns)
+        self._include_patterns = _PathPatterns(filter_include_patterns)
+        self._exclude_patterns = _PathPatterns(filter_exclude_patterns)
+        self._search_all_names = (not self.search_extensions and
+                                  not self._search_patterns)
+        # Memoized classification of file basenames: maps a basename to a
+        # tuple of booleans; see _classify_basename.
+        self._basename_memo = {}
+        # Results of the patterns that look at the directory part of paths,
+        # for the last directory seen: (dirpart, results).
+        self._last_dir_memo = (None, None)
+
         # Distinguish between dirs (like "foo") and paths (like "foo/bar")
-        # to ignore.
+        # to ignore. Paths are kept in a trie of path components, which the
+        # walk descends together with the directory tree.
         self.ignore_dirs = set()
         self.ignore_paths = set()
+        self._ignore_paths_trie = _PathTrieNode()
         for d in ignore_dirs:
             if os.sep in d:
                 self.ignore_paths.add(d)
+                self._ignore_paths_trie.add(_split_path(d))
             else:
                 self.ignore_dirs.add(d)
 
         self.find_only_text_files = find_only_text_files
+        self.walk_threads = walk_threads
+        self.cache_dir = cache_dir
+        self._dir_cache = None
+        self.use_ignore_files = use_ignore_files
+        self.use_git_index = use_git_index
+        self.files_from = files_from
+        self.min_filesize = min_filesize
+        self.max_filesize = max_filesize
+        self.newer_than = newer_than
+        self.older_than = older_than
+        self._has_stat_bounds = any(bound is not None for bound in (
+            min_filesize, max_filesize, newer_than, older_than))
+        self.follow_symlinks = follow_symlinks
+        self.dir_callback = dir_callback
+        if shard is not None and not 1 <= shard[0] <= shard[1]:
+            raise ValueError('invalid shard %d/%d' % tuple(shard))
+        self.shard = shard
+        self.shard_subtrees = shard_subtrees
+        self.search_compressed = search_compressed
+        self.search_archives = search_archives
+        # Number of the --files-from path or root the last found file came
+        # from, counting the --files-from paths first and then the roots, in
+        # the order they're searched.
+        self.source_index = None
+        # Set of (st_dev, st_ino) of the directories and files visited during
+        # the search, or None when there's no way to reach anything twice.
+        self._seen = None
+        self._seen_lock = threading.Lock()
+
+        # Debug counters collected during the search:
+        #   dirs_scanned: directories listed with os.scandir
+        #   entries_seen: directory entries examined
+        #   stats_saved: stat calls avoided thanks to the file type information
+        #                cached in os.DirEntry
+        #   dirs_from_cache: directory listings taken from the persistent cache
+        #   dirs_pruned: directories skipped because of ignore files
+        self.stats = collections.Counter()
 
     def files(self):
         """ Generate files according to the search rules. Yield
             paths to files one by one.
         """
+        paths = self._found_files()
+        if self.search_archives:
+            paths = self._archive_members(paths)
+        for path in paths:
+            yield path
+
+    def _archive_members(self, paths):
+        """ Replace the archives among paths by the virtual paths of their
+            members that pass the file name rules, and find_only_text_files
+            (checked on the contents of the members, not the archives).
+        """
+        reader = MemberReader() if self.find_only_text_files else None
+        try:
+            for path in paths:
+                if archive_format(path) is None:
+                    yield path
+                    continue
+                for name in archive_members(path):
+                    virtual_path = member_path(path, name)
+                    if (    self._name_is_found(virtual_path) and
+                            (reader is None or
+                             self._member_is_text(reader, path, name))):
+                        yield virtual_path
+        finally:
+            if reader is not None:
+                reader.close()
+
+    def _member_is_text(self, reader, archive, name):
+        """ Is the member with the given name in archive a text file? reader
+            is the archives.MemberReader to read it with.
+        """
+        try:
+            with reader.open(archive, name) as f:
+                return istextfile(f)
+        except (OSError,) + ARCHIVE_ERRORS:
+            return False
+
+    def _found_files(self):
+        if self.follow_symlinks or len(self.roots) > 1:
+            self._seen = set()
+        else:
+            self._seen = None
+
+        self.source_index = -1
+        if self.files_from is not None:
+            for path in self.files_from:
+                self.source_index += 1
+                if (self._path_in_shard(path.replace(os.sep, '/')) and
+                        self._file_is_found(path)):
+                    yield path
+
         for root in self.roots:
+            self.source_index += 1
+            if self._seen is not None and not self._first_visit_path(root):
+                continue
             if os.path.isfile(root):
-                if self._file_is_found(root):
+                if (self._path_in_shard(root.replace(os.sep, '/')) and
+                        self._file_is_found(root)):
                     yield root
             else: # dir
-                for dirpath, subdirs, files in os.walk(root):
-                    if self._should_ignore_dir(dirpath):
-                        # This dir should be ignored, so remove all its subdirs
-                        # from the walk and go to next dir.
-                        del subdirs[:]
+                if self.use_git_index:
+                    index_files = self._git_index_files(root)
+                    if index_files is not None:
+                        if self.shard is not None and not self.shard_subtrees:
+                            index_files = self._files_in_shard(
+                                root, index_files)
+                        for path in index_files:
+                            yield path
                         continue
-                    for filename in files:
-                        fullpath = os.path.join(dirpath, filename)
-                        if (    self._file_is_found(fullpath) and
-                                os.path.exists(fullpath)):
-                            yield fullpath
-                    if not self.recurse:
+                if self.cache_dir is not None:
+                    self._dir_cache = DirCache(self.cache_dir, root)
+                if self.walk_threads > 1:
+                    walker = self._walk_parallel(root)
+                else:
+                    walker = self._walk(root)
+                if self.shard is not None and not self.shard_subtrees:
+                    walker = self._files_in_shard(root, walker)
+                if self.walk_order == 'mtime':
+                    walker = self._newest_first(walker)
+                try:
+                    for path in walker:
+                        yield path
+                finally:
+                    if self._dir_cache is not None:
+                        self._dir_cache.save()
+                        self.stats['dirs_from_cache'] += self._dir_cache.hits
+                        self._dir_cache = None
+
+    def _walk(self, root):
+        """ Walk the directory tree starting at root, yielding found files.
+
+            This is similar to a top-down os.walk and visits directories in
+            the same order, but it works directly on os.scandir entries: the
+            file type information the OS returns with the listing is reused,
+            so no per-file stat is needed for plain files. Files are yielded
+            while the directory is being listed; only the subdirectories are
+            kept around for later.
+        """
+        root_item = self._root_item(root)
+        if root_item is None:
+            return
+        if self.walk_order == 'breadth':
+            walker = self._walk_breadth_first(root_item)
+        elif self.walk_order == 'mtime':
+            walker = self._walk_mtime_first(root_item)
+        else:
+            walker = self._walk_depth_first(root_item)
+        for path in walker:
+            yield path
+
+    def _walk_depth_first(self, root_item):
+        stack = [root_item]
+        while stack:
+            subdirs = []
+            for path, subdir_item in self._scan_dir(stack.pop(), self.stats):
+                if subdir_item is not None:
+                    subdirs.append(subdir_item)
+                else:
+                    yield path
+            # Push in reverse, so that subdirectories are visited in the order
+            # they were listed.
+            stack.extend(reversed(subdirs))
+
+    def _walk_breadth_first(self, root_item):
+        pending = collections.deque([root_item])
+        while pending:
+            for path, subdir_item in self._scan_dir(pending.popleft(),
+                                                    self.stats):
+                if subdir_item is not None:
+                    pending.append(subdir_item)
+                else:
+                    yield path
+
+    def _walk_mtime_first(self, root_item):
+        # Heap of (-mtime, sequence, item); the sequence number keeps
+        # directories with equal mtimes in the order they were listed.
+        sequence = itertools.count()
+        pending = [(0, next(sequence), root_item)]
+        while pending:
+            _, _, item = heapq.heappop(pending)
+            for path, subdir_item in self._scan_dir(item, self.stats):
+                if subdir_item is not None:
+                    try:
+                        mtime = os.stat(path).st_mtime
+                    except OSError:
+                        mtime = 0
+                    heapq.heappush(pending,
+                                   (-mtime, next(sequence), subdir_item))
+                else:
+                    yield path
+
+    # Number of found files held back by the 'mtime' walk order
+    WALK_ORDER_WINDOW = 256
+
+    def _newest_first(self, paths):
+        """ Reorder the paths generated by paths within a window of
+            WALK_ORDER_WINDOW: whenever the window is full, the most recently
+            modified file in it is yielded.
+        """
+        window = []
+        sequence = itertools.count()
+        try:
+            for path in paths:
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    mtime = 0
+                heapq.heappush(window, (-mtime, next(sequence), path))
+                if len(window) >= self.WALK_ORDER_WINDOW:
+                    yield heapq.heappop(window)[2]
+            while window:
+                yield heapq.heappop(window)[2]
+        finally:
+            # Stop the walk (and its threads) if the consumer stops early
+            paths.close()
+
+    def _walk_parallel(self, root):
+        """ Walk the directory tree starting at root with several threads,
+            yielding found files.
+
+            Worker threads take directories from a work queue and list them
+            concurrently (os.scandir releases the GIL, so this keeps more I/O
+            in flight on high-latency file systems). Found files are passed
+            back through a bounded queue, so workers block rather than
+            accumulate results when the consumer is slower than the walk.
+            The order of the found files is not deterministic.
+        """
+        root_item = self._root_item(root)
+        if root_item is None:
+            return
+        work = queue.Queue()
+        results = queue.Queue(maxsize=self.WALK_QUEUE_SIZE)
+        lock = threading.Lock()
+        stop = threading.Event()
+        # Number of directories queued or being listed. When it drops to 0,
+        # the walk is done.
+        pending = [1]
+
+        def put_result(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def worker():
+            stats = collections.Counter()
+            while True:
+                item = work.get()
+                if item is None:
+                    break
+                try:
+                    if not stop.is_set():
+                        for path, subdir_item in self._scan_dir(item, stats):
+                            if stop.is_set():
+                                break
+                            if subdir_item is not None:
+                                with lock:
+                                    pending[0] += 1
+                                work.put(subdir_item)
+                            else:
+                                put_result(path)
+                except BaseException as e:
+                    put_result(_WalkError(e))
+                finally:
+                    with lock:
+                        pending[0] -= 1
+                        done = pending[0] == 0
+                    if done:
+                        put_result(_WALK_DONE)
+            with lock:
+                self.stats.update(stats)
+
+        work.put(root_item)
+        threads = [threading.Thread(target=worker, daemon=True)
+                   for _ in range(self.walk_threads)]
+        for t in threads:
+            t.start()
+        try:
+            while True:
+                item = results.get()
+                if item is _WALK_DONE:
+                    break
+                elif isinstance(item, _WalkError):
+                    raise item.exc
+                yield item
+        finally:
+            # Also reached when the consumer stops early: tell the workers to
+            # drop what they're doing, and wake them up to exit.
+            stop.set()
+            for t in threads:
+                work.put(None)
+            for t in threads:
+                t.join()
+
+    def _git_index_files(self, root):
+        """ Generate the found files under root from the git index, without
+            walking the directory tree. Return None if root is not in a git
+            work tree or its index can't be read.
+        """
+        worktree = find_git_worktree(root)
+        if worktree is None:
+            return None
+        toplevel, gitdir = worktree
+        try:
+            tracked = list(read_index_paths(gitdir))
+        except GitIndexError:
+            return None
+        return self._filter_index_files(root, toplevel, tracked)
+
+    def _filter_index_files(self, root, toplevel, tracked):
+        relroot = os.path.relpath(os.path.abspath(root), toplevel)
+        prefix = '' if relroot == os.curdir else (
+            relroot.replace(os.sep, '/') + '/')
+        root_item = self._root_item(root)
+        if root_item is None:
+            return
+        # The directories of the files found are passed to dir_callback, as
+        # the walk passes the directories it lists (for --watch).
+        reported_dirs = set()
+        if self.dir_callback is not None:
+            self._report_index_dirs(root, '', reported_dirs)
+
+        # The index is sorted by path, so all the files of a directory come
+        # together, and directory checks are done once per directory.
+        last_dir = None
+        last_dir_searched = False
+        for relpath in tracked:
+            if not relpath.startswith(prefix):
+                continue
+            subpath = relpath[len(prefix):]
+            if (self.shard is not None and self.shard_subtrees and
+                    not self._path_in_shard(subpath.partition('/')[0])):
+                continue
+            dirpart, _, _ = subpath.rpartition('/')
+            if (self.max_depth is not None and
+                    subpath.count('/') >= self.max_depth):
+                continue
+            if dirpart != last_dir:
+                last_dir = dirpart
+                last_dir_searched = True
+                states = root_item.ignore_path_states
+                for component in dirpart.split('/') if dirpart else []:
+                    if component in self.ignore_dirs:
+                        states = None
+                    else:
+                        states = self._descend_ignore_paths(states, component)
+                    if states is None:
+                        last_dir_searched = False
                         break
+                if last_dir_searched and self.dir_callback is not None:
+                    self._report_index_dirs(root, dirpart, reported_dirs)
+            if not last_dir_searched:
+                continue
+            self.stats['entries_seen'] += 1
+            path = os.path.join(root, *subpath.split('/'))
+            if not self._file_is_found(path):
+                continue
+            # Paths from the index don't come with inodes, so overlapping
+            # roots cost a stat per file.
+            if self._seen is not None and not self._first_visit_path(path):
+                continue
+            yield path
+
+    def _report_index_dirs(self, root, dirpart, reported_dirs):
+        """ Pass the directory dirpart (relative to root, from the git index)
+            and the directories above it to dir_callback, unless they're in
+            reported_dirs already. They're added to it.
+        """
+        parts = dirpart.split('/') if dirpart else []
+        for i in range(len(parts) + 1):
+            reldir = '/'.join(parts[:i])
+            if reldir not in reported_dirs:
+                reported_dirs.add(reldir)
+                self.dir_callback(os.path.join(root, *parts[:i]))
+
+    def _root_item(self, root):
+        """ Create the _WalkItem for a root directory. Return None if the
+            root itself should be ignored.
+        """
+        components = _split_path(root)
+        if components and components[-1] in self.ignore_dirs:
+            return None
+        states = ()
+        for component in components:
+            states = self._descend_ignore_paths(states, component)
+            if states is None:
+                return None
+
+        ignore_context = ()
+        if self.use_ignore_files:
+            ignore_context = ancestor_ignore_context(root)
+        dev = None
+        if self._seen is not None:
+            try:
+                dev = os.stat(root).st_dev
+            except OSError:
+                return None
+        return _WalkItem(root, ignore_context, states, dev, 0)
+
+    def _path_in_shard(self, relpath):
+        """ Is relpath (a path with '/' separators) in the shard of this
+            search? The hash must not depend on the platform or on the
+            Python process (unlike hash()), since shards are searched
+            separately.
+        """
+        if self.shard is None:
+            return True
+        index, count = self.shard
+        key = zlib.crc32(relpath.encode('utf-8', 'surrogateescape'))
+        return key % count == index - 1
+
+    def _files_in_shard(self, root, paths):
+        """ Filter the paths found under root by their shard.
+        """
+        try:
+            for path in paths:
+                relpath = path[len(root):].lstrip(os.sep)
+                if self._path_in_shard(relpath.replace(os.sep, '/')):
+                    yield path
+        finally:
+            if hasattr(paths, 'close'):
+                paths.close()
+
+    def _first_visit(self, key):
+        """ Record a (st_dev, st_ino) key as seen. Return True if it wasn't
+            seen before.
+        """
+        with self._seen_lock:
+            if key in self._seen:
+                return False
+            self._seen.add(key)
+            return True
+
+    def _first_visit_path(self, path):
+        """ _first_visit for a path, which is stat-ed (following symlinks).
+            Paths that can't be stat-ed count as visited once: the search
+            will skip or report them anyway.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return True
+        return self._first_visit((st.st_dev, st.st_ino))
+
+    def _descend_ignore_paths(self, states, name):
+        """ Advance the ignore_paths trie states of a directory into its
+            subdirectory name. states is a tuple of the trie nodes matching
+            the trailing path components of the directory. Return None if
+            the subdirectory is ignored.
+        """
+        trie = self._ignore_paths_trie
+        if not trie.children:
+            return ()
+        new_states = []
+        for node in (trie,) + states:
+            child = node.children.get(name)
+            if child is not None:
+                if child.terminal:
+                    return None
+                new_states.append(child)
+        return tuple(new_states)
+
+    def _dir_ignore_context(self, dirpath, ignore_context, names):
+        """ Add the rules of the ignore files among names (the entries of
+            dirpath) to ignore_context, the context dirpath was reached
+            with. Return None if dirpath is a cache directory, which is
+            skipped as a whole.
+        """
+        if CACHEDIR_TAG_NAME in names and is_cachedir(dirpath):
+            return None
+        for name in IGNORE_FILE_NAMES:
+            if name in names:
+                rules = load_ignore_rules(os.path.join(dirpath, name))
+                if rules is not None:
+                    ignore_context = ignore_context + ((rules, ''),)
+        return ignore_context
+
+    def _listed_ignore_context(self, item):
+        """ The ignore context for the entries of the directory of item, as
+            _scan_dir computes it. None if the directory is skipped.
+        """
+        if not self.use_ignore_files:
+            return item.ignore_context
+        try:
+            names = set(os.listdir(item.path))
+        except OSError:
+            return None
+        return self._dir_ignore_context(item.path, item.ignore_context, names)
+
+    def _subdir_item(self, item, name):
+        """ Create the _WalkItem for the subdirectory name of the directory
+            of item, checking it like _scan_dir does. Return None if the walk
+            doesn't descend into it.
+        """
+        if self.max_depth is not None and item.depth + 1 >= self.max_depth:
+            return None
+        if (    self.shard is not None and self.shard_subtrees and
+                item.depth == 0 and not self._path_in_shard(name)):
+            return None
+        if name in self.ignore_dirs:
+            return None
+        path = os.path.join(item.path, name)
+        if not self.follow_symlinks and os.path.islink(path):
+            return None
+        states = self._descend_ignore_paths(item.ignore_path_states, name)
+        if states is None:
+            return None
+        ignore_context = self._listed_ignore_context(item)
+        if ignore_context is None:
+            return None
+        if ignore_context and is_ignored(ignore_context, name, True):
+            return None
+        return _WalkItem(path, descend_ignore_context(ignore_context, name),
+                         states, None, item.depth + 1)
+
+    def _walk_item_of(self, dirpath):
+        """ Find the root dirpath is in, and create the _WalkItem the walk
+            from that root would list dirpath with. Return a pair (root,
+            item): item is None if the walk doesn't reach dirpath, and both
+            are None if dirpath isn't in any of the roots.
+        """
+        for root in self.roots:
+            prefix = os.path.join(root, '')
+            if dirpath == root:
+                relpath = ''
+            elif dirpath.startswith(prefix):
+                relpath = dirpath[len(prefix):]
+            else:
+                continue
+            item = self._root_item(root)
+            for name in relpath.split(os.sep) if relpath else []:
+                if item is None:
+                    break
+                item = self._subdir_item(item, name)
+            return root, item
+        return None, None
+
+    def files_in_dir(self, dirpath):
+        """ Generate the files that the walk of the roots finds in dirpath,
+            a directory in one of the roots, and below it. This is for
+            directories created after the walk (--watch): they're searched
+            with the rules that apply to them under their root.
+        """
+        root, item = self._walk_item_of(dirpath)
+        if item is None:
+            return
+        self._seen = set() if self.follow_symlinks else None
+        if self._seen is not None:
+            try:
+                item = item._replace(dev=os.stat(dirpath).st_dev)
+            except OSError:
+                return
+        paths = self._walk_depth_first(item)
+        if self.shard is not None and not self.shard_subtrees:
+            paths = self._files_in_shard(root, paths)
+        if self.search_archives:
+            paths = self._archive_members(paths)
+        for path in paths:
+            yield path
+
+    def _scan_dir(self, item, stats):
+        """ List a single directory, given its _WalkItem. Yield (path,
+            subdir_item) pairs: subdir_item is None for found files, and a
+            _WalkItem for subdirectories the walk should descend into.
+            Debug counters are added to stats.
+        """
+        if self.max_depth is None:
+            descend = True
+        elif item.depth >= self.max_depth:
+            # Only when max_depth is 0: the root isn't even listed
+            return
+        else:
+            descend = item.depth + 1 < self.max_depth
+
+        dirpath = item.path
+        if self.dir_callback is not None:
+            self.dir_callback(dirpath)
+        try:
+            if self._dir_cache is not None:
+                scandir_it = iter(self._dir_cache.scandir(dirpath))
+            else:
+                scandir_it = os.scandir(dirpath)
+        except OSError:
+            return
+        stats['dirs_scanned'] += 1
+        # With shard_subtrees, the entries of the roots are split between
+        # the shards.
+        shard_entries = (self.shard is not None and self.shard_subtrees and
+                         item.depth == 0)
+
+        ignore_context = item.ignore_context
+        if self.use_ignore_files or self.walk_order == 'sorted':
+            # The whole listing has to be read before any of it is used: to
+            # sort it, or because the ignore files of this directory apply to
+            # all its entries.
+            try:
+                entries = list(scandir_it)
+            except OSError:
+                entries = []
+            finally:
+                if hasattr(scandir_it, 'close'):
+                    scandir_it.close()
+            if self.walk_order == 'sorted':
+                entries.sort(key=lambda entry: entry.name)
+            scandir_it = iter(entries)
+
+        if self.use_ignore_files:
+            ignore_context = self._dir_ignore_context(
+                dirpath, ignore_context,
+                set(entry.name for entry in entries))
+            if ignore_context is None:
+                return
+
+        try:
+            while True:
+                try:
+                    entry = next(scandir_it)
+                except StopIteration:
+                    break
+                except OSError:
+                    # Problem reading the rest of the directory
+                    break
+                stats['entries_seen'] += 1
+
+                if (shard_entries and
+                        not self._path_in_shard(entry.name)):
+                    continue
+
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    # Like os.walk, don't descend into symlinks to
+                    # directories unless asked to.
+                    if descend and (self.follow_symlinks or
+                                    not entry.is_symlink()):
+                        if entry.name in self.ignore_dirs:
+                            continue
+                        states = self._descend_ignore_paths(
+                            item.ignore_path_states, entry.name)
+                        if states is None:
+                            continue
+                        if (ignore_context and
+                                is_ignored(ignore_context, entry.name, True)):
+                            stats['dirs_pruned'] += 1
+                            continue
+                        dev = None
+                        if self._seen is not None:
+                            # Also catches cycles: the ancestors of this
+                            # directory were all seen.
+                            try:
+                                st = entry.stat()
+                            except OSError:
+                                continue
+                            if not self._first_visit((st.st_dev, st.st_ino)):
+                                continue
+                            dev = st.st_dev
+                        yield entry.path, _WalkItem(
+                            entry.path,
+                            descend_ignore_context(ignore_context, entry.name),
+                            states,
+                            dev,
+                            item.depth + 1)
+                    continue
+
+                if not self._name_is_found(entry.path):
+                    continue
+                if (ignore_context and
+                        is_ignored(ignore_context, entry.name, False)):
+                    continue
+                # Only symlinks can point to files that don't exist, so
+                # only they need to be checked with an actual stat (unless
+                # the file has to be stat-ed anyway).
+                is_symlink = entry.is_symlink()
+                if self._seen is not None:
+                    if is_symlink:
+                        try:
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        key = (st.st_dev, st.st_ino)
+                    else:
+                        # A file is on the device of its directory, and the
+                        # inode comes with the listing.
+                        key = (item.dev, entry.inode())
+                    if not self._first_visit(key):
+                        continue
+                elif is_symlink and not self._has_stat_bounds:
+                    if not os.path.exists(entry.path):
+                        continue
+                if not is_symlink and not self._has_stat_bounds:
+                    stats['stats_saved'] += 1
+                if not self._file_properties_are_found(entry.path, entry):
+                    continue
+                yield entry.path, None
+        finally:
+            if hasattr(scandir_it, 'close'):
+                scandir_it.close()
+
+    # Limit for the size of the basename memo; it's cleared when reached.
+    BASENAME_MEMO_SIZE = 100000
+
+    def _classify_basename(self, basename):
+        """ Compute and memoize the basename-only part of _file_is_found:
+            (ext_ignored, ext_searched, in_ignore, in_search, in_exclude,
+            in_include).
+        """
+        ext = os.path.splitext(basename)[1]
+        typed_name = basename
+        if self.search_compressed and ext in COMPRESSED_EXTENSIONS:
+            typed_name = basename[:-len(ext)]
+            ext = os.path.splitext(typed_name)[1]
+        result = (
+            ext in self.ignore_extensions,
+            ext in self.search_extensions,
+            self._ignore_patterns.basename_matches(typed_name),
+            self._search_patterns.basename_matches(typed_name),
+            self._exclude_patterns.basename_matches(basename),
+            self._include_patterns.basename_matches(basename))
+        if len(self._basename_memo) >= self.BASENAME_MEMO_SIZE:
+            self._basename_memo.clear()
+        self._basename_memo[basename] = result
+        return result
+
+    def _path_matches(self, path_patterns, index, dirpart, filename):
+        """ Run the patterns of path_patterns that need more than the
+            basename of filename. index identifies path_patterns in the
+            per-directory memo.
+        """
+        if path_patterns.full and path_patterns.full.search(filename):
+            return True
+        if path_patterns.dir is None:
+            return False
+        last_dir, dir_results = self._last_dir_memo
+        if last_dir != dirpart:
+            dir_results = [None] * 4
+            self._last_dir_memo = (dirpart, dir_results)
+        result = dir_results[index]
+        if result is None:
+            result = dir_results[index] = bool(
+                path_patterns.dir.search(dirpart))
+        return result
+
+    def _stat_is_found(self, st):
+        """ Check the size and time bounds against a stat result.
+        """
+        if self.min_filesize is not None and st.st_size < self.min_filesize:
+            return False
+        if self.max_filesize is not None and st.st_size > self.max_filesize:
+            return False
+        if self.newer_than is not None and st.st_mtime <= self.newer_than:
+            return False
+        if self.older_than is not None and st.st_mtime >= self.older_than:
+            return False
+        return True
 
     def _merge_regex_patterns(self, patterns):
         """ patterns is a sequence of strings describing regexes. Merge
@@ -122,63 +1019,120 @@ class FileFinder(object):
         one_pattern = '|'.join('(?:{0})'.format(p) for p in patterns)
         return re.compile(one_pattern)
 
-    def _should_ignore_dir(self, dirpath):
-        """ Should the given directory be ignored?
+    def is_found(self, filename):
+        """ Would the walk of the roots find this file? Besides the rules
+            for the file itself, those of its place under its root are
+            checked: the directories above it, ignore files, max_depth and
+            the shard. Files that aren't in any of the roots aren't found.
         """
-        if os.path.split(dirpath)[1] in self.ignore_dirs:
-            return True
-        elif len(self.ignore_paths) > 0:
-            # If we have paths to ignore, things are more difficult...
-            for ignored_path in self.ignore_paths:
-                found_i = dirpath.rfind(ignored_path)
-                if (found_i == 0 or (
-                    found_i > 0 and dirpath[found_i - 1] == os.sep)
-                    ):
-                    return True
-        return False
-
-    def _file_is_found(self, filename):
+        if filename in self.roots:
+            return (self._path_in_shard(filename.replace(os.sep, '/')) and
+                    self._file_is_found(filename))
+        root, item = self._walk_item_of(os.path.dirname(filename))
+        if item is None:
+            return False
+        if self.max_depth is not None and item.depth >= self.max_depth:
+            return False
+        if self.shard is not None:
+            relpath = filename[len(root):].lstrip(os.sep).replace(os.sep, '/')
+            if self.shard_subtrees:
+                relpath = relpath.partition('/')[0]
+            if not self._path_in_shard(relpath):
+                return False
+        if not self._name_is_found(filename):
+            return False
+        ignore_context = self._listed_ignore_context(item)
+        if ignore_context is None or (ignore_context and is_ignored(
+                ignore_context, os.path.basename(filename), False)):
+            return False
+        return self._file_properties_are_found(filename)
+
+    def _file_is_found(self, filename, entry=None):
         """ Should this file be "found" according to the search rules?
+            entry is the file's os.DirEntry, if there is one.
         """
-        # Tries to eliminate the file by all the given search rules. If the
-        # file survives until the end, it's found
-        root, ext = os.path.splitext(filename)
+        return (self._name_is_found(filename) and
+                self._file_properties_are_found(filename, entry))
+
+    def _name_is_found(self, filename):
+        """ Is the name of this file "found" according to the search rules?
+        """
+        # The decision is made on the basename as much as possible. The
+        # classification of the basename (its extension and the results of
+        # all the patterns that only need the basename) is memoized, and the
+        # patterns that need the rest of the path only run when they can
+        # still change the answer.
+        i = filename.rfind(os.sep)
+        if os.altsep:
+            i = max(i, filename.rfind(os.altsep))
+        basename = filename[i + 1:]
+        basename_class = self._basename_memo.get(basename)
+        if basename_class is None:
+            basename_class = self._classify_basename(basename)
+        (ext_ignored, ext_searched, in_ignore, in_search, in_exclude,
+            in_include) = basename_class
 
         # The ignores take precedence.
-        if (ext in self.ignore_extensions or
-            self.ignore_pattern and self.ignore_pattern.search(filename)
-            ):
+        if ext_ignored or in_ignore:
+            return False
+        dirpart = filename[:max(i, 0)]
+        if self._ignore_patterns.needs_path and self._path_matches(
+                self._ignore_patterns, 0, dirpart, filename):
             return False
 
+        # The members of archives go through the rest of the rules
+        # themselves (see _archive_members). Archives inside archives are
+        # just members.
+        if (    self.search_archives and
+                archive_format(basename) is not None and
+                split_member_path(filename) is None):
+            return not (in_exclude or (self._exclude_patterns.needs_path and
+                self._path_matches(
+                    self._exclude_patterns, 2, dirpart, filename)))
+
         # Try to find a match either in search_extensions OR search_pattern.
         # If neither is specified, we have a match by definition.
-        have_match = False
-        if not self.search_extensions and not self.search_pattern:
-            # Both empty: means all extensions and patterns are interesting.
-            have_match = True
-        if self.search_extensions and ext in self.search_extensions:
-            have_match = True
-        if self.search_pattern and self.search_pattern.search(filename):
-           have_match = True
-
-        if not have_match:
+        if not (self._search_all_names or ext_searched or in_search or (
+                self._search_patterns.needs_path and self._path_matches(
+                    self._search_patterns, 1, dirpart, filename))):
             return False
 
         # Now onto filters. Only files matches that don't trigger the exclude
         # filters and do trigger the include filters (if any exists) go through.
-        if (self.filter_exclude_pattern and
-            self.filter_exclude_pattern.search(filename)
-            ):
+        if in_exclude or (self._exclude_patterns.needs_path and
+                self._path_matches(
+                    self._exclude_patterns, 2, dirpart, filename)):
             return False
 
-        if (self.filter_include_pattern and
-            not self.filter_include_pattern.search(filename)
-            ):
+        if self._include_patterns and not (in_include or (
+                self._include_patterns.needs_path and self._path_matches(
+                    self._include_patterns, 3, dirpart, filename))):
             return False
 
+        return True
+
+    def _file_properties_are_found(self, filename, entry=None):
+        """ Check the rules that look at the file itself rather than its
+            name: the size and time bounds, and find_only_text_files. The
+            cheaper checks go first.
+        """
+        if self._has_stat_bounds:
+            try:
+                # DirEntry.stat caches its result, and on some platforms
+                # it comes with the directory listing.
+                st = entry.stat() if entry is not None else os.stat(filename)
+            except OSError:
+                return False
+            if not self._stat_is_found(st):
+                return False
+
         # If find_only_text_files, open the file and try to determine whether
-        # it's text or binary.
-        if self.find_only_text_files:
+        # it's text or binary. For archives, the members are checked instead
+        # (see _archive_members).
+        if self.find_only_text_files and not (
+                self.search_archives and
+                archive_format(filename) is not None and
+                split_member_path(filename) is None):
             try:
                 with open(filename, 'rb') as f:
                     if not istextfile(f):
@@ -191,6 +1145,113 @@ class FileFinder(object):
         return True
 
 
+class _PathPatterns(object):
+    """ A set of regex patterns searched in file paths, split by how much of
+        the path they need to see:
+
+        - Patterns that can't match a path separator, and where every match
+          ends at the end of the path (like r'~$'), can only match inside the
+          basename. They're searched in the basename only.
+        - Other patterns that can't match a path separator and have no
+          anchors or lookarounds (like 'Makefile') match if they match either
+          the basename or the directory part. They're searched in each one
+          separately, so that both results can be reused.
+        - Everything else is searched in the full path.
+    """
+    def __init__(self, patterns):
+        basename_only = []
+        local = []
+        full = []
+        seps = os.sep + (os.altsep or '') + '/'
+        for pattern in patterns:
+            parsed = regexinfo.parse(pattern)
+            if parsed is None or regexinfo.can_match_any_of(parsed, seps):
+                full.append(pattern)
+            elif regexinfo.is_end_anchored(parsed):
+                basename_only.append(pattern)
+            elif not regexinfo.has_assertions(parsed):
+                local.append(pattern)
+            else:
+                full.append(pattern)
+        self.patterns = list(patterns)
+        self.basename = _merge_patterns(basename_only + local)
+        self.dir = _merge_patterns(local)
+        self.full = _merge_patterns(full)
+        self.needs_path = self.dir is not None or self.full is not None
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def basename_matches(self, basename):
+        return bool(self.basename and self.basename.search(basename))
+
+
+def _merge_patterns(patterns):
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:{0})'.format(p) for p in patterns))
+
+
+# A directory waiting to be listed by the walk.
+#
+# path:
+#   Path of the directory
+#
+# ignore_context:
+#   Ignore rules that apply to the entries of the directory (see
+#   ignorefiles.is_ignored)
+#
+# ignore_path_states:
+#   Nodes of the ignore_paths trie matching the trailing components of the
+#   path (see FileFinder._descend_ignore_paths)
+#
+# dev:
+#   st_dev of the directory, when the search tracks visited inodes (None
+#   otherwise)
+#
+# depth:
+#   Number of directories between the root and this directory (0 for the
+#   root)
+#
+_WalkItem = collections.namedtuple('_WalkItem', [
+    'path', 'ignore_context', 'ignore_path_states', 'dev', 'depth'])
+
+
+class _PathTrieNode(object):
+    """ Node in a trie of path components. A terminal node ends a path.
+    """
+    __slots__ = ('children', 'terminal')
+
+    def __init__(self):
+        self.children = {}
+        self.terminal = False
+
+    def add(self, components):
+        node = self
+        for component in components:
+            node = node.children.setdefault(component, _PathTrieNode())
+        node.terminal = True
+
+
+def _split_path(path):
+    """ Split a path into its non-empty components.
+    """
+    if os.altsep:
+        path = path.replace(os.altsep, os.sep)
+    return [c for c in path.split(os.sep) if c]
+
+
+class _WalkError(object):
+    """ Carries an exception raised in a walker thread to the consumer.
+    """
+    def __init__(self, exc):
+        self.exc = exc
+
+
+# Marks the end of a parallel walk in the results queue
+_WALK_DONE = object()
+
+
 if __name__ == '__main__':
     import sys
     ff = FileFinder(sys.argv[1:], ignore_dirs=[], recurse=True)
@@ -0,0 +1,172 @@
+#-------------------------------------------------------------------------------
+# pss: gitindex.py
+#
+# Reading the list of tracked files directly from a git index file
+# (.git/index), without running git and without listing directories.
+#
+# Eli Bendersky (eliben@gmail.com)
+# This code is in the public domain
+#-------------------------------------------------------------------------------
+import os
+import struct
+
+
+class GitIndexError(Exception):
+    pass
+
+
+# Entry modes that aren't regular files in the work tree
+_MODE_GITLINK = 0o160000     # submodule
+_MODE_SPARSE_DIR = 0o040000  # directory entry of a sparse index
+
+_FLAG_EXTENDED = 0x4000
+_EXTENDED_FLAG_SKIP_WORKTREE = 0x4000
+
+# Size of the fixed part of an entry, up to the object hash: ctime, mtime,
+# dev, ino, mode, uid, gid, size - all 32-bit.
+_ENTRY_STAT_SIZE = 40
+
+# Signature of the extension of split indexes (core.splitIndex), which only
+# hold the changes to a shared index
+_EXTENSION_LINK = b'link'
+
+
+def find_git_worktree(path):
+    """ Find the git work tree containing path. Return a pair of
+        (toplevel, gitdir): the top directory of the work tree and its git
+        directory. Return None if path isn't inside a work tree.
+    """
+    path = os.path.abspath(path)
+    while True:
+        dotgit = os.path.join(path, '.git')
+        if os.path.isdir(dotgit):
+            return path, dotgit
+        elif os.path.isfile(dotgit):
+            # Linked work trees and submodules have a .git file pointing to
+            # the real git directory.
+            try:
+                with open(dotgit, 'r') as f:
+                    line = f.readline().strip()
+            except OSError:
+                return None
+            if not line.startswith('gitdir:'):
+                return None
+            gitdir = line[len('gitdir:'):].strip()
+            return path, os.path.normpath(os.path.join(path, gitdir))
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def read_index_paths(gitdir):
+    """ Generate the paths of the files tracked in the index of gitdir, as
+        strings relative to the top of the work tree with '/' separators.
+        Index format versions 2, 3 and 4 are supported. Submodules, files
+        in conflict (reported once) and files excluded from a sparse
+        checkout are skipped.
+
+        Raise GitIndexError if the index can't be read or parsed, or if it's
+        a split index (which doesn't list all the files by itself).
+    """
+    try:
+        with open(os.path.join(gitdir, 'index'), 'rb') as f:
+            data = f.read()
+    except OSError as err:
+        raise GitIndexError('cannot read index: %s' % err)
+
+    if len(data) < 12 or data[:4] != b'DIRC':
+        raise GitIndexError('not a git index file')
+    version, count = struct.unpack_from('>LL', data, 4)
+    if version not in (2, 3, 4):
+        raise GitIndexError('unsupported index version %d' % version)
+    hash_size = _object_hash_size(gitdir)
+
+    pos = 12
+    name = b''
+    prev_yielded = None
+    paths = []
+    try:
+        for _ in range(count):
+            mode, = struct.unpack_from('>L', data, pos + 24)
+            flags, = struct.unpack_from('>H', data,
+                                        pos + _ENTRY_STAT_SIZE + hash_size)
+            namepos = pos + _ENTRY_STAT_SIZE + hash_size + 2
+            extended_flags = 0
+            if flags & _FLAG_EXTENDED and version >= 3:
+                extended_flags, = struct.unpack_from('>H', data, namepos)
+                namepos += 2
+
+            if version == 4:
+                # The name is prefix-compressed against the previous entry's
+                # name, and entries aren't padded.
+                strip, namepos = _read_varint(data, namepos)
+                end = data.index(b'\0', namepos)
+                name = name[:len(name) - strip] + data[namepos:end]
+                pos = end + 1
+            else:
+                end = data.index(b'\0', namepos)
+                name = data[namepos:end]
+                # Entries are padded with 1-8 NULs to a multiple of 8 bytes
+                pos += (end - pos + 8) & ~7
+
+            if (mode == _MODE_GITLINK or mode == _MODE_SPARSE_DIR or
+                    extended_flags & _EXTENDED_FLAG_SKIP_WORKTREE):
+                continue
+            # Entries of a file in conflict (several stages) are adjacent
+            if name == prev_yielded:
+                continue
+            prev_yielded = name
+            paths.append(os.fsdecode(name))
+
+        # The extensions follow the entries, up to the checksum of the file
+        end = len(data) - hash_size
+        while pos + 8 <= end:
+            signature = data[pos:pos + 4]
+            size, = struct.unpack_from('>L', data, pos + 4)
+            if signature == _EXTENSION_LINK:
+                raise GitIndexError('split index files are not supported')
+            pos += 8 + size
+    except (struct.error, ValueError, IndexError):
+        raise GitIndexError('corrupt index file')
+    for path in paths:
+        yield path
+
+
+def _read_varint(data, pos):
+    """ Read the variable-length offset encoding used by index version 4.
+        Return (value, new_pos).
+    """
+    c = data[pos]
+    pos += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, pos
+
+
+def _object_hash_size(gitdir):
+    """ Size in bytes of object hashes in the repository: 32 for SHA-256
+        repositories, 20 for SHA-1 ones.
+    """
+    configs = [os.path.join(gitdir, 'config')]
+    try:
+        # Linked work trees share the config of the main repository
+        with open(os.path.join(gitdir, 'commondir'), 'r') as f:
+            commondir = os.path.join(gitdir, f.read().strip())
+        configs.append(os.path.join(commondir, 'config'))
+    except OSError:
+        pass
+    for config in configs:
+        try:
+            with open(config, 'r') as f:
+                for line in f:
+                    key, _, value = line.partition('=')
+                    if (key.strip().lower() == 'objectformat' and
+                            value.strip().lower() == 'sha256'):
+                        return 32
+        except OSError:
+            pass
+    return 20
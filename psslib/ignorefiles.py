@@ -0,0 +1,240 @@
+#-------------------------------------------------------------------------------
+# pss: ignorefiles.py
+#
+# Support for .gitignore-style ignore files and for cache directory tags.
+# The glob patterns in ignore files are compiled into regexes once, when the
+# file is read.
+#
+# Eli Bendersky (eliben@gmail.com)
+# This code is in the public domain
+#-------------------------------------------------------------------------------
+import os
+import re
+
+
+# Names of ignore files, in order of increasing precedence within the same
+# directory
+IGNORE_FILE_NAMES = ('.gitignore', '.ignore')
+
+# See https://bford.info/cachedir/
+CACHEDIR_TAG_NAME = 'CACHEDIR.TAG'
+_CACHEDIR_TAG_SIGNATURE = b'Signature: 8a477f597d28d172789f06886806bc55'
+
+
+class IgnoreRules(object):
+    """ The compiled rules of a single ignore file.
+
+        Paths are matched relative to the directory the ignore file is in,
+        with '/' as the separator.
+    """
+    def __init__(self, lines):
+        # List of (regex, negated, dir_only) in the order of the file
+        self.rules = []
+        for line in lines:
+            rule = _compile_rule(line)
+            if rule is not None:
+                self.rules.append(rule)
+        # All the patterns merged, for quickly rejecting paths none of the
+        # rules apply to (the common case).
+        if self.rules:
+            self._any = re.compile('|'.join(
+                '(?:%s)' % regex.pattern for regex, _, _ in self.rules), re.S)
+        else:
+            self._any = None
+
+    def match(self, relpath, is_dir):
+        """ Decide whether relpath is ignored by these rules. Return True if
+            it's ignored, False if it's explicitly un-ignored (by a negated
+            rule) and None if no rule applies.
+        """
+        if self._any is None or not self._any.match(relpath):
+            return None
+        # As in git, the last matching rule wins
+        for regex, negated, dir_only in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relpath):
+                return not negated
+        return None
+
+
+def load_ignore_rules(path):
+    """ Read and compile the ignore file at path. Return an IgnoreRules
+        object, or None if the file can't be read or has no rules.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    rules = IgnoreRules(data.decode('utf-8', 'replace').splitlines())
+    return rules if rules.rules else None
+
+
+def is_ignored(ignore_context, name, is_dir):
+    """ Check the entry called name, in a directory with the given
+        ignore_context, against the ignore rules.
+
+        ignore_context is a tuple of (IgnoreRules, prefix) pairs, ordered by
+        increasing precedence (deeper ignore files come later). prefix is the
+        path of the directory relative to the directory of the ignore file,
+        ending with '/' (or empty).
+    """
+    for rules, prefix in reversed(ignore_context):
+        result = rules.match(prefix + name, is_dir)
+        if result is not None:
+            return result
+    return False
+
+
+def descend_ignore_context(ignore_context, name):
+    """ The ignore context for subdirectory name, given the context of its
+        parent directory.
+    """
+    return tuple((rules, prefix + name + '/')
+                 for rules, prefix in ignore_context)
+
+
+def ancestor_ignore_context(dirpath):
+    """ Collect the ignore rules that apply to dirpath from its ancestors, up
+        to the top of the git work tree containing it (if any). The rules of
+        dirpath itself are not included.
+    """
+    dirpath = os.path.abspath(dirpath)
+    ancestors = []
+    path = dirpath
+    while True:
+        if os.path.exists(os.path.join(path, '.git')):
+            break
+        parent = os.path.dirname(path)
+        if parent == path:
+            # Not inside a git work tree: only dirpath and its
+            # subdirectories have applicable ignore files.
+            return ()
+        path = parent
+        ancestors.append(path)
+
+    toplevel = path
+    context = []
+    exclude_rules = load_ignore_rules(
+        os.path.join(toplevel, '.git', 'info', 'exclude'))
+    if exclude_rules is not None:
+        context.append((exclude_rules, _relative_prefix(toplevel, dirpath)))
+    for ancestor in reversed(ancestors):
+        for name in IGNORE_FILE_NAMES:
+            rules = load_ignore_rules(os.path.join(ancestor, name))
+            if rules is not None:
+                context.append((rules, _relative_prefix(ancestor, dirpath)))
+    return tuple(context)
+
+
+def is_cachedir(dirpath):
+    """ Is dirpath (which has a CACHEDIR.TAG file) a tagged cache directory?
+    """
+    try:
+        with open(os.path.join(dirpath, CACHEDIR_TAG_NAME), 'rb') as f:
+            return f.read(len(_CACHEDIR_TAG_SIGNATURE)) == _CACHEDIR_TAG_SIGNATURE
+    except OSError:
+        return False
+
+
+def _relative_prefix(base, path):
+    if base == path:
+        return ''
+    return os.path.relpath(path, base).replace(os.sep, '/') + '/'
+
+
+def _compile_rule(line):
+    """ Compile a single line of an ignore file into a (regex, negated,
+        dir_only) triple. Return None for blank lines and comments.
+    """
+    # Trailing spaces are ignored unless escaped
+    stripped = line.rstrip(' ')
+    if stripped.endswith('\\') and len(stripped) < len(line):
+        stripped += ' '
+    line = stripped.rstrip('\r\n')
+    if not line or line.startswith('#'):
+        return None
+
+    negated = False
+    if line.startswith('!'):
+        negated = True
+        line = line[1:]
+    elif line.startswith('\\!') or line.startswith('\\#'):
+        line = line[1:]
+
+    dir_only = False
+    if line.endswith('/') and not line.endswith('\\/'):
+        dir_only = True
+        line = line.rstrip('/')
+    if not line:
+        return None
+
+    # A pattern with a slash (other than a trailing one) is relative to the
+    # directory of the ignore file. Otherwise it matches at any level.
+    anchored = '/' in line
+    line = line.lstrip('/')
+    if line.startswith('**/'):
+        anchored = False
+        line = line[3:]
+    regex = _translate_glob(line)
+    if not anchored:
+        regex = '(?:.*/)?' + regex
+    return re.compile(regex + r'\Z', re.S), negated, dir_only
+
+
+def _translate_glob(glob):
+    """ Translate a gitignore glob to a regex.
+    """
+    out = []
+    i, n = 0, len(glob)
+    while i < n:
+        c = glob[i]
+        if c == '*':
+            if glob.startswith('**', i):
+                before_ok = i == 0 or glob[i - 1] == '/'
+                after = glob[i + 2:i + 3]
+                if before_ok and after == '/':
+                    # '**/' matches zero or more directories
+                    out.append('(?:.*/)?')
+                    i += 3
+                    continue
+                elif before_ok and after == '':
+                    # Trailing '/**' matches everything inside
+                    out.append('.*')
+                    i += 2
+                    continue
+            out.append('[^/]*')
+            while i < n and glob[i] == '*':
+                i += 1
+            continue
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if j < n and glob[j] in '!^':
+                j += 1
+            if j < n and glob[j] == ']':
+                j += 1
+            while j < n and glob[j] != ']':
+                j += 1
+            if j >= n:
+                out.append(re.escape(c))
+            else:
+                body = glob[i + 1:j]
+                negate = body[:1] in ('!', '^')
+                if negate:
+                    body = body[1:]
+                # A ']' right after the '[' (or the '!') is a member, and '['
+                # is one anywhere; re needs both escaped where they are.
+                body = (body.replace('\\', '\\\\').replace('[', '\\[')
+                        .replace(']', '\\]'))
+                out.append('[%s%s]' % ('^/' if negate else '', body))
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            out.append(re.escape(glob[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
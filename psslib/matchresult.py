@@ -10,10 +10,12 @@ from collections import namedtuple
 
 
 # matching_line:
-#   The line that matched the pattern
+#   The line that matched the pattern. In multiline searches, a match can
+#   span several lines; they are all in matching_line then, each with its
+#   newline (and the column ranges count from the start of the first).
 #
 # matching_lineno:
-#   Line number of the matching line
+#   Line number of the matching line (the first one, when there are several)
 #
 # matching_column_ranges:
 #   A list of pairs. Its length is the amount of matches for the pattern in the
@@ -22,8 +24,14 @@ from collections import namedtuple
 #   Python.
 #   I.e. range (2, 5) means columns 2,3,4 matched
 #
+# matching_patterns:
+#   When several patterns are searched for at once, a list with the pattern
+#   that matched each of the column ranges. None otherwise.
+#
 MatchResult = namedtuple('MatchResult', ' '.join([
                 'matching_line',
                 'matching_lineno',
-                'matching_column_ranges']))
+                'matching_column_ranges',
+                'matching_patterns']))
+MatchResult.__new__.__defaults__ = (None,)
 
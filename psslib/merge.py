@@ -0,0 +1,67 @@
+#-------------------------------------------------------------------------------
+# pss: merge.py
+#
+# Merging the outputs of sharded searches (pss --shard I/N) into the output
+# of a single search.
+#
+# Sharded searches put a record before the output of each file (see
+# file_record), holding the file's path and the number of the root it was
+# found under. The output is split into per-file blocks at these records, and
+# the blocks are ordered by root, then as a depth-first walk with sorted
+# directory entries finds the files (pss --walk-order sorted): the files of a
+# directory in name order, then its subdirectories in name order.
+#
+# Eli Bendersky (eliben@gmail.com)
+# This code is in the public domain
+#-------------------------------------------------------------------------------
+import os
+import re
+
+
+# File paths can't contain NUL characters, so the record can't be confused
+# with any path or with the lines of text files.
+_RECORD_FORMAT = '\x00pss-file\x00%d\x00%s\x00\n'
+
+_RECORD = re.compile('\x00pss-file\x00(\\d+)\x00([^\x00]*)\x00\n')
+
+
+def file_record(source, filename):
+    """ The record that precedes the output of the file filename in the
+        output of a sharded search. source is the number of the root (or
+        --files-from path) it was found under, in the order they're searched
+        (see FileFinder.source_index).
+    """
+    return _RECORD_FORMAT % (source, filename)
+
+
+def merge_outputs(texts):
+    """ Merge the outputs of several sharded pss runs (strings, without
+        colors). Return the merged output as a string, without the records.
+        Raise ValueError if a text isn't the output of a sharded run.
+
+        Text that comes before the output of the first file (the same in all
+        the outputs, such as that of --explain) is kept once.
+    """
+    preamble = None
+    blocks = []
+    for text in texts:
+        parts = _RECORD.split(text)
+        if len(parts) == 1 and text:
+            raise ValueError('not the output of a --shard search')
+        if preamble is None and parts[0]:
+            preamble = parts[0]
+        for i in range(1, len(parts), 3):
+            source, filename, output = parts[i:i + 3]
+            blocks.append(((int(source), walk_order_key(filename)), output))
+    # sort is stable, so blocks of the same file keep their order
+    blocks.sort(key=lambda block: block[0])
+    return (preamble or '') + ''.join(output for _, output in blocks)
+
+
+def walk_order_key(path):
+    """ Sort key of path in the order of a depth-first walk with sorted
+        directory entries: the files of a directory come before the
+        contents of its subdirectories.
+    """
+    parts = re.split(r'[/\\]' if os.sep == '\\' else '/', path)
+    return tuple((1, part) for part in parts[:-1]) + ((0, parts[-1]),)
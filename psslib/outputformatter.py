@@ -36,6 +36,15 @@ class OutputFormatter(object):
         """
         raise NotImplementedError()
 
+    def changed_matching_line(self, matchresult, filename, change):
+        """ Called in watch mode, to emit a matching line that was added
+            (change is '+') or removed (change is '-') since the file was
+            last searched. By default, added lines are emitted with
+            matching_line, and removed lines aren't emitted.
+        """
+        if change == '+':
+            self.matching_line(matchresult, filename)
+
     def context_line(self, line, lineno, filename):
         """ Called to emit a context line.
         """
@@ -52,6 +61,20 @@ class OutputFormatter(object):
         """
         raise NotImplementedError()
 
+    def explanation(self, lines):
+        """ Called to emit the lines of text explaining how the search is
+            done (see ContentMatcher.explain), before any matches.
+        """
+        pass
+
+    def file_record(self, source, filename):
+        """ Called in sharded searches (pss --shard) before the output of
+            each file, to mark it for merging the outputs (see
+            merge.file_record). source is the number of the root the file
+            was found under.
+        """
+        pass
+
     def found_filename(self, filename):
         """ Called to emit a found filename when pss runs in file finding mode
             instead of line finding mode (emitting only the found files and not
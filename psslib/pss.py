@@ -10,11 +10,15 @@
 from __future__ import print_function
 import os, sys
 import optparse
+import time
+from datetime import datetime
 
 
 from psslib import __version__
 from psslib.driver import (pss_run, TYPE_MAP,
         IGNORED_DIRS, IGNORED_FILE_PATTERNS, PssOnlyFindFilesOption)
+from psslib.merge import merge_outputs
+from psslib.utils import read_path_list
 
 
 def main(argv=sys.argv, output_formatter=None):
@@ -38,6 +42,9 @@ def main(argv=sys.argv, output_formatter=None):
     except SystemExit:
         return 2
 
+    if options.merge:
+        return _merge_files(args)
+
     # Handle the various "only find files" options.
     #
     only_find_files = False
@@ -58,9 +65,33 @@ def main(argv=sys.argv, output_formatter=None):
         only_find_files = True
         only_find_files_option = PssOnlyFindFilesOption.FILES_WITHOUT_MATCHES
 
-    # The --match option sets the pattern explicitly, so it's not expected
-    # as an argument.
-    if options.match:
+    if options.watch and only_find_files:
+        print('<<--watch cannot be combined with -f, -g, -l or -L>>')
+        return 2
+    if options.watch and options.search_archives:
+        print('<<--watch cannot be combined with --search-archives>>')
+        return 2
+
+    # Patterns given with -e and --patterns-file are searched for together,
+    # along with the one given with --match.
+    patterns = list(options.patterns)
+    if options.patterns_file:
+        try:
+            with open(options.patterns_file, encoding='utf-8') as f:
+                patterns.extend(line.rstrip('\r\n') for line in f)
+        except (OSError, UnicodeDecodeError) as err:
+            print('<<cannot read %s: %s>>' % (options.patterns_file, err))
+            return 2
+        patterns = [p for p in patterns if p]
+        if not patterns:
+            print('<<no patterns in %s>>' % options.patterns_file)
+            return 2
+    if options.match and patterns:
+        patterns.insert(0, options.match)
+
+    # The --match, -e and --patterns-file options set the pattern explicitly,
+    # so it's not expected as an argument.
+    if options.match or patterns:
         search_pattern_expected = False
 
     # Handle the various --help options, or just print help if pss is called
@@ -83,12 +114,12 @@ def main(argv=sys.argv, output_formatter=None):
     # only root. If no search pattern is expected, the whole of 'args' is roots.
     #
     if not search_pattern_expected:
-        pattern = options.match or None
+        pattern = patterns or options.match or None
         roots = args
     else:
         pattern = args[0]
         roots = args[1:]
-    if len(roots) == 0:
+    if len(roots) == 0 and not options.files_from:
         roots = ['.']
 
     # Partition the type list to included types (--<type>) and excluded types
@@ -113,6 +144,23 @@ def main(argv=sys.argv, output_formatter=None):
     add_ignored_dirs = _splice_comma_names(options.ignored_dirs or [])
     remove_ignored_dirs = _splice_comma_names(options.noignored_dirs or [])
 
+    # With --files-from, the list of files is streamed into pss_run while it's
+    # being read.
+    #
+    files_from = None
+    files_from_stream = None
+    if options.files_from:
+        if options.files_from == '-':
+            files_from_stream = sys.stdin.buffer
+        else:
+            try:
+                files_from_stream = open(options.files_from, 'rb')
+            except OSError as err:
+                print('<<cannot open %s: %s>>' % (options.files_from, err))
+                return 2
+        files_from = read_path_list(
+            files_from_stream, b'\0' if options.null_separated else b'\n')
+
     # Finally, invoke pss_run with the default output formatter
     #
     try:
@@ -149,7 +197,26 @@ def main(argv=sys.argv, output_formatter=None):
                 show_column_of_first_match=options.show_column,
                 universal_newlines=options.universal_newlines,
                 ncontext_before=ncontext_before,
-                ncontext_after=ncontext_after)
+                ncontext_after=ncontext_after,
+                walk_threads=options.walk_threads,
+                use_dir_cache=options.dir_cache,
+                use_ignore_files=options.gitignore,
+                use_git_index=options.git_index,
+                files_from=files_from,
+                min_filesize=options.min_filesize,
+                max_filesize=options.max_filesize,
+                newer_than=options.newer_than,
+                older_than=options.older_than,
+                follow_symlinks=options.follow,
+                walk_order=options.walk_order,
+                max_depth=options.max_depth,
+                watch=options.watch,
+                explain=options.explain,
+                multiline=options.multiline,
+                search_zip=options.search_zip,
+                search_archives=options.search_archives,
+                shard=options.shard,
+                shard_subtrees=options.shard_subtrees)
     except KeyboardInterrupt:
         print('<<interrupted - exiting>>')
         return 2
@@ -158,6 +225,10 @@ def main(argv=sys.argv, output_formatter=None):
         return 2
     else:
         return 0 if match_found else 1
+    finally:
+        if (    files_from_stream is not None and
+                files_from_stream is not sys.stdin.buffer):
+            files_from_stream.close()
 
 
 DESCRIPTION = r'''
@@ -242,15 +313,46 @@ def parse_cmdline(cmdline_args):
     group_searching.add_option('-Q', '--literal',
         action='store_true', dest='literal', default=False,
         help='Quote all metacharacters; the pattern is literal')
+    group_searching.add_option('-z', '--search-zip',
+        action='store_true', dest='search_zip', default=False,
+        help='''Search the decompressed contents of gzip, bzip2 and xz
+        compressed files (foo.c.gz is searched as a C file)''')
+    group_searching.add_option('--search-archives',
+        action='store_true', dest='search_archives', default=False,
+        help='''Search the members of zip and tar archives (jars, wheels,
+        tarballs...) as files, without extracting them. Members are shown
+        as ARCHIVE!/MEMBER, and the file type options apply to their
+        names''')
+    group_searching.add_option('--multiline',
+        action='store_true', dest='multiline', default=False,
+        help='''Match the pattern against the whole contents of files, so
+        that matches can span several lines (^ and $ match at the start
+        and end of each line, and . matches newlines too)''')
     group_searching.add_option('-U', '--universal-newlines',
         action='store_true', dest='universal_newlines', default=False,
         help='Use PEP 278 universal newline support when opening files')
+    group_searching.add_option('--watch',
+        action='store_true', dest='watch', default=False,
+        help='''After searching, keep watching the searched files and
+        directories, and search files again when they change. Matches
+        that appear or disappear are shown with a + or - prefix''')
+    group_searching.add_option('--explain',
+        action='store_true', dest='explain', default=False,
+        help='''Before searching, show the engine chosen to search the
+        files for the pattern, and why''')
     optparser.add_option_group(group_searching)
 
     group_output = optparse.OptionGroup(optparser, 'Search output')
     group_output.add_option('--match',
         action='store', dest='match', metavar='PATTERN',
         help='Specify the search pattern explicitly')
+    group_output.add_option('-e', '--regexp',
+        action='append', dest='patterns', metavar='PATTERN', default=[],
+        help='''Specify a search pattern explicitly; can be given several
+        times, to search for lines matching any of the patterns''')
+    group_output.add_option('--patterns-file',
+        action='store', dest='patterns_file', metavar='FILE',
+        help='Search for the patterns listed in FILE, one per line (empty lines are ignored)')
     group_output.add_option('-m', '--max-count',
         action='store', dest='max_count', metavar='NUM', default=sys.maxsize,
         type='int', help='Stop searching in each file after NUM matches')
@@ -321,6 +423,49 @@ def parse_cmdline(cmdline_args):
     group_filefinding.add_option('-L', '--files-without-matches',
         action='store_true', dest='find_files_without_matches',
         help='Only print the names of found files that have no matches for the pattern')
+    group_filefinding.add_option('--walk-threads',
+        action='store', dest='walk_threads', metavar='NUM', default=1,
+        type='int',
+        help='List directories with NUM threads (files are found in no particular order)')
+    group_filefinding.add_option('--walk-order',
+        action='store', dest='walk_order', metavar='ORDER', default='depth',
+        type='choice',
+        choices=['depth', 'sorted', 'breadth', 'shallow', 'mtime'],
+        help='''Order of walking directories: depth (default), sorted
+        (depth-first with sorted directory entries),
+        breadth or shallow (files closer to the root first), or mtime
+        (recently modified directories and files first)''')
+    group_filefinding.add_option('--max-depth',
+        action='store', dest='max_depth', metavar='NUM', default=None,
+        type='int',
+        help='Descend at most NUM directories below the given roots (1 means no recursion)')
+    group_filefinding.add_option('--shard',
+        action='callback', callback=_shard_option_callback, type='string',
+        dest='shard', metavar='I/N', default=None,
+        help='''Split the files into N shards by a stable hash of their
+        paths, and only search shard number I (1 to N). The output of
+        each file is marked with a NUL-separated record; use --merge to
+        combine the outputs of all the shards''')
+    group_filefinding.add_option('--shard-subtrees',
+        action='store_true', dest='shard_subtrees', default=False,
+        help='With --shard, assign whole top-level files and directories to shards, so each shard only walks its own part of the tree')
+    group_filefinding.add_option('--merge',
+        action='store_true', dest='merge', default=False,
+        help='''Instead of searching, merge the outputs of sharded runs
+        saved in the given files (without colors), in the order of a
+        single run with --walk-order sorted''')
+    group_filefinding.add_option('--files-from',
+        action='store', dest='files_from', metavar='FILE',
+        help='Search the files listed in FILE (one per line, or "-" for stdin), in addition to the given roots')
+    group_filefinding.add_option('-0', '--null',
+        action='store_true', dest='null_separated', default=False,
+        help='File names in the --files-from list are separated by NUL characters')
+    group_filefinding.add_option('--git-index',
+        action='store_true', dest='git_index', default=False,
+        help='In git work trees, search the files tracked in the git index instead of walking the directories')
+    group_filefinding.add_option('--dir-cache',
+        action='store_true', dest='dir_cache', default=False,
+        help='Cache directory listings between runs (in ~/.cache/pss), and only re-list directories that changed')
     optparser.add_option_group(group_filefinding)
 
     group_inclusion = optparse.OptionGroup(optparser, 'File inclusion/exclusion')
@@ -336,16 +481,40 @@ def parse_cmdline(cmdline_args):
     group_inclusion.add_option('--noignore-dir',
         action='append', dest='noignored_dirs', metavar='name',
         help='Remove directory (or several comma-separated directories) from the list of ignored dirs')
+    group_inclusion.add_option('--gitignore',
+        action='store_true', dest='gitignore', default=False,
+        help='Skip files and directories excluded by .gitignore and .ignore files, and directories tagged with CACHEDIR.TAG')
     group_inclusion.add_option('-r', '-R', '--recurse',
         action='store_true', dest='recurse', default=True,
         help='Recurse into subdirectories (default)')
     group_inclusion.add_option('-n', '--no-recurse',
         action='store_false', dest='recurse',
         help='Do not recurse into subdirectories')
+    group_inclusion.add_option('--follow',
+        action='store_true', dest='follow', default=False,
+        help='Follow symbolic links to directories (each file is searched once, even if reached through several links)')
     group_inclusion.add_option('-t', '--textonly', '--nobinary',
         action='store_true', dest='textonly', default=False,
         help='''Restrict the search to only textual files.
         Warning: with this option the search is likely to run much slower''')
+    group_inclusion.add_option('--min-filesize',
+        action='callback', callback=_size_option_callback, type='string',
+        dest='min_filesize', metavar='SIZE', default=None,
+        help='Only search files of at least SIZE bytes (suffixes k, M and G are allowed)')
+    group_inclusion.add_option('--max-filesize',
+        action='callback', callback=_size_option_callback, type='string',
+        dest='max_filesize', metavar='SIZE', default=None,
+        help='Only search files of at most SIZE bytes (suffixes k, M and G are allowed)')
+    group_inclusion.add_option('--newer',
+        action='callback', callback=_time_option_callback, type='string',
+        dest='newer_than', metavar='TIME', default=None,
+        help='''Only search files modified after TIME: either an age
+        like 30m, 12h, 2d or 1w (s, m, h, d, w suffixes), or a date
+        like 2020-01-31 or "2020-01-31 12:00"''')
+    group_inclusion.add_option('--older',
+        action='callback', callback=_time_option_callback, type='string',
+        dest='older_than', metavar='TIME', default=None,
+        help='Only search files modified before TIME (same format as --newer)')
     group_inclusion.add_option('-G', '--include-pattern',
         action='append', dest='include_patterns', metavar='REGEX', default=[],
         help='Only search files that match REGEX')
@@ -414,6 +583,93 @@ def _splice_comma_names(namelist):
     return newlist
 
 
+_SIZE_SUFFIXES = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+_AGE_SUFFIXES = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+_DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S',
+                 '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S')
+
+
+def _shard_option_callback(option, opt_str, value, parser):
+    """ Parse I/N into a pair (I, N) with 1 <= I <= N.
+    """
+    index, _, count = value.partition('/')
+    try:
+        shard = (int(index), int(count))
+    except ValueError:
+        shard = None
+    if shard is None or not 1 <= shard[0] <= shard[1]:
+        raise optparse.OptionValueError(
+            'option %s: invalid shard %r (expected I/N with 1 <= I <= N)' %
+            (opt_str, value))
+    setattr(parser.values, option.dest, shard)
+
+
+def _merge_files(paths):
+    """ Implement --merge: print the merged outputs saved in paths. Return
+        the exit code.
+    """
+    texts = []
+    for path in paths:
+        try:
+            with open(path, 'r', errors='surrogateescape', newline='') as f:
+                texts.append(f.read())
+        except OSError as err:
+            print('<<cannot open %s: %s>>' % (path, err))
+            return 2
+    try:
+        merged = merge_outputs(texts)
+    except ValueError as err:
+        print('<<%s>>' % err)
+        return 2
+    sys.stdout.write(merged)
+    return 0 if merged else 1
+
+
+def _size_option_callback(option, opt_str, value, parser):
+    """ Parse a file size like 100, 64k or 1.5M into a number of bytes.
+    """
+    text = value.strip().lower()
+    if text.endswith('b'):
+        text = text[:-1]
+    suffix = text[-1:] if text[-1:] in _SIZE_SUFFIXES else ''
+    try:
+        size = float(text[:len(text) - len(suffix)])
+    except ValueError:
+        size = -1
+    if size < 0:
+        raise optparse.OptionValueError(
+            'option %s: invalid size: %r' % (opt_str, value))
+    setattr(parser.values, option.dest, int(size * _SIZE_SUFFIXES[suffix]))
+
+
+def _time_option_callback(option, opt_str, value, parser):
+    """ Parse an age (2d) or a local date (2020-01-31) into a time in
+        seconds since the epoch.
+    """
+    text = value.strip()
+    timestamp = None
+    if text[-1:].lower() in _AGE_SUFFIXES:
+        try:
+            age = float(text[:-1])
+        except ValueError:
+            pass
+        else:
+            timestamp = time.time() - age * _AGE_SUFFIXES[text[-1].lower()]
+    else:
+        for fmt in _DATE_FORMATS:
+            try:
+                timestamp = datetime.strptime(text, fmt).timestamp()
+                break
+            except ValueError:
+                pass
+    if timestamp is None:
+        raise optparse.OptionValueError(
+            'option %s: invalid time: %r' % (opt_str, value))
+    setattr(parser.values, option.dest, timestamp)
+
+
 class PssOptionParser(optparse.OptionParser):
     """Option parser that separates using --help and --version from
        using invalid options.
@@ -0,0 +1,305 @@
+#-------------------------------------------------------------------------------
+# pss: regexinfo.py
+#
+# Static analysis of regular expressions, used to decide when cheaper
+# matching strategies give the same results as running the full regex.
+#
+# Eli Bendersky (eliben@gmail.com)
+# This code is in the public domain
+#-------------------------------------------------------------------------------
+import warnings
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:
+    # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+_c = sre_constants
+
+_REPEAT_OPS = frozenset(
+    getattr(_c, name) for name in
+    ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT') if hasattr(_c, name))
+
+_NEWLINE = ord('\n')
+
+# Zero-width assertions that behave the same at the edges of a line whether
+# it's matched alone or in a buffer with other lines (with re.MULTILINE): ^,
+# $, \b and \B
+_LINE_AT_CODES = frozenset([_c.AT_BEGINNING, _c.AT_END, _c.AT_BOUNDARY,
+                            _c.AT_NON_BOUNDARY])
+
+# Checks for the characters matched by categories (\d, \s, \w and their
+# negations). Unknown categories are assumed to match anything.
+_CATEGORY_CHECKS = {
+    _c.CATEGORY_DIGIT: lambda ch: ch.isdigit(),
+    _c.CATEGORY_NOT_DIGIT: lambda ch: not ch.isdigit(),
+    _c.CATEGORY_SPACE: lambda ch: ch.isspace(),
+    _c.CATEGORY_NOT_SPACE: lambda ch: not ch.isspace(),
+    _c.CATEGORY_WORD: lambda ch: ch.isalnum() or ch == '_',
+    _c.CATEGORY_NOT_WORD: lambda ch: not (ch.isalnum() or ch == '_'),
+}
+
+
+def parse(pattern, flags=0):
+    """ Parse a regex pattern (str or bytes) with the given re flags. Return
+        the parsed pattern, or None if it can't be parsed.
+    """
+    try:
+        return sre_parse.parse(pattern, flags)
+    except Exception:
+        return None
+
+
+def can_match_any_of(parsed, chars):
+    """ Can the parsed pattern consume any of the given characters (a string
+        of single characters)? The answer errs on the side of True.
+    """
+    codes = frozenset(ord(c) for c in chars)
+    return _can_match(parsed, codes, _is_dotall(parsed.state.flags))
+
+
+def is_line_local(parsed):
+    """ Are the matches of the parsed pattern confined to single lines, so
+        that running it with re.MULTILINE over a buffer of whole lines finds
+        the same matches as running it on each line separately?
+
+        This is the case when the pattern can't match a newline nor the
+        empty string, and has no assertions other than ^, $ and word
+        boundaries (no \\A, \\Z, lookarounds or backreferences).
+    """
+    try:
+        if parsed.getwidth()[0] == 0:
+            return False
+    except (OverflowError, TypeError):
+        return False
+    return (not can_match_any_of(parsed, '\n') and
+            _only_line_assertions(parsed))
+
+
+def required_literals(parsed):
+    """ Find literal strings such that every match of the parsed pattern
+        contains at least one of them. Return a sorted list of these strings
+        (made of characters, also for bytes patterns), or None if none were
+        found. When there are several candidates (as in a(bcd|efg)h), the
+        set whose shortest string is the longest is picked.
+
+        Case insensitive parts of the pattern have no required literals.
+    """
+    return _required_literals(parsed, _is_ignorecase(parsed.state.flags))
+
+
+def literal_text(parsed):
+    """ If the parsed pattern only matches a fixed string (it consists of
+        literal characters, and isn't case insensitive), return that string
+        (made of characters, also for bytes patterns). Otherwise return None.
+    """
+    if parsed is None or _is_ignorecase(parsed.state.flags):
+        return None
+    chars = []
+    for op, av in parsed:
+        if op != _c.LITERAL:
+            return None
+        chars.append(chr(av))
+    return ''.join(chars)
+
+
+def has_assertions(parsed):
+    """ Does the parsed pattern have anchors (^, $, \\b, \\A etc.),
+        lookarounds or backreferences anywhere?
+    """
+    for op, av in parsed:
+        if op in (_c.AT, _c.ASSERT, _c.ASSERT_NOT, _c.GROUPREF,
+                  _c.GROUPREF_EXISTS):
+            return True
+        if any(has_assertions(sub) for sub in _subpatterns(op, av)):
+            return True
+    return False
+
+
+def is_self_contained(pattern, flags=0):
+    """ Does the pattern (compiled with the given re flags) match the same
+        as an alternative of a bigger regex, as in (?:pattern)|(?:other)?
+        It doesn't when it sets global flags inline (like (?i)), which
+        would apply to the whole regex, or has groups, whose names and
+        numbers (that backreferences use) would clash with those of the
+        other alternatives. Patterns that can't be parsed are assumed not
+        to.
+    """
+    alternation = (b'(?:)|(?:%s)' if isinstance(pattern, bytes)
+                   else '(?:)|(?:%s)') % pattern
+    # Before Python 3.11, global flags that aren't at the start of the
+    # regex only get a DeprecationWarning
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        parsed = parse(alternation, flags)
+    return parsed is not None and parsed.state.groups == 1
+
+
+def is_end_anchored(parsed):
+    """ Does every match of the parsed pattern end at the end of the string,
+        while there are no other assertions in it?
+    """
+    items = list(parsed)
+    if not items:
+        return False
+    op, av = items[-1]
+    if op != _c.AT or av not in (_c.AT_END, _c.AT_END_STRING):
+        return False
+    return not has_assertions(sre_parse.SubPattern(parsed.state, items[:-1]))
+
+
+def _only_line_assertions(parsed):
+    for op, av in parsed:
+        if op == _c.AT:
+            if av not in _LINE_AT_CODES:
+                return False
+        elif op in (_c.ASSERT, _c.ASSERT_NOT, _c.GROUPREF,
+                    _c.GROUPREF_EXISTS):
+            return False
+        elif not all(_only_line_assertions(sub)
+                     for sub in _subpatterns(op, av)):
+            return False
+    return True
+
+
+def _required_literals(parsed, ignorecase):
+    best = None
+    run = []
+    # A sentinel at the end flushes the last run of literals
+    for op, av in list(parsed) + [(None, None)]:
+        if op == _c.LITERAL and not ignorecase:
+            run.append(chr(av))
+            continue
+        if run:
+            best = _better_literals(best, [''.join(run)])
+            run = []
+        if op == _c.SUBPATTERN:
+            _, add_flags, del_flags, sub = av
+            sub_ignorecase = ((ignorecase or _is_ignorecase(add_flags)) and
+                              not _is_ignorecase(del_flags))
+            best = _better_literals(best,
+                                    _required_literals(sub, sub_ignorecase))
+        elif op in _REPEAT_OPS:
+            if av[0] >= 1:
+                best = _better_literals(
+                    best, _required_literals(av[2], ignorecase))
+        elif op == getattr(_c, 'ATOMIC_GROUP', None):
+            best = _better_literals(best, _required_literals(av, ignorecase))
+        elif op == _c.BRANCH:
+            # Every alternative needs literals of its own
+            alternatives = set()
+            for sub in av[1]:
+                literals = _required_literals(sub, ignorecase)
+                if literals is None:
+                    break
+                alternatives.update(literals)
+            else:
+                if len(alternatives) <= _MAX_REQUIRED_LITERALS:
+                    best = _better_literals(best, sorted(alternatives))
+    return best
+
+
+# Sets with more alternative literals than this aren't worth screening with
+_MAX_REQUIRED_LITERALS = 16
+
+
+def _better_literals(literals1, literals2):
+    """ The better of two sets of required literals (either may be None):
+        the one with the longer shortest literal, then the smaller one.
+    """
+    if literals1 is None:
+        return literals2
+    if literals2 is None:
+        return literals1
+    key = lambda literals: (min(map(len, literals)), -len(literals))
+    return literals2 if key(literals2) > key(literals1) else literals1
+
+
+def _is_ignorecase(flags):
+    return bool(flags & sre_parse.SRE_FLAG_IGNORECASE)
+
+
+def _is_dotall(flags):
+    return bool(flags & sre_parse.SRE_FLAG_DOTALL)
+
+
+def _subpatterns(op, av):
+    """ The nested sub-patterns of a parsed item.
+    """
+    if op == _c.SUBPATTERN:
+        return [av[-1]]
+    elif op in _REPEAT_OPS:
+        return [av[2]]
+    elif op == _c.BRANCH:
+        return av[1]
+    elif op in (_c.ASSERT, _c.ASSERT_NOT):
+        return [av[1]]
+    elif op == _c.GROUPREF_EXISTS:
+        return [sub for sub in av[1:] if sub is not None]
+    elif op == getattr(_c, 'ATOMIC_GROUP', None):
+        return [av]
+    return []
+
+
+def _can_match(parsed, codes, dotall):
+    for op, av in parsed:
+        if op == _c.ANY:
+            if dotall or any(code != _NEWLINE for code in codes):
+                return True
+        elif op == _c.LITERAL:
+            if av in codes:
+                return True
+        elif op == _c.IN:
+            if _set_can_match(av, codes):
+                return True
+        elif op == _c.CATEGORY:
+            if _category_can_match(av, codes):
+                return True
+        elif op in (_c.AT, _c.ASSERT, _c.ASSERT_NOT):
+            # Zero-width
+            continue
+        elif op == _c.SUBPATTERN:
+            # Groups can turn DOTALL on and off: (?s:...) and (?-s:...)
+            _, add_flags, del_flags, sub = av
+            sub_dotall = ((dotall or _is_dotall(add_flags)) and
+                          not _is_dotall(del_flags))
+            if _can_match(sub, codes, sub_dotall):
+                return True
+        elif op in (_c.BRANCH, _c.GROUPREF_EXISTS) or (
+                op in _REPEAT_OPS or
+                op == getattr(_c, 'ATOMIC_GROUP', None)):
+            if any(_can_match(sub, codes, dotall)
+                   for sub in _subpatterns(op, av)):
+                return True
+        else:
+            # NOT_LITERAL, GROUPREF and anything unknown
+            return True
+    return False
+
+
+def _set_can_match(items, codes):
+    if items and items[0][0] == _c.NEGATE:
+        return True
+    for op, av in items:
+        if op == _c.LITERAL:
+            if av in codes:
+                return True
+        elif op == _c.RANGE:
+            if any(av[0] <= code <= av[1] for code in codes):
+                return True
+        elif op == _c.CATEGORY:
+            if _category_can_match(av, codes):
+                return True
+        else:
+            return True
+    return False
+
+
+def _category_can_match(category, codes):
+    check = _CATEGORY_CHECKS.get(category)
+    if check is None:
+        return True
+    return any(check(chr(code)) for code in codes)
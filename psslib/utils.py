@@ -6,6 +6,9 @@
 # Eli Bendersky (eliben@gmail.com)
 # This code is in the public domain
 #-------------------------------------------------------------------------------
+import codecs
+import os
+
 from . import colorama
 
 
@@ -33,7 +36,27 @@ def istextfile(fileobj, blocksize=512):
     # so a read (in python 3) won't return bytes.
     if not isinstance(block, bytes):
         block = block.encode('utf-8')
+    return istextblock(block)
+
 
+def istextblock(block):
+    """ The heuristic of istextfile, applied to a block of bytes already read
+        from the start of a file. Text in UTF-16 and UTF-32 has NUL bytes, so
+        for a block starting with their byte order mark (see bom_encoding),
+        the heuristic is applied to its characters instead.
+    """
+    encoding = bom_encoding(block)
+    if encoding is not None:
+        # The size of the mark is that of a code unit. The block may end in
+        # the middle of a character.
+        unit = len('\ufeff'.encode(encoding))
+        text = block[unit:len(block) - len(block) % unit].decode(
+            encoding, 'replace')
+        if '\x00' in text:
+            return False
+        nontext = sum(1 for c in text
+                      if not c.isprintable() and c not in '\n\r\t\f\b')
+        return nontext <= 0.30 * len(text)
     if b'\x00' in block:
         # Files with null bytes are binary
         return False
@@ -47,6 +70,56 @@ def istextfile(fileobj, blocksize=512):
     return float(len(nontext)) / len(block) <= 0.30
 
 
+# Byte order marks, and the encodings of the text following them. The UTF-32
+# little endian mark starts with the UTF-16 one, so it's checked first.
+_BOM_ENCODINGS = [
+    (codecs.BOM_UTF32_LE, 'utf-32-le'),
+    (codecs.BOM_UTF32_BE, 'utf-32-be'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+]
+
+
+def bom_encoding(block):
+    """ If the block of bytes from the start of a file starts with a UTF-16
+        or UTF-32 byte order mark, return the encoding of the text that
+        follows it ('utf-16-le', 'utf-16-be', 'utf-32-le' or 'utf-32-be').
+        Otherwise return None.
+    """
+    for bom, encoding in _BOM_ENCODINGS:
+        if block.startswith(bom):
+            return encoding
+    return None
+
+
+def read_path_list(stream, separator=b'\n', chunk_size=65536):
+    """ Generate the paths listed in a binary stream, separated by
+        separator (a single byte). Paths are generated as soon as they're
+        read, so the stream can still be written to while they're being used.
+        With a newline separator, a '\r' ending a line is dropped too. Empty
+        entries are skipped.
+    """
+    # read1 returns whatever is available instead of waiting for a full
+    # chunk, which matters for pipes.
+    read = getattr(stream, 'read1', stream.read)
+    pending = b''
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        parts = (pending + chunk).split(separator)
+        pending = parts.pop()
+        for part in parts:
+            if separator == b'\n':
+                part = part.rstrip(b'\r')
+            if part:
+                yield os.fsdecode(part)
+    if separator == b'\n':
+        pending = pending.rstrip(b'\r')
+    if pending:
+        yield os.fsdecode(pending)
+
+
 def decode_colorama_color(color_str):
     """ Decode a Colorama color encoded in a string in the following format:
         FORE,BACK,STYLE
@@ -0,0 +1,337 @@
+#-------------------------------------------------------------------------------
+# pss: watcher.py
+#
+# Watching the searched directories and files for changes, for pss --watch.
+# On Linux inotify is used (through ctypes); elsewhere, or when inotify isn't
+# available, the watched files and directories are polled.
+#
+# Eli Bendersky (eliben@gmail.com)
+# This code is in the public domain
+#-------------------------------------------------------------------------------
+import ctypes
+import ctypes.util
+import difflib
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+
+class WatchEvent:
+    """ Kinds of events reported by watchers, in (kind, path) pairs.
+        RESCAN means events were lost and everything has to be checked again
+        (the path is None).
+    """
+    FILE_CHANGED, FILE_DELETED, DIR_CREATED, DIR_DELETED, RESCAN = range(5)
+
+
+def create_watcher():
+    """ Create the best watcher available on this system.
+    """
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError):
+        return PollingWatcher()
+
+
+def diff_matches(old_matches, new_matches):
+    """ Compare two lists of MatchResult objects for the same file, by their
+        matching lines. Return a pair (removed, added): the matches of
+        old_matches that are gone, and the matches of new_matches that are
+        new. Matches that only moved to other line numbers are neither.
+    """
+    old_lines = [m.matching_line for m in old_matches]
+    new_lines = [m.matching_line for m in new_matches]
+    removed = []
+    added = []
+    opcodes = difflib.SequenceMatcher(
+        None, old_lines, new_lines, autojunk=False).get_opcodes()
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag != 'equal':
+            removed.extend(old_matches[i1:i2])
+            added.extend(new_matches[j1:j2])
+    return removed, added
+
+
+# Constants from <sys/inotify.h>
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = (_IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO |
+               _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF |
+               _IN_ONLYDIR)
+
+# struct inotify_event, without the name that follows it
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher(object):
+    """ Watcher using the inotify API of Linux.
+
+        Directories added with add_dir are watched as a whole: changes to any
+        of their entries are reported. For files added with add_file, the
+        directory containing them is watched, but only events for the added
+        files are reported (unless the directory is also added with add_dir).
+    """
+    # After the first event arrives, wait this long for more events, so that
+    # a burst of writes to a file is reported once. Files that are written
+    # all the time would keep the burst going, so events are collected for
+    # at most SETTLE_MAX_SECONDS, and up to SETTLE_MAX_BYTES of them.
+    SETTLE_SECONDS = 0.05
+    SETTLE_MAX_SECONDS = 0.25
+    SETTLE_MAX_BYTES = 1024 * 1024
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(_IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # Maps watch descriptors to [dirpath, whole], where whole is True for
+        # directories added with add_dir.
+        self._watches = {}
+        self._wd_by_dir = {}
+        self._files = set()
+
+    def add_dir(self, dirpath):
+        """ Watch all the entries of the directory dirpath.
+        """
+        wd = self._wd_by_dir.get(dirpath)
+        if wd is None:
+            wd = self._watch(dirpath)
+            if wd is None:
+                return
+        self._watches[wd][1] = True
+
+    def add_file(self, path):
+        """ Watch the file at path.
+        """
+        dirpath = os.path.dirname(path) or os.curdir
+        wd = self._wd_by_dir.get(dirpath)
+        if wd is not None and self._watches[wd][1]:
+            return
+        self._files.add(path)
+        if wd is None:
+            self._watch(dirpath)
+
+    def wait(self, timeout=None):
+        """ Wait for changes. Return a list of (kind, path) events (see
+            WatchEvent), which is empty if timeout (in seconds) expired first.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        deadline = time.time() + self.SETTLE_MAX_SECONDS
+        chunks = []
+        size = 0
+        while True:
+            # Each read returns whole events
+            chunk = os.read(self.fd, 65536)
+            chunks.append(chunk)
+            size += len(chunk)
+            settle = min(self.SETTLE_SECONDS, deadline - time.time())
+            if (    size >= self.SETTLE_MAX_BYTES or settle <= 0 or
+                    not select.select([self.fd], [], [], settle)[0]):
+                break
+        return self._parse_events(b''.join(chunks))
+
+    def close(self):
+        os.close(self.fd)
+
+    def _watch(self, dirpath):
+        wd = self._add_watch(self.fd, os.fsencode(dirpath), _WATCH_MASK)
+        if wd < 0:
+            # Gone already, no permission, or out of watches (see
+            # /proc/sys/fs/inotify/max_user_watches): the directory won't be
+            # watched.
+            return None
+        self._watches[wd] = [dirpath, False]
+        self._wd_by_dir[dirpath] = wd
+        return wd
+
+    def _forget(self, wd):
+        dirpath, _ = self._watches.pop(wd)
+        if self._wd_by_dir.get(dirpath) == wd:
+            del self._wd_by_dir[dirpath]
+
+    def _forget_tree(self, dirpath):
+        """ Stop watching dirpath and the directories below it - it was moved
+            away, so the paths of their watches are stale.
+        """
+        prefix = os.path.join(dirpath, '')
+        for wd, (path, _) in list(self._watches.items()):
+            if path == dirpath or path.startswith(prefix):
+                self._rm_watch(self.fd, wd)
+                self._forget(wd)
+
+    def _parse_events(self, data):
+        events = {}
+        pos = 0
+        while pos + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, namelen = _EVENT_HEADER.unpack_from(data, pos)
+            pos += _EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos + namelen].rstrip(b'\0'))
+            pos += namelen
+
+            if mask & _IN_Q_OVERFLOW:
+                return [(WatchEvent.RESCAN, None)]
+            if mask & _IN_IGNORED:
+                if wd in self._watches:
+                    self._forget(wd)
+                continue
+            watch = self._watches.get(wd)
+            if watch is None or not name:
+                # Events of the watched directory itself (deletion and
+                # moves) are reported by its parent.
+                continue
+            dirpath, whole = watch
+            path = os.path.join(dirpath, name)
+            if mask & _IN_ISDIR:
+                if not whole:
+                    continue
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    event = (WatchEvent.DIR_CREATED, path)
+                elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                    self._forget_tree(path)
+                    event = (WatchEvent.DIR_DELETED, path)
+                else:
+                    continue
+            else:
+                if not whole and path not in self._files:
+                    continue
+                if mask & (_IN_DELETE | _IN_MOVED_FROM):
+                    event = (WatchEvent.FILE_DELETED, path)
+                else:
+                    event = (WatchEvent.FILE_CHANGED, path)
+            # Only the last event for each path matters: it tells what the
+            # path is now.
+            events[path] = event
+        return list(events.values())
+
+
+class PollingWatcher(object):
+    """ Watcher that periodically stats the watched files and directories.
+        Directories whose mtime changed are listed again to find created and
+        deleted entries. Same interface as InotifyWatcher.
+    """
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        # Maps watched files to their (mtime_ns, size, inode)
+        self._files = {}
+        # Maps directories added with add_dir to (mtime_ns, names, subdirs)
+        self._dirs = {}
+
+    def add_dir(self, dirpath):
+        try:
+            self._dirs[dirpath] = self._list_dir(dirpath)
+        except OSError:
+            pass
+
+    def add_file(self, path):
+        self._files[path] = self._stamp(path)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            events = self._poll()
+            if events:
+                return events
+            if deadline is not None and time.time() >= deadline:
+                return []
+            delay = self.interval
+            if deadline is not None:
+                delay = max(0, min(delay, deadline - time.time()))
+            time.sleep(delay)
+
+    def close(self):
+        pass
+
+    def _poll(self):
+        events = []
+        for dirpath, (mtime_ns, names, subdirs) in list(self._dirs.items()):
+            try:
+                current_mtime_ns = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                # Reported by the parent directory, if it's watched
+                del self._dirs[dirpath]
+                continue
+            if current_mtime_ns == mtime_ns:
+                continue
+            try:
+                listing = self._list_dir(dirpath)
+            except OSError:
+                continue
+            self._dirs[dirpath] = listing
+            _, new_names, new_subdirs = listing
+            for name in sorted(new_names - names):
+                path = os.path.join(dirpath, name)
+                if name in new_subdirs:
+                    events.append((WatchEvent.DIR_CREATED, path))
+                elif path not in self._files:
+                    events.append((WatchEvent.FILE_CHANGED, path))
+            for name in sorted(names - new_names):
+                if name in subdirs:
+                    path = os.path.join(dirpath, name)
+                    self._forget_tree(path)
+                    events.append((WatchEvent.DIR_DELETED, path))
+
+        for path, stamp in list(self._files.items()):
+            new_stamp = self._stamp(path)
+            if new_stamp == stamp:
+                continue
+            if new_stamp is None:
+                del self._files[path]
+                events.append((WatchEvent.FILE_DELETED, path))
+            else:
+                self._files[path] = new_stamp
+                events.append((WatchEvent.FILE_CHANGED, path))
+        return events
+
+    def _forget_tree(self, dirpath):
+        prefix = os.path.join(dirpath, '')
+        for path in list(self._dirs):
+            if path.startswith(prefix):
+                del self._dirs[path]
+
+    @staticmethod
+    def _list_dir(dirpath):
+        mtime_ns = os.stat(dirpath).st_mtime_ns
+        names = set()
+        subdirs = set()
+        with os.scandir(dirpath) as scandir_it:
+            for entry in scandir_it:
+                names.add(entry.name)
+                try:
+                    if entry.is_dir():
+                        subdirs.add(entry.name)
+                except OSError:
+                    pass
+        return mtime_ns, names, subdirs
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
@@ -0,0 +1,168 @@
+#-------------------------------------------------------------------------------
+# pss: test/test_archives.py
+#
+# Test finding and searching the members of zip and tar archives
+#
+# Eli Bendersky (eliben@gmail.com)
+# This code is in the public domain
+#-------------------------------------------------------------------------------
+import gzip
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from psslib.archives import (MemberReader, archive_format, archive_members,
+                             member_path, split_member_path)
+from psslib.driver import pss_run
+from psslib.filefinder import FileFinder
+from test.utils import MockOutputFormatter
+
+
+class TestArchives(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.jar = os.path.join(self.dir, 'app.jar')
+        with zipfile.ZipFile(self.jar, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('com/x/', '')
+            zf.writestr('com/x/Y.java', 'class Y { int answer = 42; }\n')
+            zf.writestr('META-INF/MANIFEST.MF', 'Version: 42\n')
+        self.tgz = os.path.join(self.dir, 'layer.tar.gz')
+        with tarfile.open(self.tgz, 'w:gz') as tf:
+            info = tarfile.TarInfo('src')
+            info.type = tarfile.DIRTYPE
+            tf.addfile(info)
+            for name, data in [('src/a.py', b'x = 42\n'),
+                               ('src/b.c', b'int y;\n'),
+                               ('src/c.py.gz', gzip.compress(b'y = 42\n'))]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tf.addfile(info, io.BytesIO(data))
+        with open(os.path.join(self.dir, 'bad.zip'), 'wb') as f:
+            f.write(b'PK\x03\x04 not really a zip')
+        with open(os.path.join(self.dir, 'd.py'), 'wb') as f:
+            f.write(b'z = 42\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_paths(self):
+        self.assertEqual(archive_format('x/A.JAR'), 'zip')
+        self.assertEqual(archive_format('x.tar.bz2'), 'tar')
+        self.assertIsNone(archive_format('x.gz'))
+        path = member_path(self.jar, 'com/x/Y.java')
+        self.assertEqual(split_member_path(path), (self.jar, 'com/x/Y.java'))
+        self.assertIsNone(split_member_path(self.jar))
+        self.assertIsNone(split_member_path('x!/y.c'))
+
+    def test_members(self):
+        self.assertEqual(list(archive_members(self.jar)),
+                         ['com/x/Y.java', 'META-INF/MANIFEST.MF'])
+        self.assertEqual(list(archive_members(self.tgz)),
+                         ['src/a.py', 'src/b.c', 'src/c.py.gz'])
+        self.assertEqual(
+            list(archive_members(os.path.join(self.dir, 'bad.zip'))), [])
+
+        reader = MemberReader()
+        try:
+            # In order, out of order, and across archives
+            for archive, name, data in [
+                    (self.tgz, 'src/a.py', b'x = 42\n'),
+                    (self.tgz, 'src/b.c', b'int y;\n'),
+                    (self.tgz, 'src/a.py', b'x = 42\n'),
+                    (self.jar, 'com/x/Y.java',
+                     b'class Y { int answer = 42; }\n'),
+                    (self.tgz, 'src/b.c', b'int y;\n')]:
+                with reader.open(archive, name) as f:
+                    self.assertEqual(f.read(), data)
+            self.assertRaises(OSError, reader.open, self.tgz, 'src/none')
+            self.assertRaises(OSError, reader.open, self.jar, 'com/x/Z.java')
+        finally:
+            reader.close()
+
+    def test_duplicate_members(self):
+        # The last entry with a name replaces the earlier ones
+        tar = os.path.join(self.dir, 'dup.tar')
+        with tarfile.open(tar, 'w') as tf:
+            for name, data in [('a.c', b'old 42\n'), ('b.c', b'b 42\n'),
+                               ('a.c', b'new: 42\n'), ('d', b''),
+                               ('c.c', b'c 42\n'), ('d', None)]:
+                info = tarfile.TarInfo(name)
+                if data is None:
+                    info.type = tarfile.DIRTYPE
+                    tf.addfile(info)
+                else:
+                    info.size = len(data)
+                    tf.addfile(info, io.BytesIO(data))
+        self.assertEqual(list(archive_members(tar)), ['b.c', 'a.c', 'c.c'])
+        reader = MemberReader()
+        try:
+            for name, data in [('a.c', b'new: 42\n'), ('b.c', b'b 42\n'),
+                               ('a.c', b'new: 42\n')]:
+                with reader.open(tar, name) as f:
+                    self.assertEqual(f.read(), data)
+            self.assertRaises(OSError, reader.open, tar, 'd')
+        finally:
+            reader.close()
+
+        of = MockOutputFormatter(os.path.basename(self.dir))
+        pss_run([tar], pattern='42', output_formatter=of, do_break=False,
+                search_archives=True)
+        name = os.path.basename(self.dir)
+        self.assertEqual(
+            [path for kind, path in of.output if kind == 'START_MATCHES'],
+            [member_path(os.path.join(name, 'dup.tar'), member)
+             for member in ['b.c', 'a.c', 'c.c']])
+        self.assertEqual(
+            [match for kind, match in of.output if kind == 'MATCH'],
+            [(1, [(2, 4)]), (1, [(5, 7)]), (1, [(2, 4)])])
+
+    def test_find_members(self):
+        def found(**kwargs):
+            ff = FileFinder([self.dir], search_archives=True, **kwargs)
+            return sorted(os.path.relpath(path, self.dir)
+                          for path in ff.files())
+        self.assertEqual(found(search_extensions=['.py']),
+                         ['d.py', member_path('layer.tar.gz', 'src/a.py')])
+        self.assertEqual(found(search_extensions=['.py'],
+                               search_compressed=True),
+                         ['d.py', member_path('layer.tar.gz', 'src/a.py'),
+                          member_path('layer.tar.gz', 'src/c.py.gz')])
+        self.assertEqual(found(search_extensions=['.java', '.c'],
+                               filter_exclude_patterns=[r'\.tar\.gz$']),
+                         [member_path('app.jar', 'com/x/Y.java')])
+        self.assertNotIn(
+            'app.jar',
+            list(FileFinder([self.dir], search_archives=True).files()))
+
+        # Only text files are found among the members, as the search only
+        # searches them (the archives themselves are binary files)
+        with zipfile.ZipFile(self.jar, 'a') as zf:
+            zf.writestr('com/x/Y.class', b'\xca\xfe\xba\xbe\x00\x00')
+        self.assertEqual(found(find_only_text_files=True),
+                         [member_path('app.jar', 'META-INF/MANIFEST.MF'),
+                          member_path('app.jar', 'com/x/Y.java'), 'd.py',
+                          member_path('layer.tar.gz', 'src/a.py'),
+                          member_path('layer.tar.gz', 'src/b.c')])
+
+    def test_search_archives(self):
+        of = MockOutputFormatter(os.path.basename(self.dir))
+        pss_run([self.dir], pattern='42', output_formatter=of,
+                do_break=False, search_archives=True, search_zip=True,
+                include_types=['py', 'java'])
+        name = os.path.basename(self.dir)
+        self.assertEqual(
+            sorted(path for kind, path in of.output
+                   if kind == 'START_MATCHES'),
+            sorted(os.path.join(name, path) for path in [
+                'd.py', member_path('app.jar', 'com/x/Y.java'),
+                member_path('layer.tar.gz', 'src/a.py'),
+                member_path('layer.tar.gz', 'src/c.py.gz')]))
+
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
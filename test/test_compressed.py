@@ -0,0 +1,135 @@
+#-------------------------------------------------------------------------------
+# pss: test/test_compressed.py
+#
+# Test the decompression of compressed files, and searching them with -z
+#
+# Eli Bendersky (eliben@gmail.com)
+# This code is in the public domain
+#-------------------------------------------------------------------------------
+import bz2
+import gzip
+from io import BytesIO
+import lzma
+import os
+import shutil
+import tempfile
+import unittest
+
+from psslib.compressed import DecompressedReader, open_decompressed
+from psslib.driver import pss_run
+from test.utils import MockOutputFormatter
+
+
+text = b''.join(b'line %d of the text\n' % i for i in range(5000))
+
+
+class TestDecompression(unittest.TestCase):
+    def _open(self, data, filename='file', prefetch=False):
+        return open_decompressed(BytesIO(data), filename, data[:512],
+                                 prefetch=prefetch)
+
+    def test_formats(self):
+        for prefetch in (False, True):
+            for data, filename in [
+                    (gzip.compress(text), 'file.gz'),
+                    (bz2.compress(text), 'file.bz2'),
+                    (lzma.compress(text), 'file.xz'),
+                    # The magic bytes tell the format, not the extension
+                    (bz2.compress(text), 'file.gz'),
+                    (lzma.compress(text, format=lzma.FORMAT_ALONE),
+                     'file.lzma')]:
+                with self._open(data, filename, prefetch) as f:
+                    self.assertEqual(f.read(), text)
+                    # Rewinding starts over
+                    f.seek(0)
+                    self.assertEqual(list(f)[:2], [b'line 0 of the text\n',
+                                                   b'line 1 of the text\n'])
+
+        # Only files named like compressed files are decompressed, and only
+        # if they are compressed
+        self.assertIsNone(self._open(text))
+        self.assertIsNone(self._open(text, 'file.gz'))
+        self.assertIsNone(self._open(gzip.compress(text)))
+        self.assertIsNone(self._open(b'BZh is not bzip2\n', 'notes.txt'))
+        self.assertIsNone(
+            self._open(lzma.compress(text, format=lzma.FORMAT_ALONE)))
+        for prefetch in (False, True):
+            data = b'not compressed\n'
+            fileobj = BytesIO(data)
+            self.assertIsNone(open_decompressed(fileobj, 'file.lzma', data,
+                                                prefetch=prefetch))
+            self.assertEqual(fileobj.read(), data)
+
+    def test_errors(self):
+        for prefetch in (False, True):
+            for data, filename in [(gzip.compress(text)[:-100], 'file.gz'),
+                                   (b'\x1f\x8b' + b'x' * 100, 'file.gz'),
+                                   (lzma.compress(text)[:50], 'file.xz')]:
+                with self._open(data, filename, prefetch=prefetch) as f:
+                    self.assertRaises(OSError, f.read)
+
+    def test_prefetch_stopped_early(self):
+        # Closing the stream while the prefetching thread waits for the
+        # reader doesn't hang.
+        data = gzip.compress(text * 10)
+        reader = DecompressedReader(BytesIO(data), gzip, prefetch=True)
+        # Start over with small chunks, so that the queue fills up
+        reader.CHUNK_SIZE = 100
+        reader.PREFETCH_CHUNKS = 2
+        reader.seek(0)
+        self.assertEqual(reader.read(5), b'line ')
+        reader.close()
+        self.assertIsNone(reader._thread)
+
+
+class TestSearchZip(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name, data in [('a.c.gz', gzip.compress(b'int x;\nint y = 42;\n')),
+                           ('b.c.bz2', bz2.compress(b'42\n')),
+                           ('c.py.xz', lzma.compress(b'x = 42\n')),
+                           ('d.c.gz', b'\x1f\x8b' + b'corrupt'),
+                           ('e.c', b'return 42;\n'),
+                           ('f.c', b'BZh = 42;\n')]:
+            with open(os.path.join(self.dir, name), 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _search(self, **kwargs):
+        of = MockOutputFormatter(os.path.basename(self.dir))
+        pss_run([self.dir], pattern='42', output_formatter=of,
+                do_break=False, **kwargs)
+        return sorted(of.output)
+
+    def test_search_zip(self):
+        name = os.path.basename(self.dir)
+        self.assertEqual(self._search(),
+                         sorted([('MATCH', (1, [(7, 9)])),
+                                 ('START_MATCHES', os.path.join(name, 'e.c')),
+                                 ('MATCH', (1, [(6, 8)])),
+                                 ('START_MATCHES',
+                                  os.path.join(name, 'f.c'))]))
+        self.assertEqual(
+            self._search(search_zip=True, include_types=['cc']),
+            sorted([('MATCH', (2, [(8, 10)])),
+                    ('START_MATCHES', os.path.join(name, 'a.c.gz')),
+                    ('MATCH', (1, [(0, 2)])),
+                    ('START_MATCHES', os.path.join(name, 'b.c.bz2')),
+                    ('MATCH', (1, [(7, 9)])),
+                    ('START_MATCHES', os.path.join(name, 'e.c')),
+                    ('MATCH', (1, [(6, 8)])),
+                    ('START_MATCHES', os.path.join(name, 'f.c'))]))
+        self.assertIn(('START_MATCHES', os.path.join(name, 'c.py.xz')),
+                      self._search(search_zip=True, include_types=['py']))
+
+        # Context lines are read again from the start
+        self.assertIn(('CONTEXT', 1),
+                      self._search(search_zip=True, include_types=['cc'],
+                                   ncontext_before=1))
+
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
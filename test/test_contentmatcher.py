@@ -1,12 +1,16 @@
-from io import StringIO
+from io import BytesIO, StringIO
 
+import mmap
 import os
 import pprint
 import sys
+import tempfile
+import time
 import unittest
 
 sys.path.extend(['.', '..'])
 from psslib.contentmatcher import ContentMatcher, MatchResult
+from psslib import regexinfo
 
 
 text1 = r'''some line vector<int>
@@ -121,6 +125,370 @@ class TestContentMatcher(unittest.TestCase):
         cm = ContentMatcher(r'$\t', literal_pattern=False)
         self.assertMatches(cm, text2, [])
 
+    def test_buffer_matcher(self):
+        # The buffer engine is used when matches can't cross lines
+        self.assertEqual(ContentMatcher('line').match_file.__name__,
+                         'buffer_matcher')
+        self.assertEqual(ContentMatcher(r'\bL?ine$').match_file.__name__,
+                         'buffer_matcher')
+        for pattern in [r'e\s', r'(?s)e.', r'^', r'\Aline', r'(?<=a)n']:
+            self.assertEqual(ContentMatcher(pattern).match_file.__name__,
+                             'matcher')
+
+        # It finds the same matches as the line engine, also across chunk
+        # boundaries and with long lines.
+        texts = [text1, text2, text1 + 'no newline at end line',
+                 text1.replace('\n', '\r\n'), '',
+                 'line' * 50 + '\n' + 'x' * 100 + 'line\n']
+        patterns = ['line', 'pie', r'\bline\b', r'^ *line', r'e$', 'n.',
+                    r'[a-z]+ine\b', r'v\w+']
+        for chunk_size in (ContentMatcher.BUFFER_CHUNK_SIZE, 7, 64):
+            for text in texts:
+                for pattern in patterns:
+                    for kwargs in [{}, dict(ignore_case=True),
+                                   dict(max_match_count=2),
+                                   dict(invert_match=True),
+                                   dict(invert_match=True,
+                                        max_match_count=2)]:
+                        cm = ContentMatcher(pattern, **kwargs)
+                        self.assertEqual(cm.match_file, cm.buffer_matcher)
+                        cm.BUFFER_CHUNK_SIZE = chunk_size
+                        for data in (text, text.encode('ascii')):
+                            if isinstance(data, bytes):
+                                cm = ContentMatcher(pattern.encode('ascii'),
+                                                    **kwargs)
+                                cm.BUFFER_CHUNK_SIZE = chunk_size
+                                wrap = BytesIO
+                            else:
+                                wrap = StringIO
+                            if kwargs.get('invert_match'):
+                                line_matcher = cm.inverted_matcher
+                            else:
+                                line_matcher = cm.matcher
+                            self.assertEqual(
+                                list(cm.buffer_matcher(wrap(data))),
+                                list(line_matcher(wrap(data))),
+                                (pattern, kwargs, chunk_size, text))
+
+    def test_required_literals(self):
+        def required(pattern):
+            return regexinfo.required_literals(regexinfo.parse(pattern))
+        self.assertEqual(required(r'def\s+handle_\w+'), ['handle_'])
+        self.assertEqual(required(r'a(bcd|efg)h'), ['bcd', 'efg'])
+        self.assertEqual(required(r'(foo|\w+)z'), ['z'])
+        self.assertEqual(required(r'x(?i:abc)yz'), ['yz'])
+        self.assertEqual(required(b'\\d+(?:ab)+'), ['ab'])
+        for pattern in [r'(?i)foo', r'(abc)?', r'x*', r'foo|\d']:
+            self.assertIsNone(required(pattern))
+
+        # Screening lines with the literals doesn't change the matches of
+        # any engine.
+        patterns = [r'\w+ine\b', r'l(ine|xx)', r'\s+line', r'[a-z]e p(ie)?',
+                    r'(?<=\w)ine', r'(?i)LINE']
+        for pattern in patterns:
+            for kwargs in [{}, dict(invert_match=True)]:
+                for data in (text1, text1.encode('ascii')):
+                    if isinstance(data, bytes):
+                        cm = ContentMatcher(pattern.encode('ascii'), **kwargs)
+                        wrap = BytesIO
+                    else:
+                        cm = ContentMatcher(pattern, **kwargs)
+                        wrap = StringIO
+                    screened = list(cm.match_file(wrap(data)))
+                    cm._required = None
+                    cm._find_spans = cm._regex_spans
+                    self.assertEqual(screened, list(cm.match_file(wrap(data))),
+                                     (pattern, kwargs))
+
+    def test_literal_engines(self):
+        # Literals are found without the regex also with -i, -w and -Q, and
+        # give the same results as the regex.
+        texts = [text1, text2, 'Line_line line-LINE lines\nlinE.\n',
+                 'straße Line ſtraße\n', 'a.b( a.b(c a.b(( xa.b(\n']
+        patterns = [('line', False), ('LINE', False), ('ine', False),
+                    ('a.b(', True), (r'a\.b\(', False), ('-line', True),
+                    ('tra', False), ('.', True)]
+        for pattern, literal_pattern in patterns:
+            for kwargs in [{}, dict(ignore_case=True), dict(whole_words=True),
+                           dict(ignore_case=True, whole_words=True)]:
+                for text in texts:
+                    for as_bytes in (False, True):
+                        if as_bytes:
+                            data = text.encode('utf-8')
+                            cm = ContentMatcher(pattern.encode('ascii'),
+                                literal_pattern=literal_pattern, **kwargs)
+                            wrap = BytesIO
+                        else:
+                            data = text
+                            cm = ContentMatcher(pattern,
+                                literal_pattern=literal_pattern, **kwargs)
+                            wrap = StringIO
+                        self.assertIsNotNone(cm._findstr)
+                        literal = [list(cm.matcher(wrap(data))),
+                                   list(cm.buffer_matcher(wrap(data)))]
+                        cm._findstr = None
+                        cm._find_spans = cm._regex_spans
+                        self.assertEqual(literal,
+                                         [list(cm.matcher(wrap(data)))] * 2,
+                                         (pattern, kwargs, text, as_bytes))
+
+    def test_engine_selection(self):
+        for pattern, kwargs, engine in [
+                ('line', {}, 'buffer-literal'),
+                ('line', dict(ignore_case=True), 'buffer-literal'),
+                ('line', dict(whole_words=True), 'buffer-screened-regex'),
+                (r'\w+ine\b', {}, 'buffer-screened-regex'),
+                (r'\w+', {}, 'buffer-regex'),
+                (r'line', dict(invert_match=True), 'buffer-inverted'),
+                (r'\s+', {}, 'line-regex'),
+                (r'[^x]line', {}, 'line-screened-regex'),
+                (r'[^x]line', dict(invert_match=True), 'line-inverted'),
+                (['line', 'pie'], {}, 'buffer-screened-regex')]:
+            cm = ContentMatcher(pattern, **kwargs)
+            self.assertEqual(cm.engine, engine, (pattern, kwargs))
+            explanation = cm.explain()
+            self.assertEqual(explanation[0], 'engine: ' + engine)
+            self.assertEqual(len(explanation), len(cm.engine_reasons) + 1)
+        self.assertEqual(ContentMatcher('line').match_file.__name__,
+                         'buffer_matcher')
+        self.assertEqual(ContentMatcher(r'\s+').match_file.__name__,
+                         'matcher')
+        self.assertEqual(
+            ContentMatcher(['a', 'b']).match_file.__name__, 'tagged_matcher')
+        self.assertIn(
+            "the regex only runs on lines that contain one of the literals "
+            "it requires: 'ine'",
+            ContentMatcher(br'\w+ine\b').engine_reasons)
+
+        # Only files read as bytes are mapped into memory, whatever they hold
+        mapped = ('files of 16 MB or more are searched through memory '
+                  'mappings, 64 MB at a time (not compressed files, archive '
+                  'members, or files in UTF-16 or UTF-32)')
+        self.assertIn(mapped, ContentMatcher(b'line').engine_reasons)
+        self.assertIn('files modified in the last 5 seconds are read '
+                      'instead, since a mapped file that is truncated while '
+                      "it's searched makes pss crash with SIGBUS",
+                      ContentMatcher(b'line').engine_reasons)
+        self.assertIn(mapped, ContentMatcher([b'a', b'b']).engine_reasons)
+        self.assertNotIn(mapped, ContentMatcher('line').engine_reasons)
+
+    def test_multiline(self):
+        text = ('@dec\ndef f():\n    pass\n\n@dec(1)\n@other\n'
+                'def g(): pass\n@dec\nx = 1')
+        cm = ContentMatcher(r'^@dec\b.*?\ndef \w+', multiline=True)
+        self.assertEqual(cm.engine, 'file-multiline')
+        self.assertEqual(list(cm.match_file(StringIO(text))), [
+            MatchResult('@dec\ndef f():\n', 1, [(0, 10)]),
+            MatchResult('@dec(1)\n@other\ndef g(): pass\n', 5, [(0, 20)])])
+
+        # Matches sharing lines are reported together; the newline that ends
+        # a match belongs to its last line.
+        cm = ContentMatcher(b'x\n|y|z', multiline=True)
+        self.assertEqual(list(cm.match_file(BytesIO(b'ax\nby z\nc\nz'))), [
+            MatchResult(b'ax\n', 1, [(1, 3)]),
+            MatchResult(b'by z\n', 2, [(1, 2), (3, 4)]),
+            MatchResult(b'z', 4, [(0, 1)])])
+        self.assertEqual(
+            len(list(cm.match_file(BytesIO(b'ax\nby z\nc\nz'),
+                                   max_match_count=2))), 2)
+        self.assertEqual(
+            list(ContentMatcher('$', multiline=True).match_file(
+                StringIO('a\n\nb\n'))),
+            [MatchResult('a\n', 1, [(1, 1)]), MatchResult('\n', 2, [(0, 0)]),
+             MatchResult('b\n', 3, [(1, 1)])])
+
+        cm = ContentMatcher(r'@dec\b.*?\ndef', multiline=True,
+                            invert_match=True)
+        self.assertEqual(cm.engine, 'file-multiline-inverted')
+        self.assertEqual(
+            [(r.matching_lineno, r.matching_line)
+             for r in cm.match_file(StringIO(text))],
+            [(3, '    pass\n'), (4, '\n'), (8, '@dec\n'), (9, 'x = 1')])
+        self.assertEqual(
+            len(list(ContentMatcher('nothing', multiline=True,
+                                    invert_match=True).match_file(
+                StringIO(text)))), 9)
+
+        # Several patterns, tagged
+        cm = ContentMatcher(['f\\(\\):\n', 'g\\('], multiline=True)
+        self.assertEqual([r.matching_patterns
+                          for r in cm.match_file(StringIO(text))],
+                         [['f\\(\\):\n'], ['g\\(']])
+
+        # Big binary files are mapped into memory
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(text.encode('ascii') * 3)
+            cm = ContentMatcher(br'pass\n\n@', multiline=True)
+            cm.MMAP_THRESHOLD = 1
+            # Files that were just written aren't mapped
+            with open(path, 'rb') as f:
+                self.assertIsNone(cm._mappable_size(f))
+            _age_file(path)
+            with open(path, 'rb') as f:
+                self.assertIsNotNone(cm._mappable_size(f))
+                self.assertEqual(
+                    [r.matching_lineno for r in cm.match_file(f)],
+                    [3, 11, 19])
+        finally:
+            os.remove(path)
+
+    def test_encoded_file(self):
+        text = 'ab\r\nx h\xe9llo \u65e5\u672c\u8a9e\n\u0a8aab ab\nlast ab'
+        utf8_lines = [line.encode('utf-8')
+                      for line in text.splitlines(True)]
+        for encoding in ['utf-16-le', 'utf-16-be', 'utf-32-le', 'utf-32-be']:
+            data = ('\ufeff' + text).encode(encoding)
+            def match(pattern, **kwargs):
+                cm = ContentMatcher(pattern, **kwargs)
+                return list(cm.match_encoded_file(BytesIO(data), encoding))
+
+            # Lines are UTF-8, and column ranges count UTF-8 bytes
+            self.assertEqual(match('\u65e5\u672c'.encode('utf-8')),
+                             [MatchResult(utf8_lines[1], 2, [(9, 15)])])
+            self.assertEqual(match(b'H\xc3\x89LLO', ignore_case=True),
+                             [MatchResult(utf8_lines[1], 2, [(2, 8)])])
+            # \b follows Unicode: U+0A8A is a letter
+            self.assertEqual(
+                [(r.matching_lineno, r.matching_column_ranges)
+                 for r in match(b'ab', whole_words=True)],
+                [(1, [(0, 2)]), (3, [(6, 8)]), (4, [(5, 7)])])
+            self.assertEqual(
+                [r.matching_lineno for r in match(b'ab', invert_match=True)],
+                [2])
+            self.assertEqual(len(match(b'ab', max_match_count=2)), 2)
+            self.assertEqual(match([b'last', b'h.llo']), [
+                MatchResult(utf8_lines[1], 2, [(2, 8)], [b'h.llo']),
+                MatchResult(utf8_lines[3], 4, [(0, 4)], [b'last'])])
+            self.assertEqual(match(br'ab\r?\nx', multiline=True), [
+                MatchResult(utf8_lines[0] + utf8_lines[1], 1, [(0, 5)])])
+
+            # The file is left open, for reading it again
+            f = BytesIO(data)
+            list(ContentMatcher(b'ab').match_encoded_file(f, encoding))
+            self.assertFalse(f.closed)
+
+    def test_multiple_patterns(self):
+        # All literal: a trie, preferring longer literals
+        cm = ContentMatcher([b'pie', b'pi', br'plum\ pie', b'cream'])
+        self.assertEqual(cm.regex.pattern,
+                         br'(?:cream|p(?:i(?:e)?|lum\ pie))')
+        results = list(cm.match_file(BytesIO(text2.encode('ascii'))))
+        self.assertEqual(results[:2], [
+            MatchResult(b'creampie\n', 1, [(0, 5), (5, 8)],
+                        [b'cream', b'pie']),
+            MatchResult(b'apple pie and plum pie\n', 2, [(6, 9), (14, 22)],
+                        [b'pie', br'plum\ pie'])])
+        self.assertEqual(len(results), 4)
+
+        cm = ContentMatcher([b'APPLE', b'Pie'], ignore_case=True)
+        results = list(cm.match_file(BytesIO(text2.encode('ascii'))))
+        self.assertEqual(results[1].matching_patterns,
+                         [b'APPLE', b'Pie', b'Pie'])
+
+        # Regexes: an alternation, where the first pattern that matches wins
+        cm = ContentMatcher(['p[a-z]+', 'apple', r'\w{3}m'], whole_words=True)
+        results = list(cm.match_file(StringIO(text2)))
+        self.assertEqual(results[0], MatchResult(
+            'apple pie and plum pie\n', 2, [(0, 5), (6, 9), (14, 18), (19, 22)],
+            ['apple', 'p[a-z]+', 'p[a-z]+', 'p[a-z]+']))
+
+        # A single pattern in a list is just that pattern
+        cm = ContentMatcher(['pie'])
+        self.assertIsNone(
+            list(cm.match_file(StringIO(text2)))[0].matching_patterns)
+
+    def test_multiple_patterns_apart(self):
+        # Patterns with inline global flags, groups or backreferences are
+        # searched for apart from the alternation of the others
+        text = 'xx aa\nAa b\nbb xb\nab\n'
+        for patterns, expected in [
+                (['xx', '(?i)AA'],
+                 [(1, [(0, 2), (3, 5)], ['xx', '(?i)AA']),
+                  (2, [(0, 2)], ['(?i)AA'])]),
+                (['(?P<n>a)', '(?P<n>x)', 'b$'],
+                 [(1, [(0, 1), (1, 2), (3, 4), (4, 5)],
+                   ['(?P<n>x)', '(?P<n>x)', '(?P<n>a)', '(?P<n>a)']),
+                  (2, [(1, 2), (3, 4)], ['(?P<n>a)', 'b$']),
+                  (3, [(3, 4), (4, 5)], ['(?P<n>x)', 'b$']),
+                  (4, [(0, 1), (1, 2)], ['(?P<n>a)', 'b$'])]),
+                ([r'(b)\1', r'(a)\1'],
+                 [(1, [(3, 5)], [r'(a)\1']),
+                  (3, [(0, 2)], [r'(b)\1'])]),
+                # At the same position, the alternation wins over the
+                # patterns searched for apart from it, even if they come
+                # first and would match too
+                (['(a)b|(x)', 'a', 'xx'],
+                 [(1, [(0, 2), (3, 4), (4, 5)], ['xx', 'a', 'a']),
+                  (2, [(1, 2)], ['a']),
+                  (3, [(3, 4)], ['(a)b|(x)']),
+                  (4, [(0, 1)], ['a'])])]:
+            for multiline in (False, True):
+                cm = ContentMatcher(patterns, multiline=multiline)
+                self.assertEqual(
+                    [(r.matching_lineno, r.matching_column_ranges,
+                      r.matching_patterns)
+                     for r in cm.match_file(StringIO(text))],
+                    expected, (patterns, multiline))
+                cm = ContentMatcher([p.encode('ascii') for p in patterns],
+                                    invert_match=True, multiline=multiline)
+                self.assertEqual(
+                    [r.matching_lineno
+                     for r in cm.match_file(BytesIO(text.encode('ascii')))],
+                    [n for n in range(1, 5)
+                     if n not in [e[0] for e in expected]])
+
+        cm = ContentMatcher(['xx', '(?i)AA'], ignore_case=True)
+        self.assertEqual(len(list(cm.match_file(StringIO(text)))), 2)
+
+        cm = ContentMatcher(['xx', '(?i)AA', 'zz'])
+        self.assertIn('1 of the 3 patterns set flags inline or have groups, '
+                      'so they are searched for apart from the alternation '
+                      'of the others', cm.engine_reasons)
+        self.assertTrue(regexinfo.is_self_contained('a(?:b)|(?i:c)'))
+        for pattern in ['(?i)a', '(a)', r'(?P<n>a)(?P=n)', '(']:
+            self.assertFalse(regexinfo.is_self_contained(pattern))
+
+    def test_buffer_matcher_mmap(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                # Includes a line longer than the smallest window
+                f.write((text1 * 100 + 'line ' * 2000 + '\n' + text1 * 100 +
+                         'last line').encode('ascii'))
+            _age_file(path)
+            granularity = mmap.ALLOCATIONGRANULARITY
+            for window_size in [granularity, 3 * granularity, 2 ** 30]:
+                for kwargs in [{}, dict(max_match_count=3),
+                               dict(invert_match=True)]:
+                    for pattern in [b'line', br'\bline\b', br'n\w']:
+                        cm = ContentMatcher(pattern, **kwargs)
+                        if kwargs.get('invert_match'):
+                            line_matcher = cm.inverted_matcher
+                        else:
+                            line_matcher = cm.matcher
+                        with open(path, 'rb') as f:
+                            expected = list(line_matcher(f))
+                        cm.MMAP_THRESHOLD = 1
+                        cm.MMAP_WINDOW_SIZE = window_size
+                        with open(path, 'rb') as f:
+                            self.assertEqual(list(cm.buffer_matcher(f)),
+                                             expected,
+                                             (window_size, pattern, kwargs))
+                            # The file was mapped, not read
+                            self.assertEqual(f.tell(), 0)
+        finally:
+            os.remove(path)
+
+
+def _age_file(path):
+    """ Set the mtime of path to a minute ago, so that it's old enough to be
+        mapped into memory.
+    """
+    t = time.time() - 60
+    os.utime(path, (t, t))
+
 
 #------------------------------------------------------------------------------
 if __name__ == '__main__':
@@ -1,4 +1,6 @@
 import os, sys
+import shutil
+import tempfile
 import unittest
 
 sys.path.insert(0, '.')
@@ -172,6 +174,37 @@ class TestDriver(unittest.TestCase):
 
         self.assertEqual(match_found, True)
 
+    def test_utf16_and_utf32_files(self):
+        # Files with a byte order mark are searched as text, not reported as
+        # binary files
+        tmpdir = tempfile.mkdtemp()
+        try:
+            text = 'first\r\nsecond h\xe9llo test\r\nthird\r\n'
+            for name, encoding in [('a.txt', 'utf-16-le'),
+                                   ('b.txt', 'utf-32-be')]:
+                with open(os.path.join(tmpdir, name), 'wb') as f:
+                    f.write(('\ufeff' + text).encode(encoding))
+            of = MockOutputFormatter(os.path.basename(tmpdir))
+            name = os.path.basename(tmpdir)
+            self.assertTrue(pss_run(roots=[tmpdir], pattern='test',
+                                    output_formatter=of, ncontext_before=1))
+            # Columns count the bytes of the lines in UTF-8
+            self.assertEqual(
+                sorted(of.output),
+                sorted(
+                    matches(os.path.join(name, 'a.txt'),
+                            [('CONTEXT', 1), ('MATCH', (2, [(14, 18)]))]) +
+                    matches(os.path.join(name, 'b.txt'),
+                            [('CONTEXT', 1), ('MATCH', (2, [(14, 18)]))])))
+
+            of = MockOutputFormatter(os.path.basename(tmpdir))
+            self.assertTrue(pss_run(roots=[tmpdir], pattern='H\xc9LLO',
+                                    ignore_case=True, universal_newlines=True,
+                                    output_formatter=of))
+            self.assertIn(('MATCH', (2, [(7, 12)])), of.output)
+        finally:
+            shutil.rmtree(tmpdir)
+
     def assertFoundFiles(self, output_formatter, expected_list):
         self.assertEqual(sorted(output_formatter.output),
             sorted(('FOUND_FILENAME', os.path.normpath(f)) for f in expected_list))
@@ -1,10 +1,18 @@
+import gc
 import os
+import re
+import shutil
 import sys
+import tempfile
+import time
 import unittest
+import warnings
 
 sys.path.insert(0, '.')
 sys.path.insert(0, '..')
+from psslib.dircache import DirCache
 from psslib.filefinder import FileFinder
+from psslib.ignorefiles import IgnoreRules
 from test.utils import path_to_testdir, path_relative_to_dir, filter_out_path
 
 
@@ -120,6 +128,37 @@ class TestFileFinder(unittest.TestCase):
                     'simple_filefinder/c.c',
                     'simple_filefinder/partialignored/found.c'])
 
+    def test_ignore_paths(self):
+        many_paths = [os.path.join('gen%d' % i, 'out') for i in range(300)]
+        # Ignored paths can start in the root's path, and don't match when
+        # the components are only partially equal.
+        self.assertPathsEqual(
+                self._find_files(
+                    [self.testdir_simple],
+                    search_extensions=['.c', '.cpp'],
+                    ignore_dirs=many_paths + [
+                        os.path.join('simple_filefinder', 'anothersubdir'),
+                        os.path.join('truesubdir', 'r'),
+                        os.path.join('partialignored', 'thisoneis')]),
+                [   'simple_filefinder/.bzr/hgc.c',
+                    'simple_filefinder/.bzr/ttc.cpp',
+                    'simple_filefinder/a.c',
+                    'simple_filefinder/b.cpp',
+                    'simple_filefinder/c.c',
+                    'simple_filefinder/partialignored/found.c',
+                    'simple_filefinder/partialignored/thisoneisignored/notfound.c',
+                    'simple_filefinder/truesubdir/gc.cpp',
+                    'simple_filefinder/truesubdir/r.cpp'])
+
+        # A root that is itself ignored
+        self.assertPathsEqual(
+                self._find_files(
+                    [os.path.join(self.testdir_simple, 'partialignored')],
+                    search_extensions=['.c'],
+                    ignore_dirs=[os.path.join('simple_filefinder',
+                                              'partialignored')]),
+                [])
+
     def test_file_patterns(self):
         # search ignoring known extensions on purpose, to get a small amount of
         # results
@@ -191,6 +230,378 @@ class TestFileFinder(unittest.TestCase):
                 [   'simple_filefinder/anothersubdir/deep/t.cpp',
                     'simple_filefinder/anothersubdir/deep/tt.cpp'])
 
+    def test_walk_threads(self):
+        for nthreads in (2, 4):
+            self.assertPathsEqual(
+                    self._find_files(
+                        [self.testdir_simple],
+                        search_extensions=['.c', '.cpp'],
+                        walk_threads=nthreads),
+                    self.c_and_cpp_files)
+            self.assertPathsEqual(
+                    self._find_files(
+                        [self.testdir_simple],
+                        search_extensions=['.c'],
+                        walk_threads=nthreads,
+                        ignore_dirs=['anothersubdir', '.bzr',
+                                     os.path.join('partialignored',
+                                                  'thisoneisignored')]),
+                    [   'simple_filefinder/a.c',
+                        'simple_filefinder/c.c',
+                        'simple_filefinder/partialignored/found.c'])
+            self.assertPathsEqual(
+                    self._find_files(
+                        [self.testdir_simple],
+                        recurse=False,
+                        walk_threads=nthreads,
+                        search_extensions=['.c']),
+                    [   'simple_filefinder/a.c',
+                        'simple_filefinder/c.c'])
+
+    def test_walk_threads_early_stop(self):
+        ff = FileFinder([self.testdir_simple], walk_threads=3)
+        files = ff.files()
+        next(files)
+        # Closing the generator early must shut down the worker threads
+        files.close()
+
+    def test_dir_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            root = os.path.join(tmpdir, 'simple_filefinder')
+            shutil.copytree(self.testdir_simple, root)
+            # Listings of directories modified in the last couple of seconds
+            # are not cached, so make the copied ones look old.
+            for dirpath, _, _ in os.walk(root):
+                os.utime(dirpath, (1e9, 1e9))
+            cache_dir = os.path.join(tmpdir, 'cache')
+
+            ff = FileFinder([root], search_extensions=['.c', '.cpp'],
+                            cache_dir=cache_dir)
+            first = sorted(ff.files())
+            self.assertEqual(ff.stats['dirs_from_cache'], 0)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            ff = FileFinder([root], search_extensions=['.c', '.cpp'],
+                            cache_dir=cache_dir)
+            self.assertEqual(sorted(ff.files()), first)
+            self.assertEqual(ff.stats['dirs_from_cache'], 8)
+
+            # A new file changes the directory's mtime, so that directory is
+            # listed again.
+            open(os.path.join(root, 'new.c'), 'w').close()
+            ff = FileFinder([root], search_extensions=['.c', '.cpp'],
+                            cache_dir=cache_dir)
+            self.assertEqual(sorted(ff.files()),
+                             sorted(first + [os.path.join(root, 'new.c')]))
+            self.assertEqual(ff.stats['dirs_from_cache'], 7)
+
+            # Entries of directories that are gone are dropped from the
+            # cache when the walk lists their parent again, with their
+            # subdirectories. Directories the walk doesn't reach aren't
+            # checked.
+            def cached_dirs():
+                return sorted(os.path.relpath(key, root)
+                              for key in DirCache(cache_dir, root).dirs)
+            subdirs = [os.path.relpath(dirpath, root)
+                       for dirpath, _, _ in os.walk(root)]
+            self.assertEqual(cached_dirs(), sorted(subdirs))
+            deep = os.path.join('anothersubdir', 'deep')
+            shutil.rmtree(os.path.join(root, deep))
+            list(FileFinder([root], cache_dir=cache_dir, max_depth=1).files())
+            self.assertEqual(cached_dirs(), sorted(subdirs))
+            list(FileFinder([root], cache_dir=cache_dir).files())
+            self.assertEqual(cached_dirs(),
+                             sorted(d for d in subdirs if d != deep))
+            shutil.rmtree(os.path.join(root, 'partialignored'))
+            list(FileFinder([root], cache_dir=cache_dir,
+                            ignore_dirs=['truesubdir']).files())
+            self.assertEqual(
+                cached_dirs(),
+                sorted(d for d in subdirs
+                       if d != deep and not d.startswith('partialignored')))
+
+            # And when they can't be listed
+            cache = DirCache(cache_dir, root)
+            shutil.rmtree(os.path.join(root, 'truesubdir'))
+            self.assertRaises(OSError, cache.scandir,
+                              os.path.join(root, 'truesubdir'))
+            self.assertNotIn(os.path.join(root, 'truesubdir'), cache.dirs)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_ignore_files(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            def write(relpath, contents=''):
+                path = os.path.join(tmpdir, *relpath.split('/'))
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'w') as f:
+                    f.write(contents)
+
+            write('.gitignore', '# comment\n*.o\nbuild/\n/top.c\n')
+            write('top.c')
+            write('a.c')
+            write('a.o')
+            write('build/b.c')
+            write('sub/top.c')
+            write('sub/build')       # a file: 'build/' only matches dirs
+            write('sub/.ignore', '*.c\n!keep.c\n')
+            write('sub/keep.c')
+            write('sub/drop.c')
+            write('sub/deep/x.c')
+            write('docs/a/b/gen.c')
+            write('docs/.gitignore', 'a/**/gen.c\n')
+            write('cache/CACHEDIR.TAG',
+                  'Signature: 8a477f597d28d172789f06886806bc55\n')
+            write('cache/c.c')
+            write('notcache/CACHEDIR.TAG', 'not a real tag')
+            write('notcache/c.c')
+
+            def find(**kwargs):
+                ff = FileFinder([tmpdir], **kwargs)
+                found = sorted(os.path.relpath(p, tmpdir).replace(os.sep, '/')
+                               for p in ff.files())
+                return found, ff
+
+            found, ff = find(use_ignore_files=True, ignore_dirs=[])
+            self.assertEqual(found, [
+                '.gitignore', 'a.c', 'docs/.gitignore',
+                'notcache/CACHEDIR.TAG', 'notcache/c.c',
+                'sub/.ignore', 'sub/build', 'sub/keep.c'])
+            # build/ is never listed
+            self.assertEqual(ff.stats['dirs_pruned'], 1)
+
+            found, ff = find(ignore_dirs=[])
+            self.assertEqual(len(found), 17)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_ignore_bracket_classes(self):
+        # A ']' first in a class, also after its negation, is a member
+        for glob, ignored, kept in [('[!]a].c', ['b.c'], ['].c', 'a.c']),
+                                    ('[^]a].c', ['b.c'], ['].c', 'a.c']),
+                                    ('[]a].c', ['].c', 'a.c'], ['b.c']),
+                                    ('[[]x', ['[x'], ['x'])]:
+            rules = IgnoreRules([glob])
+            for name in ignored:
+                self.assertTrue(rules.match(name, False), (glob, name))
+            for name in kept:
+                self.assertIsNone(rules.match(name, False), (glob, name))
+
+    def test_file_is_found_matches_full_path_search(self):
+        # _file_is_found splits the patterns by which part of the path they
+        # need; check it against plain searches in the full path.
+        def reference(ff, path, search_extensions, ignore_extensions,
+                      search_patterns, ignore_patterns, includes, excludes):
+            ext = os.path.splitext(path)[1]
+            search = lambda pats: any(re.search(p, path) for p in pats)
+            if ext in ignore_extensions or search(ignore_patterns):
+                return False
+            if (search_extensions or search_patterns) and not (
+                    ext in search_extensions or search(search_patterns)):
+                return False
+            if search(excludes):
+                return False
+            if includes and not search(includes):
+                return False
+            return True
+
+        paths = [os.path.join(*p.split('/')) for p in [
+            'a.c', 'dir/a.c', 'Makefile', 'src/Makefile.am', 'Makefile/x.py',
+            'a/b/c.txt~', 'x~/y.c', '#a/b#', 'a/#b#', 'core.12/x',
+            'd/core.12', 'BUILD', 'src/BUILD_x/y.h', 'lib/.z.swp',
+            'abc/def', 'nodot', 'ab/cd/ef.cpp']]
+        pattern_sets = [
+            [], ['~$'], ['#.+#$'], ['Makefile'], [r'^a'], [r'\bc'],
+            ['BUILD', r'[._].*\.swp$'], [r'core\.\d+$'], ['b/c'], ['a.'],
+            ['(?:ab|cd)'], [r'\w{3}$']]
+        ext_sets = [[], ['.c'], ['.c', '.py', '']]
+        for search_patterns in pattern_sets:
+            for other in pattern_sets:
+                for exts in ext_sets:
+                    kwargs = dict(
+                        search_extensions=exts,
+                        ignore_extensions=['.h'],
+                        search_patterns=search_patterns,
+                        ignore_patterns=other[:1],
+                        includes=other[1:],
+                        excludes=other[:1] + ['~$'])
+                    ff = FileFinder(
+                        [], search_extensions=exts,
+                        ignore_extensions=['.h'],
+                        search_patterns=search_patterns,
+                        ignore_patterns=other[:1],
+                        filter_include_patterns=other[1:],
+                        filter_exclude_patterns=other[:1] + ['~$'])
+                    for path in paths:
+                        self.assertEqual(
+                            ff._file_is_found(path),
+                            reference(ff, path, **kwargs),
+                            (path, kwargs))
+
+    def test_stats(self):
+        ff = FileFinder([self.testdir_simple], search_extensions=['.c'])
+        found = list(ff.files())
+        self.assertEqual(len(found), len(self.all_c_files))
+        # No symlinks in this directory, so no found file needed a stat
+        self.assertEqual(ff.stats['stats_saved'], len(found))
+        self.assertEqual(ff.stats['dirs_scanned'], 8)
+
+    def test_stat_bounds(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            now = time.time()
+            files = {'small.c': (10, now),
+                     'big.c': (5000, now),
+                     'old.c': (10, now - 10 * 86400)}
+            for name, (size, mtime) in files.items():
+                path = os.path.join(tmpdir, name)
+                with open(path, 'wb') as f:
+                    f.write(b'x' * size)
+                os.utime(path, (mtime, mtime))
+
+            def found(**kwargs):
+                ff = FileFinder([tmpdir], search_extensions=['.c'], **kwargs)
+                return sorted(os.path.basename(p) for p in ff.files())
+
+            self.assertEqual(found(max_filesize=1000), ['old.c', 'small.c'])
+            self.assertEqual(found(min_filesize=1000), ['big.c'])
+            self.assertEqual(found(max_filesize=10, min_filesize=10),
+                             ['old.c', 'small.c'])
+            self.assertEqual(found(newer_than=now - 86400),
+                             ['big.c', 'small.c'])
+            self.assertEqual(found(older_than=now - 86400), ['old.c'])
+            self.assertEqual(
+                found(newer_than=now - 86400, max_filesize=1000),
+                ['small.c'])
+            # Files given directly are filtered too
+            ff = FileFinder([os.path.join(tmpdir, 'big.c')],
+                            max_filesize=1000)
+            self.assertEqual(list(ff.files()), [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_walk_order(self):
+        def depths(**kwargs):
+            ff = FileFinder([self.testdir_simple],
+                            search_extensions=['.c', '.cpp'], **kwargs)
+            return [path_relative_to_dir(p, 'simple_filefinder').count('/')
+                    for p in ff.files() if not filter_out_path(p)]
+
+        # Whatever the order, the same files are found
+        for order in FileFinder.WALK_ORDERS:
+            self.assertPathsEqual(
+                self._find_files([self.testdir_simple],
+                                 search_extensions=['.c', '.cpp'],
+                                 walk_order=order),
+                self.c_and_cpp_files)
+        for order in ('breadth', 'shallow'):
+            found = depths(walk_order=order)
+            self.assertEqual(found, sorted(found))
+        self.assertNotEqual(depths(), sorted(depths()))
+        self.assertRaises(ValueError, FileFinder, [], walk_order='random')
+
+    def test_walk_order_mtime(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            now = time.time()
+            names = ['old.c', os.path.join('sub', 'new.c'),
+                     os.path.join('sub', 'deep', 'newest.c'), 'older.c']
+            for age, name in zip([100, 10, 1, 200], names):
+                path = os.path.join(tmpdir, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as f:
+                    f.write('x\n')
+                os.utime(path, (now - age, now - age))
+            for walk_threads in (1, 2):
+                ff = FileFinder([tmpdir], walk_order='mtime',
+                                walk_threads=walk_threads)
+                self.assertEqual([os.path.basename(p) for p in ff.files()],
+                                 ['newest.c', 'new.c', 'old.c', 'older.c'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_max_depth(self):
+        def found(**kwargs):
+            return self._find_files([self.testdir_simple],
+                                    search_extensions=['.c', '.cpp'],
+                                    **kwargs)
+        all_files = self.c_and_cpp_files
+        for max_depth in range(4):
+            self.assertPathsEqual(
+                found(max_depth=max_depth),
+                [p for p in all_files if p.count('/') <= max_depth])
+        self.assertPathsEqual(found(max_depth=1),
+                              found(recurse=False))
+        self.assertPathsEqual(found(max_depth=3, recurse=False),
+                              found(recurse=False))
+        # With max_depth=0 the root isn't listed at all, so no directory
+        # handle is left open
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', ResourceWarning)
+            dirs = []
+            self.assertEqual(found(max_depth=0, dir_callback=dirs.append), [])
+            gc.collect()
+            self.assertEqual(dirs, [])
+
+    @unittest.skipUnless(hasattr(os, 'symlink') and sys.platform != 'win32',
+                         'needs symlinks')
+    def test_follow_symlinks(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmpdir, 'src')
+            os.makedirs(os.path.join(src, 'sub'))
+            for name in ('a.c', os.path.join('sub', 'b.c')):
+                with open(os.path.join(src, name), 'w') as f:
+                    f.write('int x;\n')
+            os.link(os.path.join(src, 'a.c'), os.path.join(src, 'hard.c'))
+            # A link to another tree, and a cycle back to the top
+            other = os.path.join(tmpdir, 'other')
+            os.makedirs(other)
+            with open(os.path.join(other, 'o.c'), 'w') as f:
+                f.write('int o;\n')
+            os.symlink(other, os.path.join(src, 'linked'))
+            os.symlink(src, os.path.join(src, 'sub', 'loop'))
+            os.symlink(os.path.join(src, 'sub', 'b.c'),
+                       os.path.join(src, 'blink.c'))
+
+            def found(roots, **kwargs):
+                ff = FileFinder(roots, search_extensions=['.c'], **kwargs)
+                return sorted(os.path.relpath(p, tmpdir) for p in ff.files())
+
+            # Symlinks to files are found either way; without following, the
+            # file and the links to it are all separate.
+            self.assertEqual(found([src]), [
+                'src/a.c', 'src/blink.c', 'src/hard.c', 'src/sub/b.c'])
+
+            followed = found([src], follow_symlinks=True)
+            self.assertEqual(len(followed), 3)
+            self.assertIn('src/linked/o.c', followed)
+            self.assertEqual(
+                len([p for p in followed if p.endswith(('a.c', 'hard.c'))]),
+                1)
+            self.assertEqual(
+                len([p for p in followed
+                     if p.endswith(('/b.c', 'blink.c'))]), 1)
+
+            # Overlapping roots are searched once. Like with follow_symlinks,
+            # links to the same file are then found once too.
+            for roots in ([src, os.path.join(src, 'sub'),
+                           os.path.join(src, 'a.c')],
+                          [os.path.join(src, 'sub'), src, src]):
+                for walk_threads in (1, 3):
+                    overlapping = found(roots, walk_threads=walk_threads)
+                    self.assertEqual(
+                        set(os.stat(os.path.join(tmpdir, p)).st_ino
+                            for p in overlapping),
+                        set(os.stat(os.path.join(src, p)).st_ino
+                            for p in ('a.c', 'sub/b.c')))
+                    self.assertEqual(len(overlapping), 2)
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 #------------------------------------------------------------------------------
 if __name__ == '__main__':
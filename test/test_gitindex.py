@@ -0,0 +1,131 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+from psslib.filefinder import FileFinder
+from psslib.gitindex import (find_git_worktree, read_index_paths,
+                             GitIndexError)
+
+
+def have_git():
+    return shutil.which('git') is not None
+
+
+@unittest.skipUnless(have_git(), 'git is not available')
+class TestGitIndex(unittest.TestCase):
+    tracked = sorted([
+        'a.c',
+        'node_modules/m.js',
+        'src/b.c',
+        'src/deep/c.c',
+        'src/deep/longer_name_to_share_a_prefix.py',
+        'src/deep/longer_name_to_share_another.py',
+        'z.py',
+    ])
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.tmpdir, 'repo')
+        os.mkdir(self.repo)
+        self._git('init', '-q')
+        for relpath in self.tracked + ['untracked.c']:
+            path = os.path.join(self.repo, *relpath.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write('abc\n')
+        self._git('add', *self.tracked)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _git(self, *args):
+        subprocess.check_call(['git'] + list(args), cwd=self.repo,
+                              stdout=subprocess.DEVNULL)
+
+    def _gitdir(self):
+        return find_git_worktree(self.repo)[1]
+
+    def test_index_versions(self):
+        for version in ('2', '3', '4'):
+            self._git('update-index', '--index-version', version)
+            self.assertEqual(list(read_index_paths(self._gitdir())),
+                             self.tracked)
+
+    def test_extended_flags(self):
+        # Intent-to-add entries have extended flags (index version 3+)
+        self._git('add', '-N', 'untracked.c')
+        for version in ('3', '4'):
+            self._git('update-index', '--index-version', version)
+            self.assertEqual(list(read_index_paths(self._gitdir())),
+                             sorted(self.tracked + ['untracked.c']))
+
+    def test_split_index(self):
+        # A split index only holds the changes to a shared index, so it's
+        # not read, and FileFinder walks the directories instead
+        self._git('update-index', '--split-index')
+        with open(os.path.join(self.repo, 'a.c'), 'w') as f:
+            f.write('changed\n')
+        self._git('add', 'a.c')
+        self.assertRaises(GitIndexError, list,
+                          read_index_paths(self._gitdir()))
+        ff = FileFinder([self.repo], use_git_index=True,
+                        ignore_dirs=['.git'])
+        self.assertEqual(
+            sorted(os.path.relpath(path, self.repo).replace(os.sep, '/')
+                   for path in ff.files()),
+            sorted(self.tracked + ['untracked.c']))
+
+    def test_find_worktree(self):
+        subdir = os.path.join(self.repo, 'src', 'deep')
+        toplevel, gitdir = find_git_worktree(subdir)
+        self.assertEqual(toplevel, os.path.abspath(self.repo))
+        self.assertEqual(gitdir, os.path.join(toplevel, '.git'))
+
+    def test_bad_index(self):
+        with open(os.path.join(self._gitdir(), 'index'), 'wb') as f:
+            f.write(b'DIRC\x00\x00\x00\x02\x00\x00\x00\x05garbage')
+        with self.assertRaises(GitIndexError):
+            list(read_index_paths(self._gitdir()))
+
+    def test_filefinder(self):
+        def find(root, **kwargs):
+            ff = FileFinder([root], use_git_index=True, **kwargs)
+            return sorted(os.path.relpath(p, self.repo).replace(os.sep, '/')
+                          for p in ff.files())
+
+        self.assertEqual(
+            find(self.repo, search_extensions=['.c'], ignore_dirs=[]),
+            ['a.c', 'src/b.c', 'src/deep/c.c'])
+        self.assertEqual(
+            find(os.path.join(self.repo, 'src'), search_extensions=['.c']),
+            ['src/b.c', 'src/deep/c.c'])
+        self.assertEqual(
+            find(self.repo, search_extensions=['.c'], recurse=False),
+            ['a.c'])
+        self.assertEqual(
+            find(self.repo, search_extensions=['.js', '.py'],
+                 ignore_dirs=['node_modules', 'deep']),
+            ['z.py'])
+
+    def test_filefinder_dir_callback(self):
+        # The directories of the files from the index are reported, as the
+        # walk reports the directories it lists (for --watch).
+        dirs = []
+        ff = FileFinder([self.repo], use_git_index=True,
+                        ignore_dirs=['node_modules'], dir_callback=dirs.append)
+        list(ff.files())
+        self.assertEqual(
+            sorted(os.path.relpath(d, self.repo).replace(os.sep, '/')
+                   for d in dirs),
+            ['.', 'src', 'src/deep'])
+
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#-------------------------------------------------------------------------------
+# pss: test/test_merge.py
+#
+# Test sharded searches and the merging of their outputs
+#
+# Eli Bendersky (eliben@gmail.com)
+# This code is in the public domain
+#-------------------------------------------------------------------------------
+from io import StringIO
+import os, sys
+import shutil
+import tempfile
+import unittest
+
+from psslib.defaultpssoutputformatter import DefaultPssOutputFormatter
+from psslib.driver import pss_run
+from psslib.filefinder import FileFinder
+from psslib.merge import file_record, merge_outputs, walk_order_key
+from psslib.pss import main
+from test.utils import path_to_testdir
+
+
+class TestMerge(unittest.TestCase):
+    testdir1 = path_to_testdir('testdir1')
+
+    def _run(self, do_heading, roots=None, **kwargs):
+        stream = StringIO()
+        of = DefaultPssOutputFormatter(do_colors=False, do_heading=do_heading,
+                                       stream=stream)
+        pss_run(roots or [self.testdir1], output_formatter=of,
+                do_break=do_heading, walk_order='sorted', **kwargs)
+        return stream.getvalue()
+
+    def test_walk_order_key(self):
+        paths = ['a/z.c', 'a/b/c.c', 'b.c', 'a/a.c', 'a/b/a.c', 'c/a.c']
+        self.assertEqual(sorted(paths, key=walk_order_key),
+                         ['b.c', 'a/a.c', 'a/z.c', 'a/b/a.c', 'a/b/c.c',
+                          'c/a.c'])
+
+    def test_sharded_files(self):
+        all_files = list(FileFinder([self.testdir1]).files())
+        for shard_subtrees in (False, True):
+            sharded = []
+            for index in range(1, 4):
+                ff = FileFinder([self.testdir1], shard=(index, 3),
+                                shard_subtrees=shard_subtrees)
+                sharded.extend(ff.files())
+            self.assertEqual(sorted(sharded), sorted(all_files))
+        self.assertRaises(ValueError, FileFinder, [], shard=(4, 3))
+
+    def test_merge(self):
+        for do_heading in (False, True):
+            for kwargs in [dict(pattern='abc'),
+                           dict(pattern='abc', ncontext_before=1,
+                                ncontext_after=1),
+                           dict(pattern='cde', search_all_types=True),
+                           dict(only_find_files=True)]:
+                single = self._run(do_heading, **kwargs)
+                self.assertTrue(single)
+                sharded = [self._run(do_heading, shard=(index, 3), **kwargs)
+                           for index in range(1, 4)]
+                self.assertEqual(merge_outputs(reversed(sharded)), single,
+                                 (do_heading, kwargs))
+
+    def test_merge_names_and_roots(self):
+        # Names that look like line numbers or separators, and several roots
+        # that aren't in sorted order
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for name in ['t/z.c', 't/d-1-x/f.c', 't/b.c', 't/2024-01.c',
+                         't/a:2:b.c', 'r/a.c', 'r/q/b.c']:
+                path = os.path.join(tmpdir, name)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'w') as f:
+                    f.write('hello\nx-1-y\nhello\n')
+            for roots in [[os.path.join(tmpdir, 't')],
+                          [os.path.join(tmpdir, 't'),
+                           os.path.join(tmpdir, 'r')]]:
+                for do_heading in (False, True):
+                    for kwargs in [dict(pattern='hello'),
+                                   dict(pattern='hello', ncontext_after=1),
+                                   dict(only_find_files=True)]:
+                        single = self._run(do_heading, roots, **kwargs)
+                        for count in (2, 3):
+                            sharded = [self._run(do_heading, roots,
+                                                 shard=(index, count),
+                                                 **kwargs)
+                                       for index in range(1, count + 1)]
+                            self.assertEqual(
+                                merge_outputs(reversed(sharded)), single,
+                                (roots, do_heading, kwargs, count))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_merge_records(self):
+        self.assertEqual(
+            merge_outputs([
+                file_record(0, 'b.c') + 'b.c:1:hello\n' +
+                file_record(0, '2024-01.c') + '2024-01.c:1:hello\n',
+                file_record(0, 'a.c') + 'a.c:1:hello\n']),
+            '2024-01.c:1:hello\na.c:1:hello\nb.c:1:hello\n')
+        self.assertEqual(
+            merge_outputs([
+                'explained\n' + file_record(1, 'a/a.c') + 'a/a.c\n',
+                'explained\n' + file_record(0, 'b/b.c') + 'b/b.c\n']),
+            'explained\nb/b.c\na/a.c\n')
+        self.assertEqual(merge_outputs(['', '']), '')
+        self.assertRaises(ValueError, merge_outputs, ['a.c:1:hello\n'])
+
+    def test_merge_option(self):
+        shard_files = []
+        try:
+            for text in [file_record(0, 'd/b.c') + 'd/b.c:1:x\nd/b.c:2:y\n',
+                         file_record(0, 'd/a.c') + 'd/a.c:3:z\n']:
+                fd, path = tempfile.mkstemp()
+                with os.fdopen(fd, 'w') as f:
+                    f.write(text)
+                shard_files.append(path)
+            stdout = StringIO()
+            sys.stdout = stdout
+            try:
+                rc = main(['pss', '--merge'] + shard_files)
+            finally:
+                sys.stdout = sys.__stdout__
+            self.assertEqual(rc, 0)
+            self.assertEqual(stdout.getvalue(),
+                             'd/a.c:3:z\nd/b.c:1:x\nd/b.c:2:y\n')
+
+            with open(shard_files[0], 'w') as f:
+                f.write('d/b.c:1:x\n')
+            stdout = StringIO()
+            sys.stdout = stdout
+            try:
+                rc = main(['pss', '--merge'] + shard_files)
+            finally:
+                sys.stdout = sys.__stdout__
+            self.assertEqual(rc, 2)
+        finally:
+            for path in shard_files:
+                os.remove(path)
+
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
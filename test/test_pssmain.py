@@ -8,9 +8,13 @@
 #-------------------------------------------------------------------------------
 from io import StringIO
 import os, sys
+import tempfile
+import time
 import unittest
+import unittest.mock
 
-from psslib.pss import main
+from psslib.defaultpssoutputformatter import DefaultPssOutputFormatter
+from psslib.pss import main, parse_cmdline
 from test.utils import (
         path_to_testdir, MockOutputFormatter, filter_out_path)
 
@@ -464,6 +468,26 @@ class TestPssMain(unittest.TestCase):
         self.assertEqual(binary_match[0], 'BINARY_MATCH')
         self.assertTrue(binary_match[1].find('zb.erl') > 0)
 
+    def test_textonly(self):
+        # Binary files are skipped, and each searched file is opened once
+        opened = []
+        real_open = open
+        def counting_open(path, *args, **kwargs):
+            opened.append(path)
+            return real_open(path, *args, **kwargs)
+
+        with unittest.mock.patch('builtins.open', counting_open):
+            self._run_main(['-t', '-G', 'zb\\.erl', 'cde'], expected_rc=1)
+        self.assertEqual(self.of.output, [])
+        self.assertEqual(len(opened), 1)
+
+        self._run_main(['-t', '-f', '-G', 'zb'])
+        self.assertFoundFiles(self.of, ['testdir1/zb.lsp'])
+        self.of = MockOutputFormatter('testdir1')
+        self._run_main(['-f', '-G', 'zb'])
+        self.assertFoundFiles(self.of,
+                              ['testdir1/zb.lsp', 'testdir1/subdir1/zb.erl'])
+
     def test_weird_chars(self):
         # .rb files have some weird characters in them - this is a sanity
         # test that shows that pss won't crash while decoding these files
@@ -532,6 +556,72 @@ class TestPssMain(unittest.TestCase):
                 self._gen_outputs_in_file(
                     'testdir1/filea.h', [('MATCH', (1, [(8, 11)]))])))
 
+    def test_multiple_patterns(self):
+        expected = sorted(
+            self._gen_outputs_in_file(
+                'testdir1/filea.c', [('MATCH', (1, [(0, 3)])),
+                                     ('MATCH', (2, [(4, 7)]))]) +
+            self._gen_outputs_in_file(
+                'testdir1/filea.h', [('MATCH', (1, [(8, 11)]))]))
+        self._run_main(['--cc', '-e', 'abc', '-e', 'jo[e]'])
+        self.assertEqual(sorted(self.of.output), expected)
+
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('abc\n\njoe\n')
+            self.of = MockOutputFormatter('testdir1')
+            self._run_main(['--cc', '--patterns-file', path])
+            self.assertEqual(sorted(self.of.output), expected)
+        finally:
+            os.remove(path)
+
+        sys.stdout = StringIO()
+        try:
+            self._run_main(['--patterns-file', path], expected_rc=2)
+        finally:
+            sys.stdout = sys.__stdout__
+
+    def test_explain(self):
+        self._run_main(['--cc', '--explain', 'abc'])
+        self.assertEqual(self.of.output[0][0], 'EXPLANATION')
+        self.assertEqual(self.of.output[0][1][0], 'engine: buffer-literal')
+        self.assertEqual(
+            sorted(self.of.output[1:]),
+            sorted(self._gen_outputs_in_file(
+                    'testdir1/filea.c', [('MATCH', (2, [(4, 7)]))]) +
+                self._gen_outputs_in_file(
+                    'testdir1/filea.h', [('MATCH', (1, [(8, 11)]))])))
+
+        self.of = MockOutputFormatter('testdir1')
+        self._run_main(['--explain', '-f'])
+        self.assertNotIn('EXPLANATION', [kind for kind, _ in self.of.output])
+
+    def test_multiline(self):
+        self._run_main(['--cc', '--multiline', '-A', '1', r'abcde.*?\nimp'])
+        self.assertEqual(
+            sorted(self.of.output),
+            sorted(self._gen_outputs_in_file(
+                    'testdir1/filea.c', [('MATCH', (2, [(4, 13)]))]) +
+                self._gen_outputs_in_file(
+                    'testdir1/filea.h', [('MATCH', (1, [(8, 23)])),
+                                         ('CONTEXT', 3)])))
+
+        # The default formatter emits each line of a match on its own, and
+        # also the lines of inverted matches.
+        for args, expected in [
+                (['--multiline', r'abcde\nimp'],
+                 ['2:4:moe abcde', '3:0:imp + x']),
+                (['-v', 'abc'], ['1:0:joe', '3:0:imp + x'])]:
+            stream = StringIO()
+            of = DefaultPssOutputFormatter(do_colors=False, do_heading=False,
+                                           show_column_of_first_match=True,
+                                           stream=stream)
+            self._run_main(['-G', r'filea\.c'] + args, output_formatter=of)
+            self.assertEqual([line.split(':', 1)[1]
+                              for line in stream.getvalue().splitlines()
+                              if line], expected)
+
     def test_return_code(self):
         # 0: match found or help/version printed
         # 1: no match
@@ -570,6 +660,55 @@ class TestPssMain(unittest.TestCase):
                                 'testdir3/crnewlines.txt', [('MATCH', (1, [(10, 14)]))])
                          ))
 
+    def test_files_from(self):
+        listed = [os.path.join(self.testdir1, 'filea.c'),
+                  os.path.join(self.testdir1, 'subdir1', 'someada.adb'),
+                  os.path.join(self.testdir1, 'subdir1', 'ppp.qqq')]
+        for separator, option in [('\n', []), ('\0', ['-0'])]:
+            fd, listpath = tempfile.mkstemp()
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(separator.join(listed) + separator)
+                of = MockOutputFormatter('testdir1')
+                rc = main(['', 'abc', '--files-from', listpath] + option,
+                          output_formatter=of)
+                self.assertEqual(rc, 0)
+                # ppp.qqq is not of a known type, so it's filtered out
+                self.assertEqual(sorted(of.output), sorted(
+                    self._gen_outputs_in_file(
+                        'testdir1/filea.c', [('MATCH', (2, [(4, 7)]))]) +
+                    self._gen_outputs_in_file(
+                        'testdir1/subdir1/someada.adb',
+                        [   ('MATCH', (4, [(18, 21)])),
+                            ('MATCH', (14, [(15, 18)]))])))
+            finally:
+                os.remove(listpath)
+
+    def test_stat_bound_options(self):
+        options, _, _ = parse_cmdline(
+            ['--max-filesize', '64k', '--min-filesize', '1.5M', 'abc'])
+        self.assertEqual(options.max_filesize, 64 * 1024)
+        self.assertEqual(options.min_filesize, int(1.5 * 1024 * 1024))
+
+        before = time.time()
+        options, _, _ = parse_cmdline(['--newer', '2d', 'abc'])
+        self.assertAlmostEqual(options.newer_than, before - 2 * 86400,
+                               delta=60)
+        options, _, _ = parse_cmdline(['--older', '2020-01-31', 'abc'])
+        self.assertEqual(options.older_than,
+                         time.mktime((2020, 1, 31, 0, 0, 0, 0, 0, -1)))
+
+        # Nothing in testdir1 is that big
+        self._run_main(['abc', '--min-filesize', '1G'], expected_rc=1)
+        self.assertEqual(self.of.output, [])
+
+        sys.stderr = StringIO()  # errors by optparse go here
+        try:
+            self._run_main(['abc', '--max-filesize', 'lots'], expected_rc=2)
+            self._run_main(['abc', '--newer', 'yesterday'], expected_rc=2)
+        finally:
+            sys.stderr = sys.__stderr__
+
     def _run_main(self, args, dir=None, output_formatter=None, expected_rc=0):
         rc = main(
             argv=[''] + args + [dir or self.testdir1],
@@ -0,0 +1,285 @@
+#-------------------------------------------------------------------------------
+# pss: test/test_watcher.py
+#
+# Test the watchers used by --watch, and the watch mode of pss_run
+#
+# Eli Bendersky (eliben@gmail.com)
+# This code is in the public domain
+#-------------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+from psslib import driver
+from psslib.driver import pss_run
+from psslib.matchresult import MatchResult
+from psslib.watcher import (WatchEvent, InotifyWatcher, PollingWatcher,
+                            diff_matches)
+from test.utils import MockOutputFormatter
+
+
+def _inotify_available():
+    try:
+        InotifyWatcher().close()
+        return True
+    except (OSError, AttributeError):
+        return False
+
+
+class TestDiffMatches(unittest.TestCase):
+    def test_diff(self):
+        old = [MatchResult(b'a\n', 1, []), MatchResult(b'b\n', 3, []),
+               MatchResult(b'c\n', 5, [])]
+        # Matches that only moved aren't reported
+        new = [MatchResult(b'a\n', 2, []), MatchResult(b'c\n', 6, []),
+               MatchResult(b'd\n', 7, [])]
+        removed, added = diff_matches(old, new)
+        self.assertEqual(removed, [old[1]])
+        self.assertEqual(added, [new[2]])
+        self.assertEqual(diff_matches(old, old), ([], []))
+        self.assertEqual(diff_matches([], new), ([], new))
+
+
+class WatcherTestMixin(object):
+    """ Tests common to all the watchers. create_watcher is implemented by
+        subclasses.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.watcher = self.create_watcher()
+        self.watched = os.path.join(self.tmpdir, 'watched.c')
+        self._write(self.watched, 'x')
+        self.watcher.add_dir(self.tmpdir)
+        self.watcher.add_file(self.watched)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def _wait(self, expected):
+        """ Wait until all the expected events are reported.
+        """
+        events = set()
+        deadline = time.time() + 5
+        while not expected <= events and time.time() < deadline:
+            events.update(self.watcher.wait(timeout=0.5))
+        return events
+
+    def test_events(self):
+        self.assertEqual(self.watcher.wait(timeout=0), [])
+
+        new_file = os.path.join(self.tmpdir, 'new.c')
+        new_dir = os.path.join(self.tmpdir, 'newdir')
+        self._write(new_file, 'y')
+        os.mkdir(new_dir)
+        expected = {(WatchEvent.FILE_CHANGED, new_file),
+                    (WatchEvent.DIR_CREATED, new_dir)}
+        self.assertTrue(expected <= self._wait(expected))
+
+        # Make sure the modification is visible to polling
+        os.utime(self.watched, (1e9, 1e9))
+        self._write(self.watched, 'changed')
+        expected = {(WatchEvent.FILE_CHANGED, self.watched)}
+        self.assertTrue(expected <= self._wait(expected))
+
+        os.remove(self.watched)
+        os.rmdir(new_dir)
+        expected = {(WatchEvent.FILE_DELETED, self.watched),
+                    (WatchEvent.DIR_DELETED, new_dir)}
+        self.assertTrue(expected <= self._wait(expected))
+
+    def test_single_files(self):
+        # Only the added files of a directory that isn't added itself are
+        # reported.
+        subdir = os.path.join(self.tmpdir, 'sub')
+        os.mkdir(subdir)
+        watched = os.path.join(subdir, 'a.c')
+        self._write(watched, 'x')
+        self.watcher.add_file(watched)
+        os.utime(watched, (1e9, 1e9))
+        self._write(os.path.join(subdir, 'b.c'), 'y')
+        self._write(watched, 'changed')
+        expected = {(WatchEvent.FILE_CHANGED, watched)}
+        events = self._wait(expected)
+        self.assertTrue(expected <= events)
+        self.assertNotIn(
+            (WatchEvent.FILE_CHANGED, os.path.join(subdir, 'b.c')), events)
+
+
+class TestPollingWatcher(WatcherTestMixin, unittest.TestCase):
+    def create_watcher(self):
+        return PollingWatcher(interval=0.05)
+
+
+@unittest.skipUnless(_inotify_available(), 'needs inotify')
+class TestInotifyWatcher(WatcherTestMixin, unittest.TestCase):
+    def create_watcher(self):
+        return InotifyWatcher()
+
+    def test_continuous_writes(self):
+        # A file written more often than SETTLE_SECONDS doesn't keep wait
+        # from returning
+        stop = threading.Event()
+        def write():
+            with open(self.watched, 'w') as f:
+                while not stop.is_set():
+                    f.write('x')
+                    f.flush()
+                    time.sleep(0.005)
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            for max_bytes in (InotifyWatcher.SETTLE_MAX_BYTES, 64):
+                self.watcher.SETTLE_MAX_BYTES = max_bytes
+                start = time.time()
+                self.assertIn((WatchEvent.FILE_CHANGED, self.watched),
+                              self.watcher.wait(timeout=5))
+                self.assertLess(time.time() - start, 2)
+        finally:
+            stop.set()
+            writer.join()
+
+
+class ScriptedWatcher(object):
+    """ A watcher reporting a fixed series of events; each batch of events
+        is produced by a function making changes to the files. Interrupts
+        the watch when the script is done.
+    """
+    def __init__(self, script):
+        self.script = list(script)
+        self.dirs = []
+        self.files = []
+
+    def add_dir(self, dirpath):
+        self.dirs.append(dirpath)
+
+    def add_file(self, path):
+        self.files.append(path)
+
+    def wait(self, timeout=None):
+        if not self.script:
+            raise KeyboardInterrupt()
+        return self.script.pop(0)()
+
+    def close(self):
+        pass
+
+
+class TestWatchMode(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filea = os.path.join(self.tmpdir, 'a.c')
+        self._write(self.filea, 'int foo;\nint bar;\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def _run(self, script, **kwargs):
+        watcher = ScriptedWatcher(script)
+        of = MockOutputFormatter(os.path.basename(self.tmpdir))
+        with unittest.mock.patch.object(driver, 'create_watcher',
+                                        lambda: watcher):
+            found = pss_run([self.tmpdir], pattern='foo|baz', watch=True,
+                            output_formatter=of, do_break=True, **kwargs)
+        return found, of.output, watcher
+
+    def test_watch(self):
+        fileb = os.path.join(self.tmpdir, 'sub', 'b.c')
+        def change_a():
+            self._write(self.filea, 'int bar;\nint baz;\nint foo;\n')
+            return [(WatchEvent.FILE_CHANGED, self.filea)]
+        def create_b():
+            os.mkdir(os.path.dirname(fileb))
+            self._write(fileb, 'foo\n')
+            self._write(os.path.join(self.tmpdir, 'sub', 'b.qqq'), 'foo\n')
+            return [(WatchEvent.DIR_CREATED, os.path.dirname(fileb))]
+        def delete_a():
+            os.remove(self.filea)
+            return [(WatchEvent.FILE_DELETED, self.filea)]
+        def unchanged_b():
+            return [(WatchEvent.FILE_CHANGED, fileb)]
+
+        found, output, watcher = self._run(
+            [change_a, create_b, delete_a, unchanged_b])
+        self.assertTrue(found)
+        dirname = os.path.basename(self.tmpdir)
+        self.assertEqual(output, [
+            # The initial search
+            ('START_MATCHES', '%s/a.c' % dirname),
+            ('MATCH', (1, [(4, 7)])),
+            ('END_MATCHES', '%s/a.c' % dirname),
+            # a.c changed: the match for foo moved, and baz was added
+            ('START_MATCHES', '%s/a.c' % dirname),
+            ('CHANGED_MATCH', ('+', 2, [(4, 7)])),
+            ('END_MATCHES', '%s/a.c' % dirname),
+            # b.c was created in a new directory; b.qqq is not searched
+            ('START_MATCHES', '%s/sub/b.c' % dirname),
+            ('CHANGED_MATCH', ('+', 1, [(0, 3)])),
+            ('END_MATCHES', '%s/sub/b.c' % dirname),
+            # a.c was deleted
+            ('START_MATCHES', '%s/a.c' % dirname),
+            ('CHANGED_MATCH', ('-', 2, [(4, 7)])),
+            ('CHANGED_MATCH', ('-', 3, [(4, 7)])),
+            ('END_MATCHES', '%s/a.c' % dirname),
+        ])
+        self.assertIn(self.tmpdir, watcher.dirs)
+        self.assertIn(os.path.dirname(fileb), watcher.dirs)
+        self.assertIn(fileb, watcher.files)
+
+    def test_watch_rules_of_root(self):
+        # Files and directories created during the watch are checked against
+        # the ignore files and max_depth of the root they're in
+        self._write(os.path.join(self.tmpdir, '.gitignore'),
+                    'ignored.c\nbuild/\n')
+        subdir = os.path.join(self.tmpdir, 'sub')
+        deepdir = os.path.join(subdir, 'deep')
+        builddir = os.path.join(self.tmpdir, 'build')
+        def create_files():
+            os.makedirs(deepdir)
+            os.mkdir(builddir)
+            for path in [os.path.join(self.tmpdir, 'ignored.c'),
+                         os.path.join(subdir, 'ignored.c'),
+                         os.path.join(subdir, 'b.c'),
+                         os.path.join(deepdir, 'c.c'),
+                         os.path.join(builddir, 'd.c')]:
+                self._write(path, 'foo\n')
+            return [(WatchEvent.FILE_CHANGED,
+                     os.path.join(self.tmpdir, 'ignored.c')),
+                    (WatchEvent.DIR_CREATED, subdir),
+                    (WatchEvent.DIR_CREATED, builddir)]
+        def create_deep():
+            return [(WatchEvent.DIR_CREATED, deepdir),
+                    (WatchEvent.FILE_CHANGED, os.path.join(deepdir, 'c.c')),
+                    (WatchEvent.FILE_CHANGED,
+                     os.path.join(subdir, 'ignored.c'))]
+
+        found, output, watcher = self._run([create_files, create_deep],
+                                           use_ignore_files=True, max_depth=2)
+        dirname = os.path.basename(self.tmpdir)
+        self.assertEqual(output, [
+            ('START_MATCHES', '%s/a.c' % dirname),
+            ('MATCH', (1, [(4, 7)])),
+            ('END_MATCHES', '%s/a.c' % dirname),
+            ('START_MATCHES', '%s/sub/b.c' % dirname),
+            ('CHANGED_MATCH', ('+', 1, [(0, 3)])),
+            ('END_MATCHES', '%s/sub/b.c' % dirname),
+        ])
+        self.assertNotIn(builddir, watcher.dirs)
+        self.assertNotIn(deepdir, watcher.dirs)
+
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
@@ -72,6 +72,11 @@ class MockOutputFormatter(OutputFormatter):
         self.output.append(('MATCH',
             (matchresult.matching_lineno, matchresult.matching_column_ranges)))
 
+    def changed_matching_line(self, matchresult, filename, change):
+        self.output.append(('CHANGED_MATCH',
+            (change, matchresult.matching_lineno,
+             matchresult.matching_column_ranges)))
+
     def context_line(self, line, lineno, filename):
         self.output.append(('CONTEXT', lineno))
 
@@ -81,6 +86,9 @@ class MockOutputFormatter(OutputFormatter):
     def binary_file_matches(self, msg):
         self.output.append(('BINARY_MATCH', msg))
 
+    def explanation(self, lines):
+        self.output.append(('EXPLANATION', lines))
+
     def found_filename(self, filename):
         relpath = path_relative_to_dir(filename, self.basepath)
         self.output.append((